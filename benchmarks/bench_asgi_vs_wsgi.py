@@ -0,0 +1,65 @@
+"""
+Load test of the two deployment modes against the same local database:
+sync Flask under gunicorn (wsgi.py) and the async app under uvicorn (asgi.py).
+
+    $ python benchmarks/bench_asgi_vs_wsgi.py --connections 1000 --duration 30 --workers 4
+
+Uses a seeded temporary sqlite database unless DB_CONNECTION_STRING is set
+(point it at a local Postgres / MySQL to compare with a networked database,
+the async mode then uses asyncpg / aiomysql). Run it with `ulimit -n` above
+the number of connections.
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+sys.path.insert(0, HERE)
+
+from loadgen import run
+from seed import seed
+from server import start_server
+
+PATHS = ['/people?limit=20', '/people/1', '/planet?limit=20', '/vehicle/1', '/people?limit=20&after=100']
+
+def bench(mode, args, port):
+    with start_server(mode, port, args.workers):
+        # warm-up pass so both modes are measured with open pools and loaded caches
+        asyncio.run(run('http://127.0.0.1:%d' % port, PATHS, min(args.connections, 50), 2))
+        return asyncio.run(run('http://127.0.0.1:%d' % port, PATHS, args.connections, args.duration)).to_dict()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=3100)
+    parser.add_argument('--modes', default='wsgi,asgi')
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    if not os.environ.get('DB_CONNECTION_STRING'):
+        os.environ['DB_CONNECTION_STRING'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    seed(args.rows)
+
+    results = {}
+    for offset, mode in enumerate(args.modes.split(',')):
+        results[mode] = bench(mode, args, args.port + offset)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("%d connections, %d workers, %.0fs, %s" % (args.connections, args.workers, args.duration,
+                                                    os.environ['DB_CONNECTION_STRING'].split(':')[0]))
+    print("%-6s %10s %8s %8s %8s %8s %8s" % ('mode', 'requests', 'errors', 'rps', 'p50 ms', 'p99 ms', 'max ms'))
+    for mode, r in results.items():
+        print("%-6s %10d %8d %8.1f %8.2f %8.2f %8.2f" % (mode, r['requests'], r['errors'], r['rps'],
+                                                         r['p50_ms'], r['p99_ms'], r['max_ms']))
+
+if __name__ == '__main__':
+    main()
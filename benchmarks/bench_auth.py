@@ -0,0 +1,75 @@
+"""
+Login throughput and latency of an authenticated endpoint while logins are running.
+
+    $ python benchmarks/bench_auth.py --login-threads 8 --read-threads 4 --seconds 10
+
+Runs the app in process against a temporary SQLite database (or DB_CONNECTION_STRING).
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--login-threads', type=int, default=8)
+    parser.add_argument('--read-threads', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    if 'DB_CONNECTION_STRING' not in os.environ:
+        os.environ['DB_CONNECTION_STRING'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    # every login comes from the same address, the /token limit would answer 429s
+    os.environ.setdefault('RATELIMIT_ENABLED', 'false')
+    from main import app, db
+
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+    client.post('/user', json={"first_name": "Bench", "last_name": "Mark", "email": "bench@example.com", "password": "bench"})
+    token = client.post('/token', json={"email": "bench@example.com", "password": "bench"}).json['token']
+    headers = {"Authorization": "Bearer " + token}
+
+    stop = time.monotonic() + args.seconds
+    logins, reads = [], []
+
+    def login_loop():
+        c = app.test_client()
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            c.post('/token', json={"email": "bench@example.com", "password": "bench"})
+            logins.append(time.perf_counter() - start)
+
+    def read_loop():
+        c = app.test_client()
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            c.get('/me/favorites', headers=headers)
+            reads.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=login_loop) for _ in range(args.login_threads)]
+    threads += [threading.Thread(target=read_loop) for _ in range(args.read_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print("hash method      %s (%d workers)" % (app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS']))
+    print("logins/sec       %.1f" % (len(logins) / args.seconds))
+    print("login p50/p99    %.1f / %.1f ms" % (percentile(logins, 50) * 1000, percentile(logins, 99) * 1000))
+    print("/me/favorites    %.1f req/sec, p50/p99 %.2f / %.2f ms" % (
+        len(reads) / args.seconds, percentile(reads, 50) * 1000, percentile(reads, 99) * 1000))
+
+if __name__ == '__main__':
+    main()
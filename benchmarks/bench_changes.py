@@ -0,0 +1,146 @@
+"""
+Incremental sync through the change feed (src/changes.py) against polling the
+collections in full, the cost of the triggers on writes, and how fast a long
+poll sees a change made by this process and by another one.
+
+    $ python benchmarks/bench_changes.py --scale 20000 --changes 100
+
+Seeds a temporary SQLite database unless DB_CONNECTION_STRING is set. The
+"other process" writes go through their own engine, so no commit of the app
+wakes the long poll: it finds them by polling (CHANGES_POLL_SECONDS).
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+sys.path.insert(0, HERE)
+
+from seed import seed
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def full_sync(client):
+    """(requests, bytes) to read /people, /planet and /vehicle in full."""
+    requests = size = 0
+    for path in ('/people', '/planet', '/vehicle'):
+        url = path + '?limit=1000'
+        while url:
+            response = client.get(url)
+            requests += 1
+            size += len(response.data)
+            link = response.headers.get('Link')
+            url = link[link.index('<') + 1:link.index('>')].replace('http://localhost', '') if link else None
+    return requests, size
+
+def incremental_sync(client, since):
+    """(requests, bytes, next) to read the changes after `since` and the entities they name."""
+    requests = size = 0
+    changed = set()
+    while True:
+        response = client.get('/changes?since=%d&limit=1000' % since)
+        requests += 1
+        size += len(response.data)
+        body = response.json
+        changed.update((change['type'], change['id']) for change in body['changes'] if change['op'] != 'delete')
+        since = body['next']
+        if not body['more']:
+            break
+    for type, id in sorted(changed):
+        response = client.get('/%s/%d' % (type, id))
+        requests += 1
+        size += len(response.data)
+    return requests, size, since
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=int, default=20000, help="rows per catalog table")
+    parser.add_argument('--changes', type=int, default=100, help="writes between two syncs")
+    parser.add_argument('--rows', type=int, default=20000, help="rows bulk inserted to time the triggers")
+    parser.add_argument('--waits', type=int, default=20, help="long polls timed")
+    args = parser.parse_args()
+
+    if not os.environ.get('DB_CONNECTION_STRING'):
+        os.environ['DB_CONNECTION_STRING'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ.setdefault('RATELIMIT_ENABLED', 'false')
+    seed(args.scale)
+    from sqlalchemy import create_engine, update
+    from main import create_app
+    from models import db, Character, Planet, Vehicle
+    from bulk import import_rows
+    from changes import change_feed, trigger_statements
+    app = create_app({'ENABLE_ADMIN': False})
+    client = app.test_client()
+    rng = random.Random(1)
+
+    since = client.get('/changes?since=now').json['next']
+    with app.app_context():
+        for i in range(args.changes):
+            model = rng.choice((Character, Planet, Vehicle))
+            db.session.execute(update(model).where(model.id == rng.randint(1, args.scale)).values(name='changed %d' % i))
+            db.session.commit()
+
+    print("sync after %d writes (%d rows per table)" % (args.changes, args.scale))
+    print("%-20s %9s %12s %10s" % ('', 'requests', 'bytes', 'time'))
+    start = time.perf_counter()
+    requests, size = full_sync(client)
+    print("%-20s %9d %12d %7.0f ms" % ('full collections', requests, size, (time.perf_counter() - start) * 1000))
+    start = time.perf_counter()
+    requests, size, since = incremental_sync(client, since)
+    print("%-20s %9d %12d %7.0f ms" % ('change feed', requests, size, (time.perf_counter() - start) * 1000))
+
+    print("\nbulk insert of %d characters" % args.rows)
+    items = [{"name": "bulk %d" % i, "birth_year": "1BBY", "gender": "n/a", "hair_color": "none", "skin_color": "grey",
+              "eye_color": "red"} for i in range(args.rows)]
+    with app.app_context():
+        drop, create = trigger_statements(db.engine.dialect.name, db.engine.dialect.identifier_preparer.quote)
+        for name, statements in (('with triggers', []), ('without triggers', drop), ('with triggers', create)):
+            with db.engine.begin() as connection:
+                for statement in statements:
+                    connection.exec_driver_sql(statement)
+            start = time.perf_counter()
+            report = import_rows(Character, items, 1000)
+            elapsed = time.perf_counter() - start
+            print("%-20s %9.0f rows/s" % (name, report['inserted'] / elapsed))
+        db.session.remove()
+
+    print("\nlong poll, change seen after the commit (%d waits, CHANGES_POLL_SECONDS=%s)" % (args.waits, change_feed.poll_seconds))
+    other = create_engine(os.environ['DB_CONNECTION_STRING'])
+    table = Planet.__table__
+    for name in ('this process', 'other process'):
+        latencies = []
+        for i in range(args.waits):
+            since = client.get('/changes?since=now').json['next']
+            seen = {}
+
+            def poll():
+                response = app.test_client().get('/changes?since=%d&wait=10' % since)
+                seen['at'] = time.perf_counter()
+                seen['changes'] = len(response.json['changes'])
+
+            thread = threading.Thread(target=poll)
+            thread.start()
+            time.sleep(rng.uniform(0.05, 0.3))
+            if name == 'this process':
+                with app.app_context():
+                    db.session.execute(update(Planet).where(Planet.id == 1).values(name='poll %d' % i))
+                    db.session.commit()
+                    committed = time.perf_counter()
+            else:
+                with other.begin() as connection:
+                    connection.execute(table.update().where(table.c.id == 1).values(name='poll %d' % i))
+                committed = time.perf_counter()
+            thread.join()
+            assert seen['changes'] == 1, seen
+            latencies.append(seen['at'] - committed)
+        print("%-20s p50 %6.1f ms   max %6.1f ms" % (name, percentile(latencies, 50) * 1000, max(latencies) * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""
+Load test of every route of src/main.py against a seeded database, one scenario
+per route, with throughput, p50 / p95 / p99 latency and the peak memory of the
+server. Results are written as JSON and can be checked against a previous run.
+
+    $ python benchmarks/bench_endpoints.py --scale 100000 --output results/base.json
+    $ python benchmarks/bench_endpoints.py --scale 100000 --baseline results/base.json --threshold 0.1
+
+Seeds a temporary SQLite database unless DB_CONNECTION_STRING is set (an
+existing database is only seeded when it has no characters, see seed.py).
+Exits with status 1 when a scenario lost more than --threshold of its
+throughput or its p99 grew by more than --threshold compared to --baseline.
+Read scenarios run before the ones that write, --only picks a subset.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+sys.path.insert(0, HERE)
+
+from loadgen import run, encode_request
+from seed import seed, email_of, SEED_PASSWORD, FIRST
+from server import start_server, rss_bytes, MemorySampler
+
+class Context:
+    """What the scenarios need to build their requests."""
+
+    def __init__(self, scale, users, tokens, run_id):
+        self.scale = scale
+        self.users = users
+        self.tokens = tokens
+        self.run_id = run_id
+
+    def rng(self, i):
+        return random.Random(i)
+
+    def token(self, i):
+        return self.tokens[i % len(self.tokens)]
+
+    def user(self, i):
+        return i % len(self.tokens) + 1
+
+def character(i):
+    return {"name": "Bench %d" % i, "hair_color": "brown", "skin_color": "fair", "eye_color": "blue",
+            "birth_year": "19BBY", "gender": "male"}
+
+def planet(i):
+    return {"name": "Bench %d" % i, "orbital_period": 304, "gravity": "1 standard", "population": 200000,
+            "climate": "arid"}
+
+def vehicle(i):
+    return {"name": "Bench %d" % i, "model": "T-16", "manufacturer": "Incom", "cost_in_credits": 14500,
+            "length": 10, "cargo_capacity": 50}
+
+def gets(paths):
+    return lambda ctx, i, host: [encode_request(host, 'GET', path) for path in paths(ctx, ctx.rng(i))]
+
+def page_paths(resource):
+    return lambda ctx, rng: ["/%s?limit=20&after=%d" % (resource, rng.randrange(ctx.scale)) for _ in range(50)]
+
+def item_paths(resource, count='scale'):
+    return lambda ctx, rng: ["/%s/%d" % (resource, rng.randrange(1, getattr(ctx, count) + 1)) for _ in range(50)]
+
+def authenticated(ctx, i, host, method, paths, body=None):
+    headers = {"Authorization": "Bearer %s" % ctx.token(i)}
+    return [encode_request(host, method, path, body, headers) for path in paths]
+
+def create(resource, factory):
+    return lambda ctx, i, host: [encode_request(host, 'POST', '/' + resource, factory(i * 100 + k)) for k in range(10)]
+
+def bulk(resource, factory):
+    return lambda ctx, i, host: [encode_request(host, 'POST', '/%s/bulk' % resource, [factory(k) for k in range(100)])]
+
+def create_users(ctx, i, host):
+    # unique emails, a connection that goes through its list gets 400s for the duplicates
+    return [encode_request(host, 'POST', '/user', {"first_name": "Bench", "last_name": "User", "password": SEED_PASSWORD,
+                                                  "email": "bench-%s-%d-%d@bench.local" % (ctx.run_id, i, k)})
+            for k in range(100)]
+
+def login(ctx, i, host):
+    return [encode_request(host, 'POST', '/token', {"email": email_of(ctx.user(i)), "password": SEED_PASSWORD})]
+
+def add_favorites(ctx, i, host):
+    # distinct characters per connection, seeded favorites of the same user answer 400
+    paths = ["/user/favorite/people/%d" % c for c in ctx.rng(i).sample(range(1, ctx.scale + 1), min(200, ctx.scale))]
+    return authenticated(ctx, i, host, 'POST', paths)
+
+# name -> (connection index, host) -> [raw request]; reads first, writes last
+SCENARIOS = {
+    "sitemap": gets(lambda ctx, rng: ['/']),
+    "openapi": gets(lambda ctx, rng: ['/openapi.json']),
+    "health_db": gets(lambda ctx, rng: ['/health/db']),
+    "metrics": gets(lambda ctx, rng: ['/metrics']),
+    "cache_stats": gets(lambda ctx, rng: ['/cache/stats']),
+    "search": gets(lambda ctx, rng: ['/search?q=%s' % rng.choice(FIRST) for _ in range(20)]),
+    "leaderboard": gets(lambda ctx, rng: ['/leaderboard/%s?limit=10' % t for t in ('people', 'planet', 'vehicle')]),
+    "user_list": gets(page_paths('user')),
+    "user_item": gets(item_paths('user', 'users')),
+    "people_list": gets(page_paths('people')),
+    "people_item": gets(item_paths('people')),
+    "planet_list": gets(page_paths('planet')),
+    "planet_item": gets(item_paths('planet')),
+    "vehicle_list": gets(page_paths('vehicle')),
+    "vehicle_item": gets(item_paths('vehicle')),
+    "user_favorites": gets(lambda ctx, rng: ['/user/%d/favorites' % rng.randrange(1, ctx.users + 1) for _ in range(50)]),
+    "me_favorites": lambda ctx, i, host: authenticated(ctx, i, host, 'GET', ['/me/favorites']),
+    "token": login,
+    "create_user": create_users,
+    "create_people": create('people', character),
+    "create_planet": create('planet', planet),
+    "create_vehicle": create('vehicle', vehicle),
+    "bulk_people": bulk('people', character),
+    "bulk_planet": bulk('planet', planet),
+    "bulk_vehicle": bulk('vehicle', vehicle),
+    "add_fav": add_favorites
+}
+
+def access_tokens(count):
+    """Tokens of the first `count` seeded users, signed with the server's JWT_SECRET_KEY."""
+    from main import app
+    from flask_jwt_extended import create_access_token
+    with app.app_context():
+        return [create_access_token(identity=user_id) for user_id in range(1, count + 1)]
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_scenarios(args, ctx, names):
+    url = 'http://127.0.0.1:%d' % args.port
+    results = {}
+    with start_server(args.mode, args.port, args.workers) as server:
+        # warm-up so the first scenario does not pay for connecting and loading the caches
+        asyncio.run(run(url, lambda i, host: SCENARIOS['people_list'](ctx, i, host), 10, 1))
+        for name in names:
+            sampler = MemorySampler(server.pid)
+            sampler.start()
+            scenario = SCENARIOS[name]
+            result = asyncio.run(run(url, lambda i, host: scenario(ctx, i, host), args.connections, args.duration)).to_dict()
+            peak = sampler.stop()
+            result["peak_rss_mb"] = round(peak / 2 ** 20, 1) if peak is not None else None
+            results[name] = result
+            print("%-16s %8.1f rps  p50 %8.2f  p95 %8.2f  p99 %8.2f ms  %s" % (
+                name, result['rps'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['statuses']), flush=True)
+        rss = rss_bytes(server.pid)
+    return results, rss
+
+def compare(results, baseline, threshold):
+    """[(scenario, message)] for every regression beyond `threshold`."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base:
+            continue
+        if base['rps'] and result['rps'] < base['rps'] * (1 - threshold):
+            regressions.append((name, "throughput %.1f -> %.1f rps" % (base['rps'], result['rps'])))
+        if base['p99_ms'] and result['p99_ms'] > base['p99_ms'] * (1 + threshold):
+            regressions.append((name, "p99 %.2f -> %.2f ms" % (base['p99_ms'], result['p99_ms'])))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=int, default=1000, help="characters, planets and vehicles to seed (10^3 - 10^6)")
+    parser.add_argument('--users', type=int, default=None, help="users to seed (scale / 10)")
+    parser.add_argument('--favorites', type=int, default=3, help="favorites of each kind per user")
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=5, help="seconds per scenario")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--mode', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--port', type=int, default=3200)
+    parser.add_argument('--only', default=None, help="comma separated scenarios: %s" % ",".join(SCENARIOS))
+    parser.add_argument('--output', default=None, help="write the results to this JSON file")
+    parser.add_argument('--baseline', default=None, help="JSON results of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1)
+    parser.add_argument('--rate-limit', action='store_true', help="keep the rate limits on (most write scenarios then measure 429s)")
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else list(SCENARIOS)
+    unknown = set(names).difference(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenario(s): %s" % ", ".join(sorted(unknown)))
+    if args.mode == 'asgi':
+        # routes the async app does not serve
+        names = [n for n in names if n not in ('sitemap', 'openapi', 'metrics', 'cache_stats', 'search', 'leaderboard') and not n.startswith('bulk_')]
+
+    if not os.environ.get('DB_CONNECTION_STRING'):
+        os.environ['DB_CONNECTION_STRING'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    if not args.rate_limit:
+        os.environ['RATELIMIT_ENABLED'] = 'false'
+    users = max(args.scale // 10, 1) if args.users is None else args.users
+    start = time.perf_counter()
+    seed(args.scale, users, args.favorites)
+    print("seeded in %.1fs" % (time.perf_counter() - start))
+    ctx = Context(args.scale, users, access_tokens(min(users, args.connections)), int(time.time()))
+
+    results, rss = run_scenarios(args, ctx, names)
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "commit": git_commit(),
+            "database": os.environ['DB_CONNECTION_STRING'].split(':')[0],
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "mode": args.mode,
+            "workers": args.workers,
+            "scale": args.scale,
+            "users": users,
+            "connections": args.connections,
+            "duration": args.duration,
+            "rate_limit": args.rate_limit,
+            "final_rss_mb": round(rss / 2 ** 20, 1) if rss is not None else None
+        },
+        "scenarios": results
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, message in regressions:
+            print("REGRESSION %-16s %s" % (name, message))
+        if regressions:
+            sys.exit(1)
+        print("no regression above %.0f%%" % (args.threshold * 100))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Latency of POST /people when each write has a slow side effect: without side
+effect, with the side effect run inline in the request (JOBS_INLINE) and with
+it queued (src/jobs.py) while a worker runs the queue in a thread.
+
+    $ python benchmarks/bench_jobs.py --requests 500 --cost-ms 20 --spike-ms 200
+
+The side effect sleeps --cost-ms, one in 50 --spike-ms (a slow remote call).
+Runs the app in process against a temporary SQLite database (or DB_CONNECTION_STRING).
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+CHARACTER = {"name": "Bench", "hair_color": "none", "skin_color": "grey", "eye_color": "red", "birth_year": "0BBY", "gender": "n/a"}
+
+def writes(client, requests):
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.post('/people', json=CHARACTER)
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.status_code
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--cost-ms', type=float, default=20, help="duration of the side effect")
+    parser.add_argument('--spike-ms', type=float, default=200, help="duration of one side effect in 50")
+    args = parser.parse_args()
+
+    if 'DB_CONNECTION_STRING' not in os.environ:
+        os.environ['DB_CONNECTION_STRING'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ.setdefault('RATELIMIT_ENABLED', 'false')
+    from main import create_app
+    from models import db, Character, Job
+    from jobs import task, side_effects, job_queue, Worker
+
+    app = create_app({'ENABLE_ADMIN': False})
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+
+    @task('bench_side_effect')
+    def side_effect(payload):
+        time.sleep((args.spike_ms if random.random() < 0.02 else args.cost_ms) / 1000)
+
+    print("%-34s %9s %9s %9s" % ('POST /people', 'p50', 'p99', 'max'))
+
+    def report(name, timings):
+        print("%-34s %6.2f ms %6.2f ms %6.2f ms" % (
+            name, percentile(timings, 50) * 1000, percentile(timings, 99) * 1000, max(timings) * 1000))
+
+    writes(client, 20)  # warm up
+    report('no side effect', writes(client, args.requests))
+
+    side_effects[Character] = ['bench_side_effect']
+    job_queue.inline = True
+    report('side effect inline', writes(client, args.requests))
+
+    job_queue.inline = False
+    worker = Worker(poll_seconds=0.05)
+
+    def work():
+        with app.app_context():
+            worker.work()
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    report('side effect queued, worker running', writes(client, args.requests))
+
+    start = time.perf_counter()
+    with app.app_context():
+        while Job.query.filter(Job.status.in_(('queued', 'running'))).count():
+            db.session.remove()
+            time.sleep(0.05)
+        db.session.remove()
+    worker.stop()
+    thread.join()
+    print("queue drained %.1f s after the last write, %d jobs done, %d retried, %d failed" % (
+        time.perf_counter() - start, worker.done, worker.retried, worker.failed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Cost of the rate limiter: one bucket update per store, and the time it adds
+to a request of a limited route (run in process with the test client).
+
+    $ python benchmarks/bench_ratelimit.py --keys 10000 --requests 5000
+    $ RATELIMIT_REDIS_URL=redis://localhost:6379/0 python benchmarks/bench_ratelimit.py
+
+Runs the app in process against a temporary SQLite database (or DB_CONNECTION_STRING).
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+def per_call_us(fn, count):
+    start = time.perf_counter()
+    for i in range(count):
+        fn(i)
+    return (time.perf_counter() - start) / count * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=10000, help="distinct clients")
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    if 'DB_CONNECTION_STRING' not in os.environ:
+        os.environ['DB_CONNECTION_STRING'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    from main import create_app, db
+    from ratelimit import Limit, LocalBuckets, DictBuckets, RedisBuckets, rate_limiter
+
+    # never empty, every call takes the allowed path
+    limit = Limit.parse('1000000000/second')
+    stores = {"local": LocalBuckets(), "memory://": DictBuckets()}
+    if os.environ.get('RATELIMIT_REDIS_URL'):
+        stores["redis"] = RedisBuckets(os.environ['RATELIMIT_REDIS_URL'])
+    for name, store in stores.items():
+        us = per_call_us(lambda i: store.consume('bench:%d' % (i % args.keys), limit), args.requests)
+        print("consume %-10s %8.2f us" % (name, us))
+
+    app = create_app({'RATELIMIT_DEFAULT': '1000000000/second', 'ENABLE_ADMIN': False})
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+    # a 304 from memory, the cheapest route there is: the limiter is most of what differs
+    etag = client.get('/openapi.json').headers['ETag']
+    best = {}
+    for _ in range(3):
+        for enabled in (False, True):
+            rate_limiter.enabled = enabled
+            us = per_call_us(lambda i: client.get('/openapi.json', headers={'If-None-Match': etag},
+                                                  environ_base={'REMOTE_ADDR': '10.0.%d.%d' % (i // 256 % 256, i % 256)}),
+                             args.requests)
+            best[enabled] = min(us, best.get(enabled, us))
+    for enabled, us in best.items():
+        print("GET /openapi.json (304), rate limit %-3s %8.2f us per request" % ('on' if enabled else 'off', us))
+    print("added by the rate limiter          %8.2f us" % (best[True] - best[False]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Latency of the in-process search index (used when the database has no native
+full-text index) on a synthetic catalog.
+
+    $ python benchmarks/bench_search.py --rows 1000000 --target-p99-ms 50
+
+Exits with status 1 when the p99 latency is above the target.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+FIRST = ['luke', 'leia', 'han', 'anakin', 'padme', 'obi', 'wan', 'darth', 'boba', 'jango', 'mace', 'qui', 'gon',
+         'lando', 'wedge', 'biggs', 'owen', 'beru', 'jabba', 'greedo', 'yoda', 'chewbacca', 'rey', 'finn', 'poe']
+LAST = ['skywalker', 'organa', 'solo', 'amidala', 'kenobi', 'vader', 'fett', 'windu', 'jinn', 'calrissian',
+        'antilles', 'darklighter', 'lars', 'hutt', 'dameron', 'kylo', 'ren', 'tano', 'bane', 'maul']
+
+def synthetic_names(rows, seed=42):
+    rng = random.Random(seed)
+    for i in range(rows):
+        yield i + 1, "%s %s %d" % (rng.choice(FIRST).title(), rng.choice(LAST).title(), rng.randrange(10000))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--target-p99-ms', type=float, default=50)
+    args = parser.parse_args()
+
+    from search import InvertedIndex, tokenize
+
+    index = InvertedIndex()
+    start = time.perf_counter()
+    index.bulk_load((id, name, name) for id, name in synthetic_names(args.rows))
+    build = time.perf_counter() - start
+
+    rng = random.Random(7)
+    queries = []
+    for _ in range(args.queries):
+        kind = rng.random()
+        if kind < 0.4:
+            queries.append(rng.choice(FIRST)[:rng.randint(3, 5)])  # prefix of a first name
+        elif kind < 0.8:
+            queries.append("%s %s" % (rng.choice(FIRST), rng.choice(LAST)[:4]))  # two words
+        else:
+            queries.append("%s %s %d" % (rng.choice(FIRST), rng.choice(LAST), rng.randrange(10000)))  # exact
+
+    def run():
+        timings = []
+        for q in queries:
+            start = time.perf_counter()
+            index.search(tokenize(q), args.limit)
+            timings.append(time.perf_counter() - start)
+        return percentile(timings, 50) * 1000, percentile(timings, 99) * 1000
+
+    # the first pass also sorts the ranked postings of the tokens it touches
+    cold = run()
+    p50, p99 = run()
+    print("rows             %d" % args.rows)
+    print("build            %.1f s" % build)
+    print("queries          %d" % len(queries))
+    print("cold p50 / p99   %.2f / %.2f ms" % cold)
+    print("warm p50 / p99   %.2f / %.2f ms (target p99 %.1f ms)" % (p50, p99, args.target_p99_ms))
+    if p99 > args.target_p99_ms:
+        print("FAIL: p99 above target")
+        sys.exit(1)
+    print("OK")
+
+if __name__ == '__main__':
+    main()
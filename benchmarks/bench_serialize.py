@@ -0,0 +1,78 @@
+"""
+Serialization of a large list: ORM objects + serialize() + jsonify against the
+precompiled Core serializers (stdlib json and orjson when installed).
+
+    $ python benchmarks/bench_serialize.py --rows 100000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if 'DB_CONNECTION_STRING' not in os.environ:
+        os.environ['DB_CONNECTION_STRING'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    from flask import jsonify
+    from main import app
+    from models import db, Character
+    import serializers
+
+    with app.app_context():
+        db.create_all()
+        if Character.query.count() < args.rows:
+            db.session.execute(Character.__table__.insert(), [
+                {"name": "Character %d" % i, "hair_color": "brown", "skin_color": "fair", "eye_color": "blue",
+                 "birth_year": "%dBBY" % (i % 100), "gender": "female" if i % 2 else "male"}
+                for i in range(args.rows)
+            ])
+            db.session.commit()
+
+    def orm_path():
+        with app.test_request_context():
+            people = Character.query.limit(args.rows).all()
+            return len(jsonify([person.serialize() for person in people]).get_data())
+
+    def core_path(backend, fields=None):
+        def run():
+            serializers.JSON_BACKEND = backend
+            serializer = serializers.serializer_for(Character)
+            fields_ = serializer.fields(fields)
+            encode = serializer.encoder(fields_)
+            with app.app_context():
+                rows = db.session.execute(serializer.select(fields_).order_by(Character.id).limit(args.rows)).all()
+                return len(serializers.dumps([encode(row) for row in rows]))
+        return run
+
+    cases = [("orm + serialize() + jsonify", orm_path), ("core + compiled encoder + json", core_path('json'))]
+    if serializers.orjson is not None:
+        cases.append(("core + compiled encoder + orjson", core_path('orjson')))
+        cases.append(("core, ?fields=name,gender, orjson", core_path('orjson', 'name,gender')))
+    else:
+        cases.append(("core, ?fields=name,gender, json", core_path('json', 'name,gender')))
+
+    print("%d rows, best of %d" % (args.rows, args.repeat))
+    baseline = None
+    for name, fn in cases:
+        seconds, size = best_of(args.repeat, fn)
+        baseline = baseline or seconds
+        print("%-36s %8.1f ms  %6.2fx  %d bytes" % (name, seconds * 1000, baseline / seconds, size))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Memory of the catalog snapshot (src/snapshot.py): the tables in the snapshot
+against the same rows as ORM objects plus their serialize() dicts, then the
+memory of each gunicorn worker with the snapshot off, on with a preloaded
+master (shared copy on write) and on without preloading (one copy per worker).
+
+    $ python benchmarks/bench_snapshot.py --scale 100000 --workers 2
+    $ python benchmarks/bench_snapshot.py --no-gunicorn
+
+Seeds a temporary SQLite database unless DB_CONNECTION_STRING is set. Worker
+memory is read from /proc/<pid>/smaps_rollup (Linux): pss counts the shared
+pages divided among the processes, uss the pages only that worker has.
+"""
+import os
+import sys
+import gc
+import time
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', 'src')
+sys.path.insert(0, SRC)
+sys.path.insert(0, HERE)
+
+from seed import seed
+from server import server_command, wait_until_up, process_tree, smaps_rollup, ROOT
+
+MB = 2 ** 20
+
+def allocated(build):
+    """(result, bytes still allocated by it) of build()."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        gc.collect()
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+def in_process():
+    from main import create_app
+    from models import db
+    from snapshot import catalog, CATALOG
+    app = create_app({'CATALOG_SNAPSHOT': True, 'ENABLE_ADMIN': False})
+    with app.app_context():
+        print("%-10s %9s %14s %14s %8s" % ('table', 'rows', 'ORM + dicts', 'snapshot', 'ratio'))
+        for model in CATALOG:
+            rows, orm_bytes = allocated(lambda: [(row, row.serialize()) for row in model.query.all()])
+            count = len(rows)
+            del rows
+            db.session.remove()
+            _, snapshot_bytes = allocated(lambda: catalog.load([model]))
+            print("%-10s %9d %9.1f MB %9.1f MB %7.1fx   (%d / %d bytes per row)" % (
+                model.__tablename__, count, orm_bytes / MB, snapshot_bytes / MB, orm_bytes / max(snapshot_bytes, 1),
+                orm_bytes // max(count, 1), snapshot_bytes // max(count, 1)))
+
+def hit(port, scale, requests):
+    """Reads items and pages of every catalog table, so each worker has served (and loaded) them."""
+    step = max(scale // requests, 1)
+    for i in range(requests):
+        id = i * step % scale + 1
+        for path in ('/people/%d' % id, '/planet/%d' % id, '/vehicle/%d' % id, '/planet?climate=arid&limit=100&after=%d' % id):
+            with urllib.request.urlopen('http://127.0.0.1:%d%s' % (port, path), timeout=30) as response:
+                response.read()
+
+def workers_memory(port, workers, scale, requests, snapshot, preload):
+    env = dict(os.environ, CATALOG_SNAPSHOT='true' if snapshot else 'false', GUNICORN_PRELOAD='true' if preload else 'false',
+               RATELIMIT_ENABLED='false', ENABLE_ADMIN='false')
+    server = subprocess.Popen(server_command('wsgi', port, workers), cwd=ROOT, env=env)
+    try:
+        wait_until_up(port, timeout=120)
+        hit(port, scale, requests)
+        time.sleep(0.5)
+        pids = [pid for pid in process_tree(server.pid) if pid != server.pid]
+        return [smaps_rollup(pid) for pid in pids]
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=int, default=100000, help="rows per catalog table")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--requests', type=int, default=200, help="rounds of catalog requests before measuring")
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--no-gunicorn', action='store_true', help="skip the per worker measures")
+    args = parser.parse_args()
+
+    if not os.environ.get('DB_CONNECTION_STRING'):
+        os.environ['DB_CONNECTION_STRING'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    seed(args.scale)
+    in_process()
+    if args.no_gunicorn:
+        return
+
+    print("\nper worker (%d workers), after %d rounds of catalog requests" % (args.workers, args.requests))
+    print("%-28s %10s %10s %10s" % ('', 'rss', 'pss', 'uss'))
+    for name, snapshot, preload in (('snapshot off', False, True), ('snapshot on, preloaded', True, True),
+                                    ('snapshot on, not preloaded', True, False)):
+        measures = [m for m in workers_memory(args.port, args.workers, args.scale, args.requests, snapshot, preload) if m]
+        if not measures:
+            print("%-28s (no /proc/<pid>/smaps_rollup)" % name)
+            continue
+        average = {key: sum(m[key] for m in measures) / len(measures) / MB for key in ('rss', 'pss', 'uss')}
+        print("%-28s %7.1f MB %7.1f MB %7.1f MB" % (name, average['rss'], average['pss'], average['uss']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Startup cost of the API: time to import src/main.py, to build the app, to
+answer its first request (in a fresh process each time) and for gunicorn to
+answer the first request with and without a preloaded master.
+
+    $ python benchmarks/bench_startup.py --repeat 10 --output results/startup.json
+    $ python benchmarks/bench_startup.py --baseline results/startup.json --threshold 0.2
+
+Uses a seeded temporary SQLite database unless DB_CONNECTION_STRING is set.
+Exits with status 1 when a median grew by more than --threshold compared to
+--baseline.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', 'src')
+sys.path.insert(0, SRC)
+sys.path.insert(0, HERE)
+
+from seed import seed
+from server import server_command, ROOT
+
+# run in a fresh interpreter, prints the timings (seconds) as JSON
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app()
+created = time.perf_counter()
+client = app.test_client()
+assert client.get('/people?limit=20').status_code == 200
+first = time.perf_counter()
+admin = None
+if app.config['ENABLE_ADMIN']:
+    client.get('/admin/')
+    admin = time.perf_counter() - first
+print(json.dumps({"import": imported - start, "create_app": created - imported,
+                  "first_request": first - created, "total": first - start, "first_admin_request": admin}))
+"""
+
+def probe(env):
+    output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=SRC, env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def interpreter_start(env):
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', 'pass'], env=env)
+    return time.perf_counter() - start
+
+def gunicorn_boot(port, workers, preload, timeout=60):
+    """Seconds from starting gunicorn to the first 200 on /people."""
+    env = dict(os.environ, GUNICORN_PRELOAD='true' if preload else 'false')
+    start = time.perf_counter()
+    server = subprocess.Popen(server_command('wsgi', port, workers), cwd=ROOT, env=env)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen('http://127.0.0.1:%d/people?limit=20' % port, timeout=5) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError("gunicorn did not answer within %ds" % timeout)
+    finally:
+        server.terminate()
+        server.wait()
+
+def summarize(samples):
+    samples = [s for s in samples if s is not None]
+    if not samples:
+        return None
+    return {"median_ms": round(statistics.median(samples) * 1000, 2), "min_ms": round(min(samples) * 1000, 2),
+            "max_ms": round(max(samples) * 1000, 2)}
+
+def compare(results, baseline, threshold):
+    """[(measure, message)] for every median that grew by more than `threshold`."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base or not result:
+            continue
+        if result['median_ms'] > base['median_ms'] * (1 + threshold):
+            regressions.append((name, "%.1f -> %.1f ms" % (base['median_ms'], result['median_ms'])))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help="fresh processes per measure")
+    parser.add_argument('--rows', type=int, default=1000, help="characters, planets and vehicles to seed")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--port', type=int, default=3300)
+    parser.add_argument('--no-gunicorn', action='store_true', help="skip the gunicorn boot measures")
+    parser.add_argument('--output', default=None, help="write the results to this JSON file")
+    parser.add_argument('--baseline', default=None, help="JSON results of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if not os.environ.get('DB_CONNECTION_STRING'):
+        os.environ['DB_CONNECTION_STRING'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    seed(args.rows)
+
+    samples = {}
+    for enable_admin in ('true', 'false'):
+        env = dict(os.environ, ENABLE_ADMIN=enable_admin)
+        for _ in range(args.repeat):
+            for name, value in probe(env).items():
+                samples.setdefault(name if enable_admin == 'true' else name + '_no_admin', []).append(value)
+    samples.pop('first_admin_request_no_admin', None)
+    samples['python_startup'] = [interpreter_start(dict(os.environ)) for _ in range(args.repeat)]
+    if not args.no_gunicorn:
+        for preload in (False, True):
+            name = 'gunicorn_boot_preload' if preload else 'gunicorn_boot'
+            samples[name] = [gunicorn_boot(args.port, args.workers, preload) for _ in range(args.repeat)]
+
+    results = {name: summarize(values) for name, values in samples.items()}
+    for name, result in results.items():
+        if result:
+            print("%-28s median %8.1f ms  min %8.1f  max %8.1f" % (name, result['median_ms'], result['min_ms'], result['max_ms']))
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "database": os.environ['DB_CONNECTION_STRING'].split(':')[0],
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "repeat": args.repeat,
+            "workers": args.workers
+        },
+        "results": results
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, message in regressions:
+            print("REGRESSION %-28s %s" % (name, message))
+        if regressions:
+            sys.exit(1)
+        print("no regression above %.0f%%" % (args.threshold * 100))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Checks with EXPLAIN that the collection queries of src/query.py are answered
+from an index: filtered shapes must search an index (no full table scan) and
+sorted shapes must read rows in index order (no sort step). Prints the plan of
+every shape and exits with 1 if one of them doesn't hold; tests/test_query_plans.py
+runs the same checks on SQLite.
+
+    $ python benchmarks/explain_queries.py --scale 20000
+    $ DB_CONNECTION_STRING=postgresql://localhost/bench python benchmarks/explain_queries.py
+
+Seeds the database of DB_CONNECTION_STRING (a temporary SQLite database by
+default) with benchmarks/seed.py and runs ANALYZE first, so the planner sees
+realistic statistics. SQLite (EXPLAIN QUERY PLAN) and Postgres (EXPLAIN) only.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+# range / IN filters in id order: reading the table in id order until LIMIT rows
+# match is the better plan when the filter keeps many rows, only a planner with
+# value statistics (Postgres, SQLite built with STAT4) can tell, so they are
+# checked there and just reported otherwise
+STATS = 'stats'
+
+# (collection, query string args, the filters use an index, the rows come in index order)
+CASES = [
+    ('people', {}, False, True),
+    ('people', {'after': '500'}, True, True),
+    ('people', {'gender': 'female'}, True, True),
+    ('people', {'eye_color__in': 'red,yellow'}, STATS, False),
+    ('people', {'hair_color__null': 'true'}, True, True),
+    ('people', {'name': 'Lu'}, True, False),
+    ('planet', {'climate': 'arid'}, True, True),
+    ('planet', {'climate': 'arid', 'after': '500'}, True, True),
+    ('planet', {'population__gt': '999000000'}, STATS, False),
+    ('planet', {'sort': '-population'}, False, True),
+    ('planet', {'sort': 'population', 'cursor': [500000000, 500]}, True, True),
+    ('planet', {'sort': '-orbital_period', 'fields': 'name'}, False, True),
+    ('vehicle', {'sort': '-cost_in_credits', 'fields': 'name,model'}, False, True),
+    ('vehicle', {'cost_in_credits__lt': '1000', 'sort': 'cost_in_credits'}, True, True),
+    ('vehicle', {'model': 'T-42', 'fields': 'name,model'}, True, True),
+    ('vehicle', {'manufacturer__in': 'Hoth Engineering,Endor Engineering'}, STATS, False),
+    ('vehicle', {'length__gte': '99', 'length__lt': '100'}, STATS, False),
+    ('vehicle', {'name__prefix': 'Solo speeder 1', 'sort': 'name'}, True, True),
+    ('user', {'sort': '-join_date'}, False, True),
+    ('user', {'email': 'user1@bench.local'}, True, False),
+]
+
+def explain(connection, dialect, sql):
+    """(plan lines, full scan, sort step) of a SELECT."""
+    from sqlalchemy import text
+    if dialect == 'sqlite':
+        lines = [row[-1] for row in connection.execute(text('EXPLAIN QUERY PLAN ' + sql))]
+        # "SCAN planet" without an index reads the whole table (in rowid order)
+        scan = any(line.startswith('SCAN') and 'USING' not in line for line in lines)
+        return lines, scan, any('TEMP B-TREE' in line for line in lines)
+    plan = connection.execute(text('EXPLAIN (FORMAT JSON) ' + sql)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    nodes, pending = [], [plan[0]['Plan']]
+    while pending:
+        node = pending.pop()
+        nodes.append(node)
+        pending.extend(node.get('Plans', []))
+    lines = ['%s %s' % (node['Node Type'], node.get('Index Name') or node.get('Relation Name') or '') for node in nodes]
+    return lines, any(node['Node Type'] == 'Seq Scan' for node in nodes), any('Sort' in node['Node Type'] for node in nodes)
+
+def check(connection, dialect):
+    """(collection, query string args, plan lines, problems, full scan) of each of CASES, run after ANALYZE."""
+    from sqlalchemy import text
+    from models import db, User, Character, Planet, Vehicle
+    from query import CollectionQuery, encode_cursor
+    models = {'user': User, 'people': Character, 'planet': Planet, 'vehicle': Vehicle}
+    connection.execute(text('ANALYZE'))
+    statistics = dialect == 'postgresql' or any(
+        'ENABLE_STAT4' in row[0] for row in connection.execute(text('PRAGMA compile_options')))
+    results = []
+    for collection, query_args, searched, ordered in CASES:
+        query_args = dict(query_args)
+        if isinstance(query_args.get('cursor'), list):
+            query_args['cursor'] = encode_cursor(query_args['cursor'])
+        query = CollectionQuery.parse(models[collection], query_args)
+        statement = query.statement(cursor=query.start_after(query_args))
+        sql = str(statement.params(query.params, limit=101).compile(
+            dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+        lines, scan, sort = explain(connection, dialect, sql)
+        problems = []
+        if scan and (searched is True or (searched == STATS and statistics)):
+            problems.append('full table scan')
+        if ordered and sort:
+            problems.append('sort step')
+        results.append((collection, query_args, lines, problems, scan and searched == STATS))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=int, default=20000, help="rows per table when seeding")
+    args = parser.parse_args()
+
+    if not os.environ.get('DB_CONNECTION_STRING'):
+        os.environ['DB_CONNECTION_STRING'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'explain.db')
+    from seed import seed
+    seed(args.scale)
+    from main import app
+    from models import db
+
+    failures = 0
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        if dialect not in ('sqlite', 'postgresql'):
+            parser.error("EXPLAIN checks support sqlite and postgresql, not %s" % dialect)
+        with db.engine.connect() as connection:
+            for collection, query_args, lines, problems, unindexed in check(connection, dialect):
+                failures += bool(problems)
+                shown = '&'.join('%s=%s' % item for item in query_args.items())
+                print("%-4s /%s?%s" % ('FAIL' if problems else 'ok', collection, shown))
+                for line in lines:
+                    print("       %s" % line)
+                if problems:
+                    print("       -> %s" % ', '.join(problems))
+                elif unindexed:
+                    print("       -> scans in id order, no value statistics to pick the index")
+    print("%d of %d query shapes passed" % (len(CASES) - failures, len(CASES)))
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
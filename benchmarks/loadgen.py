@@ -0,0 +1,138 @@
+"""
+Minimal asyncio HTTP/1.1 load generator: N keep-alive connections each sending
+requests back to back for a fixed duration.
+
+    $ python benchmarks/loadgen.py http://127.0.0.1:3000 /people?limit=20 --connections 1000 --duration 30
+
+Only what the API answers is supported: Content-Length or chunked bodies,
+the connection is reopened when the server closes it.
+"""
+import json
+import time
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+async def read_response(reader):
+    """(status, keep_alive) of the next response, its body is read and dropped."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("connection closed by the server")
+    version, status = status_line.split(b' ', 2)[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower()] = value.strip().lower()
+    if headers.get(b'transfer-encoding') == b'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif b'content-length' in headers:
+        await reader.readexactly(int(headers[b'content-length']))
+    keep_alive = headers.get(b'connection') != b'close' and version == b'HTTP/1.1'
+    return int(status), keep_alive
+
+class LoadResult:
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def to_dict(self):
+        count = len(self.latencies)
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "statuses": {str(k): v for k, v in sorted(self.statuses.items())},
+            "rps": round(count / self.elapsed, 1) if self.elapsed else 0.0,
+            "p50_ms": round(percentile(self.latencies, 50) * 1000, 2),
+            "p90_ms": round(percentile(self.latencies, 90) * 1000, 2),
+            "p95_ms": round(percentile(self.latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(self.latencies, 99) * 1000, 2),
+            "max_ms": round(max(self.latencies, default=0) * 1000, 2)
+        }
+
+async def connection_loop(host, port, requests, deadline, result, connect_timeout):
+    reader = writer = None
+    index = 0
+    while time.monotonic() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), connect_timeout)
+            start = time.perf_counter()
+            writer.write(requests[index % len(requests)])
+            index += 1
+            status, keep_alive = await read_response(reader)
+            result.latencies.append(time.perf_counter() - start)
+            result.statuses[status] = result.statuses.get(status, 0) + 1
+            if not keep_alive:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            result.errors += 1
+            if writer is not None:
+                writer.close()
+                writer = None
+            await asyncio.sleep(0.05)
+    if writer is not None:
+        writer.close()
+
+def encode_request(host, method, path, body=None, headers=None):
+    """Raw HTTP/1.1 request, `body` is sent as JSON."""
+    lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s" % host, "Accept: application/json"]
+    data = b''
+    if body is not None:
+        data = json.dumps(body).encode()
+        lines += ["Content-Type: application/json", "Content-Length: %d" % len(data)]
+    lines += ["%s: %s" % item for item in (headers or {}).items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + data
+
+def build_requests(host, paths, headers=None):
+    return [encode_request(host, 'GET', path, headers=headers) for path in paths]
+
+async def run(url, requests, connections=100, duration=10.0, headers=None, connect_timeout=10.0):
+    """
+    `requests` is a list of GET paths shared by every connection (each one starts
+    at a different offset) or a function (connection index, host) -> [raw request].
+    """
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    if callable(requests):
+        requests_for = requests
+    else:
+        shared = build_requests(parts.netloc, requests, headers)
+        requests_for = lambda i, host: shared[i % len(shared):] + shared[:i % len(shared)]
+    result = LoadResult()
+    start = time.monotonic()
+    deadline = start + duration
+    await asyncio.gather(*[
+        connection_loop(host, port, requests_for(i, parts.netloc), deadline, result, connect_timeout)
+        for i in range(connections)
+    ])
+    result.elapsed = time.monotonic() - start
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('url')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--connections', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+    print(asyncio.run(run(args.url, args.paths, args.connections, args.duration)).to_dict())
+
+if __name__ == '__main__':
+    main()
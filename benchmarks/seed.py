@@ -0,0 +1,126 @@
+"""
+Seeds the database of DB_CONNECTION_STRING (SQLite, Postgres, MySQL) with
+synthetic SWAPI data, reproducibly (fixed random seed).
+
+    $ DB_CONNECTION_STRING=postgresql://localhost/bench python benchmarks/seed.py --scale 1000000
+
+--scale sets the number of characters, planets and vehicles; users default to
+scale / 10 and each user gets --favorites favorites of each kind. Every user
+has the password SEED_PASSWORD and the email user<n>@bench.local.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+SEED_PASSWORD = 'bench-password'
+CHUNK = 10000
+
+FIRST = ['luke', 'leia', 'han', 'anakin', 'padme', 'obi', 'wan', 'darth', 'boba', 'jango', 'mace', 'qui', 'gon',
+         'lando', 'wedge', 'biggs', 'owen', 'beru', 'jabba', 'greedo', 'yoda', 'chewbacca', 'rey', 'finn', 'poe']
+LAST = ['skywalker', 'organa', 'solo', 'amidala', 'kenobi', 'vader', 'fett', 'windu', 'jinn', 'calrissian',
+        'antilles', 'darklighter', 'lars', 'hutt', 'dameron', 'kylo', 'ren', 'tano', 'bane', 'maul']
+WORLDS = ['tatooine', 'alderaan', 'hoth', 'dagobah', 'bespin', 'endor', 'naboo', 'coruscant', 'kamino', 'geonosis']
+CLIMATES = ['arid', 'temperate', 'frozen', 'murky', 'tropical']
+
+def email_of(user_id):
+    return "user%d@bench.local" % user_id
+
+def characters(rng, count):
+    for i in range(count):
+        yield {"name": "%s %s %d" % (rng.choice(FIRST).title(), rng.choice(LAST).title(), i),
+               "hair_color": rng.choice(['blond', 'brown', 'black', 'none']),
+               "skin_color": rng.choice(['fair', 'light', 'dark', 'green']),
+               "eye_color": rng.choice(['blue', 'brown', 'yellow', 'red']),
+               "birth_year": "%dBBY" % rng.randrange(1000), "gender": rng.choice(['male', 'female', 'n/a'])}
+
+def planets(rng, count):
+    for i in range(count):
+        yield {"name": "%s %d" % (rng.choice(WORLDS).title(), i), "orbital_period": rng.randrange(100, 5000),
+               "gravity": "%d standard" % rng.randrange(1, 4), "population": rng.randrange(10 ** 9),
+               "climate": rng.choice(CLIMATES)}
+
+def vehicles(rng, count):
+    for i in range(count):
+        yield {"name": "%s speeder %d" % (rng.choice(LAST).title(), i), "model": "T-%d" % rng.randrange(100),
+               "manufacturer": "%s Engineering" % rng.choice(WORLDS).title(), "cost_in_credits": rng.randrange(10 ** 6),
+               "length": rng.randrange(1, 100), "cargo_capacity": rng.randrange(10 ** 4)}
+
+def users(rng, count, password_hash):
+    for i in range(1, count + 1):
+        yield {"first_name": rng.choice(FIRST).title(), "last_name": rng.choice(LAST).title(),
+               "email": email_of(i), "password": password_hash}
+
+def favorites(rng, user_count, target_count, per_user, key):
+    for user_id in range(1, user_count + 1):
+        for target_id in rng.sample(range(1, target_count + 1), min(per_user, target_count)):
+            yield {"user_id": user_id, key: target_id}
+
+def insert(table, rows):
+    from models import db
+    chunk, total = [], 0
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            db.session.execute(table.insert(), chunk)
+            total += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+        total += len(chunk)
+    db.session.commit()
+    return total
+
+def seed(scale=1000, user_count=None, per_user=3, reset=False, seed=42, verbose=False, app=None):
+    """
+    Creates the tables and fills them, unless characters already exist (pass reset=True to start over).
+    The database is the one of `app`, main.app (DB_CONNECTION_STRING) by default.
+    """
+    if app is None:
+        from main import app
+    from auth import hasher
+    from models import db, User, Character, Planet, Vehicle, FavoriteCharacter, FavoritePlanet, FavoriteVehicle
+    user_count = max(scale // 10, 1) if user_count is None else user_count
+    rng = random.Random(seed)
+    counts = {}
+    with app.app_context():
+        if reset:
+            db.drop_all()
+        db.create_all()
+        if Character.query.first() is not None:
+            return counts
+        # one hash shared by every user, hashing each password would dominate seeding
+        password_hash = hasher.hash(SEED_PASSWORD)
+        for name, table, rows in (
+            ("characters", Character.__table__, characters(rng, scale)),
+            ("planets", Planet.__table__, planets(rng, scale)),
+            ("vehicles", Vehicle.__table__, vehicles(rng, scale)),
+            ("users", User.__table__, users(rng, user_count, password_hash)),
+            ("favorite_characters", FavoriteCharacter.__table__, favorites(rng, user_count, scale, per_user, 'character_id')),
+            ("favorite_planets", FavoritePlanet.__table__, favorites(rng, user_count, scale, per_user, 'planet_id')),
+            ("favorite_vehicles", FavoriteVehicle.__table__, favorites(rng, user_count, scale, per_user, 'vehicle_id'))
+        ):
+            start = time.perf_counter()
+            counts[name] = insert(table, rows)
+            if verbose:
+                print("%-20s %9d rows %7.1fs" % (name, counts[name], time.perf_counter() - start))
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=None)
+    parser.add_argument('--favorites', type=int, default=3, help="favorites of each kind per user")
+    parser.add_argument('--reset', action='store_true', help="drop and recreate the tables first")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    if not os.environ.get('DB_CONNECTION_STRING'):
+        parser.error("set DB_CONNECTION_STRING")
+    seed(args.scale, args.users, args.favorites, args.reset, args.seed, verbose=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Starts the API in a subprocess for the load tests (sync: gunicorn + wsgi.py,
+async: uvicorn + asgi.py) and samples its memory.
+"""
+import os
+import time
+import socket
+import threading
+import contextlib
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+SRC = os.path.join(ROOT, 'src')
+
+def server_command(mode, port, workers):
+    if mode == 'wsgi':
+        return ['gunicorn', 'wsgi', '--chdir', SRC, '-w', str(workers), '-b', '127.0.0.1:%d' % port,
+                '--backlog', '2048', '--log-level', 'warning']
+    return ['uvicorn', 'asgi:app', '--app-dir', SRC, '--workers', str(workers), '--port', str(port),
+            '--backlog', '2048', '--log-level', 'warning', '--no-access-log']
+
+def wait_until_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server on port %d did not start" % port)
+
+def process_tree(pid):
+    """pid and all its descendants (Linux /proc)."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, ()))
+    return tree
+
+def rss_bytes(pid):
+    """Resident memory of a process and its workers, None where /proc is not available."""
+    if not os.path.isdir('/proc'):
+        return None
+    total = 0
+    for process in process_tree(pid):
+        try:
+            with open('/proc/%d/status' % process) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+def smaps_rollup(pid):
+    """
+    Memory of one process in bytes from /proc/<pid>/smaps_rollup: rss, pss
+    (shared pages divided among the processes sharing them) and uss (pages
+    only this process maps), None where it is not available.
+    """
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            fields = {}
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    except OSError:
+        return None
+    return {"rss": fields.get('Rss', 0), "pss": fields.get('Pss', 0),
+            "uss": fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)}
+
+class MemorySampler(threading.Thread):
+    """Peak RSS of the server process tree, sampled every `interval` seconds."""
+
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            rss = rss_bytes(self.pid)
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.peak
+
+@contextlib.contextmanager
+def start_server(mode, port, workers):
+    server = subprocess.Popen(server_command(mode, port, workers), cwd=ROOT)
+    try:
+        wait_until_up(port)
+        yield server
+    finally:
+        server.terminate()
+        server.wait()
@@ -0,0 +1,30 @@
+# gunicorn reads this file from the directory it is started in (see Procfile)
+import gc
+import os
+
+# the master imports and builds the app once and the workers fork from it,
+# GUNICORN_PRELOAD=false loads it in every worker instead (code reload with HUP)
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes', 'on')
+
+def when_ready(server):
+    # preloaded: warm the master before the first fork (see main.warm)
+    if server.cfg.preload_app and hasattr(server.app.wsgi(), 'app_context'):
+        from main import warm
+        warm(server.app.wsgi())
+        # move what the master built out of the collector's reach: collections
+        # in the workers won't write to those objects and unshare their pages
+        gc.freeze()
+
+def post_fork(server, worker):
+    # a worker must not reuse connections opened by the master
+    if server.cfg.preload_app and hasattr(worker.app.wsgi(), 'app_context'):
+        from dbpool import dispose_after_fork
+        dispose_after_fork(worker.app.wsgi())
+
+def post_worker_init(worker):
+    # open the database connections before the worker takes traffic,
+    # DB_POOL_WARMUP sets how many (see src/dbpool.py)
+    if not hasattr(worker.wsgi, 'app_context'):
+        return  # ASGI app (asgi:app), its async engine connects lazily
+    from dbpool import warm_up
+    warm_up(worker.wsgi)
@@ -0,0 +1,49 @@
+"""lookup indexes and favorites uniqueness
+
+Revision ID: 3b9f1c2d7e45
+Revises: 6ef8bec030f8
+Create Date: 2026-10-18 09:12:31.104215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9f1c2d7e45'
+down_revision = '6ef8bec030f8'
+branch_labels = None
+depends_on = None
+
+FAVORITE_TABLES = (
+    ('favorite-character', 'character_id', 'ix_favorite_character_user_id_character_id'),
+    ('favorite-planet', 'planet_id', 'ix_favorite_planet_user_id_planet_id'),
+    ('favorite-vehicle', 'vehicle_id', 'ix_favorite_vehicle_user_id_vehicle_id'),
+)
+
+
+def upgrade():
+    quote = op.get_bind().dialect.identifier_preparer.quote
+    # drop duplicated favorites (keeping the oldest one) so the unique indexes can be built,
+    # the derived table is needed for MySQL which can't select from the table it deletes from
+    for table, column, _ in FAVORITE_TABLES:
+        op.execute(
+            "DELETE FROM {t} WHERE id NOT IN (SELECT id FROM (SELECT MIN(id) AS id FROM {t} GROUP BY user_id, {c}) AS keep)"
+            .format(t=quote(table), c=quote(column))
+        )
+
+    op.create_index('ix_user_email', 'user', ['email'], unique=True)
+    for table, column, name in FAVORITE_TABLES:
+        op.create_index(name, table, ['user_id', column], unique=True)
+    op.create_index('ix_character_name', 'character', ['name'], unique=False)
+    op.create_index('ix_planet_name', 'planet', ['name'], unique=False)
+    op.create_index('ix_vehicle_name', 'vehicle', ['name'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_vehicle_name', table_name='vehicle')
+    op.drop_index('ix_planet_name', table_name='planet')
+    op.drop_index('ix_character_name', table_name='character')
+    for table, _, name in reversed(FAVORITE_TABLES):
+        op.drop_index(name, table_name=table)
+    op.drop_index('ix_user_email', table_name='user')
@@ -0,0 +1,47 @@
+"""native full-text search indexes
+
+Revision ID: 5c7a9e1b3d20
+Revises: 8d2e4a6c1f03
+Create Date: 2026-10-18 13:40:05.218764
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c7a9e1b3d20'
+down_revision = '8d2e4a6c1f03'
+branch_labels = None
+depends_on = None
+
+# table -> searched columns, must match SEARCH_FIELDS in src/search.py
+SEARCH_COLUMNS = (
+    ('character', ['name']),
+    ('planet', ['name']),
+    ('vehicle', ['name', 'model', 'manufacturer']),
+)
+
+
+def tsvector(columns):
+    document = " || ' ' || ".join("coalesce(%s, '')" % column for column in columns)
+    return sa.text("to_tsvector('simple', %s)" % document)
+
+
+def upgrade():
+    # other databases (sqlite) use the in-process index of src/search.py
+    dialect = op.get_bind().dialect.name
+    for table, columns in SEARCH_COLUMNS:
+        name = 'ix_%s_search' % table
+        if dialect == 'postgresql':
+            op.create_index(name, table, [tsvector(columns)], postgresql_using='gin')
+        elif dialect == 'mysql':
+            op.create_index(name, table, columns, mysql_prefix='FULLTEXT')
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect not in ('postgresql', 'mysql'):
+        return
+    for table, _ in reversed(SEARCH_COLUMNS):
+        op.drop_index('ix_%s_search' % table, table_name=table)
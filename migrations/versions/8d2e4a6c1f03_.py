@@ -0,0 +1,27 @@
+"""widen user.password to hold salted hashes
+
+Revision ID: 8d2e4a6c1f03
+Revises: 3b9f1c2d7e45
+Create Date: 2026-10-18 11:02:47.551930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e4a6c1f03'
+down_revision = '3b9f1c2d7e45'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing plain text passwords are rehashed on the next successful login
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.alter_column('password', existing_type=sa.String(length=80), type_=sa.String(length=255), existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.alter_column('password', existing_type=sa.String(length=255), type_=sa.String(length=80), existing_nullable=False)
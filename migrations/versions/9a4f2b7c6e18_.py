@@ -0,0 +1,36 @@
+"""(column, id) indexes for the filters and sorts of the collection endpoints
+
+Revision ID: 9a4f2b7c6e18
+Revises: 13c59d2c930c
+Create Date: 2026-10-18 15:12:44.906311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4f2b7c6e18'
+down_revision = '13c59d2c930c'
+branch_labels = None
+depends_on = None
+
+# table -> queryable columns, must match the __table_args__ of src/models.py
+QUERY_COLUMNS = (
+    ('user', ['join_date']),
+    ('character', ['gender', 'eye_color', 'hair_color']),
+    ('planet', ['climate', 'population', 'orbital_period']),
+    ('vehicle', ['model', 'manufacturer', 'cost_in_credits', 'length', 'cargo_capacity']),
+)
+
+
+def upgrade():
+    for table, columns in QUERY_COLUMNS:
+        for column in columns:
+            op.create_index('ix_%s_%s_id' % (table, column), table, [column, 'id'], unique=False)
+
+
+def downgrade():
+    for table, columns in reversed(QUERY_COLUMNS):
+        for column in reversed(columns):
+            op.drop_index('ix_%s_%s_id' % (table, column), table_name=table)
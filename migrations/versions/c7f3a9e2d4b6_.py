@@ -0,0 +1,87 @@
+"""change_log table and the triggers filling it, for src/changes.py
+
+Revision ID: c7f3a9e2d4b6
+Revises: b3e8d1f4a2c7
+Create Date: 2026-10-18 19:42:37.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7f3a9e2d4b6'
+down_revision = 'b3e8d1f4a2c7'
+branch_labels = None
+depends_on = None
+
+TRACKED = ['user', 'character', 'planet', 'vehicle', 'favorite-character', 'favorite-planet', 'favorite-vehicle']
+
+POSTGRES_FUNCTION = """
+CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO change_log (entity_type, entity_id, op, created) VALUES (TG_TABLE_NAME, OLD.id, 'delete', now() AT TIME ZONE 'utc');
+        RETURN OLD;
+    END IF;
+    INSERT INTO change_log (entity_type, entity_id, op, created) VALUES (TG_TABLE_NAME, NEW.id, lower(TG_OP), now() AT TIME ZONE 'utc');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+
+NOW = {'sqlite': 'CURRENT_TIMESTAMP', 'mysql': 'UTC_TIMESTAMP()'}
+
+
+def triggers():
+    """(drop, create) statements of the triggers for the database being migrated."""
+    dialect = op.get_bind().dialect
+    quote = dialect.identifier_preparer.quote
+    drop, create = [], []
+    if dialect.name == 'postgresql':
+        create.append(POSTGRES_FUNCTION)
+    elif dialect.name not in NOW:
+        return drop, create
+    for table in TRACKED:
+        name = 'change_log_' + table.replace('-', '_')
+        if dialect.name == 'postgresql':
+            drop.append('DROP TRIGGER IF EXISTS %s ON %s' % (name, quote(table)))
+            create.append('CREATE TRIGGER %s AFTER INSERT OR UPDATE OR DELETE ON %s FOR EACH ROW EXECUTE PROCEDURE record_change()'
+                          % (name, quote(table)))
+            continue
+        for event in ('insert', 'update', 'delete'):
+            insert = "INSERT INTO change_log (entity_type, entity_id, op, created) VALUES ('%s', %s.id, '%s', %s)" % (
+                table, 'OLD' if event == 'delete' else 'NEW', event, NOW[dialect.name])
+            drop.append('DROP TRIGGER IF EXISTS %s_%s' % (name, event))
+            if dialect.name == 'sqlite':
+                create.append('CREATE TRIGGER %s_%s AFTER %s ON %s BEGIN %s; END' % (name, event, event.upper(), quote(table), insert))
+            else:
+                create.append('CREATE TRIGGER %s_%s AFTER %s ON %s FOR EACH ROW %s' % (name, event, event.upper(), quote(table), insert))
+    if dialect.name == 'postgresql':
+        drop.append('DROP FUNCTION IF EXISTS record_change()')
+    return drop, create
+
+
+def upgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_table('change_log',
+    sa.Column('seq', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('entity_type', sa.String(length=50), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('op', sa.String(length=10), nullable=False),
+    sa.Column('created', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('seq')
+    )
+    # ### end Alembic commands ###
+    drop, create = triggers()
+    for statement in create:
+        op.execute(statement)
+
+
+def downgrade():
+    drop, create = triggers()
+    for statement in drop:
+        op.execute(statement)
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_table('change_log')
+    # ### end Alembic commands ###
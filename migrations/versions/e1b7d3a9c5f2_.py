@@ -0,0 +1,33 @@
+"""PostgreSQL indexes of the ?name= prefix ranges (name COLLATE "C")
+
+Revision ID: e1b7d3a9c5f2
+Revises: d4a8c2e6f1b9
+Create Date: 2026-10-18 21:48:30.275914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1b7d3a9c5f2'
+down_revision = 'd4a8c2e6f1b9'
+branch_labels = None
+depends_on = None
+
+TABLES = ['character', 'planet', 'vehicle']
+
+
+def upgrade():
+    # src/query.py compares the prefixes byte by byte, SQLite and MySQL use their name indexes as they are
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table in TABLES:
+        op.execute('CREATE INDEX ix_%s_name_c ON %s (name COLLATE "C")' % (table, op.get_bind().dialect.identifier_preparer.quote(table)))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table in TABLES:
+        op.drop_index('ix_%s_name_c' % table, table_name=table)
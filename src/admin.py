@@ -1,21 +1,102 @@
 import os
+import logging
+from flask import Flask, flash
 from flask_admin import Admin
-from models import db, User, Character, Planet, Vehicle, FavoriteCharacter, FavoritePlanet, FavoriteVehicle
+from flask_admin.babel import gettext
+from sqlalchemy import delete
+from models import db, User, Character, Planet, Vehicle, FavoriteCharacter, FavoritePlanet, FavoriteVehicle, Job
 from flask_admin.contrib.sqla import ModelView
+from cache import entity_cache
+from collection_cache import collection_cache
+from search import search_engine
+from jobs import enqueue_side_effects
+from favorites import FAVORITE_TYPES, count_favorites
 
-def setup_admin(app):
-    app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
-    app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
-    admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
+log = logging.getLogger("flask-admin.sqla")
+
+class JobsModelView(ModelView):
+    # the background side effects of the edit (see jobs.py) are queued in its transaction
+    def on_model_change(self, form, model, is_created):
+        enqueue_side_effects(model, 'created' if is_created else 'updated')
+
+    def on_model_delete(self, model):
+        enqueue_side_effects(model, 'deleted')
+
+class CachedModelView(JobsModelView):
+    # keep the caches of the item and collection endpoints and the search index in sync with edits done in the admin
+    def after_model_change(self, form, model, is_created):
+        entity_cache.invalidate(type(model), model.id)
+        collection_cache.invalidate(type(model))
+        search_engine.add(model)
+
+    def after_model_delete(self, model):
+        entity_cache.invalidate(type(model), model.id)
+        collection_cache.invalidate(type(model))
+        search_engine.remove(model)
+
+class FavoriteModelView(ModelView):
+    # favorites are added and removed here like through the API, with their favorite_count (see popularity.py);
+    # a favorite is not edited, changing its target would have to move a count
+    can_edit = False
+
+    def counted(self, model):
+        for resource, (favorite, entity, key) in FAVORITE_TYPES.items():
+            if favorite is type(model):
+                return resource, getattr(model, key + '_id')
+
+    def on_model_change(self, form, model, is_created):
+        if is_created:
+            db.session.flush()  # the id of the target, set through the relationship; a duplicate fails here
+            resource, id = self.counted(model)
+            if id is not None:
+                count_favorites(resource, [id], 1)
+
+    def delete_model(self, model):
+        # ModelView.delete_model, with a DELETE whose rowcount tells whether this request removed
+        # the favorite: one removed meanwhile (API, another admin) is not uncounted twice
+        try:
+            self.on_model_delete(model)
+            table = type(model).__table__
+            if self.session.execute(delete(table).where(table.c.id == model.id)).rowcount:
+                resource, id = self.counted(model)
+                if id is not None:
+                    count_favorites(resource, [id], -1)
+            self.session.expunge(model)
+            self.session.commit()
+        except Exception as ex:
+            if not self.handle_view_exception(ex):
+                flash(gettext('Failed to delete record. %(error)s', error=str(ex)), 'error')
+                log.exception('Failed to delete record.')
+            self.session.rollback()
+            return False
+        else:
+            self.after_model_delete(model)
+        return True
+
+def create_admin_app(app):
+    """
+    The admin, as its own Flask app mounted on /admin by main.create_app (built
+    on the first /admin request), with the configuration and the database of `app`.
+    """
+    admin_app = Flask(__name__, static_folder=None)
+    admin_app.config.update(app.config)
+    admin_app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
+    admin_app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
+    db.init_app(admin_app)
+    # one connection pool for both apps
+    admin_app.extensions['sqlalchemy'] = app.extensions['sqlalchemy']
+    admin = Admin(admin_app, name='4Geeks Admin', template_mode='bootstrap3', url='/')
 
     
     # Add your models here, for example this is how we add a the User model to the admin
-    admin.add_view(ModelView(User, db.session))
+    admin.add_view(CachedModelView(User, db.session))
 
     # You can duplicate that line to add mew models
-    admin.add_view(ModelView(Character, db.session))
-    admin.add_view(ModelView(Planet, db.session))
-    admin.add_view(ModelView(Vehicle, db.session))
-    admin.add_view(ModelView(FavoriteCharacter, db.session))
-    admin.add_view(ModelView(FavoritePlanet, db.session))
-    admin.add_view(ModelView(FavoriteVehicle, db.session))
\ No newline at end of file
+    admin.add_view(CachedModelView(Character, db.session))
+    admin.add_view(CachedModelView(Planet, db.session))
+    admin.add_view(CachedModelView(Vehicle, db.session))
+    admin.add_view(FavoriteModelView(FavoriteCharacter, db.session))
+    admin.add_view(FavoriteModelView(FavoritePlanet, db.session))
+    admin.add_view(FavoriteModelView(FavoriteVehicle, db.session))
+    admin.add_view(ModelView(Job, db.session))
+    return admin_app
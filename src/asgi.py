@@ -0,0 +1,590 @@
+"""
+ASGI entry point: the API of main.py (people, planet, vehicle, user, token and
+favorites routes) served by async handlers on an async SQLAlchemy engine, so a
+worker keeps serving other requests while it waits on the database.
+
+    $ uvicorn asgi:app --app-dir ./src/ --port 3000
+    $ gunicorn asgi:app -k uvicorn.workers.UvicornWorker --chdir ./src/
+
+The WSGI app (wsgi.py, used by the Procfile) stays the default. Both modes share
+the database, the serializers, the validation, the ETags and the item cache
+(cache.py, revalidated against the change feed), and issue
+interchangeable JWTs (same secret and claims as flask_jwt_extended).
+The admin, bulk imports and search are only served by the WSGI app. Waiting
+/changes consumers (long poll, event streams) cost no thread here. The rate
+limits of ratelimit.py apply to the routes under the endpoint names of main.py.
+"""
+import os
+import time
+import logging
+import uuid
+import asyncio
+import contextlib
+import datetime
+import jwt as pyjwt
+from sqlalchemy import select, update, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, JSONResponse, StreamingResponse
+from starlette.routing import Route, Match
+from starlette.concurrency import run_in_threadpool
+from werkzeug.http import is_resource_modified, http_date
+from models import User, Character, Planet, Vehicle, FavoriteCharacter, FavoriteCount
+from utils import APIException
+from serializers import serializer_for, dumps
+from pagination import int_arg, page_limit, stream_format, STREAM_BATCH_SIZE
+from query import CollectionQuery
+from conditional import version_statement, version_validators, timestamp_column, as_utc
+from cache import make_entity, configure_cache, CACHED_TABLES, REVALIDATE_BATCH
+from bulk import validate
+from auth import hasher, configure_hasher, check_credentials
+from favorites import FAVORITE_TYPES, count_upsert, parse_favorites, delete_statements, deleted_ids
+from dbpool import engine_options, pool_status
+from changes import CHANGES, LATEST, batch, event_stream_chunk, parse_types, configure_changes
+from ratelimit import configure_ratelimit, LocalBuckets
+
+log = logging.getLogger(__name__)
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite'
+}
+
+JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', "secret_key")
+JWT_ACCESS_TOKEN_EXPIRES = datetime.timedelta(minutes=15)  # flask_jwt_extended default
+
+def async_url(url):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+    if backend == 'sqlite' and url.database and url.database != ':memory:':
+        # flask_sqlalchemy resolves relative sqlite paths from src/, do the same
+        url = url.set(database=os.path.join(os.path.dirname(os.path.abspath(__file__)), url.database))
+    return url
+
+def async_engine_options(url):
+    options = engine_options(url)
+    options.pop('poolclass', None)  # async engines need their own adapted pool
+    timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    if timeout and make_url(url).get_backend_name() == 'postgresql':
+        options['connect_args'] = {"server_settings": {"statement_timeout": str(timeout)}}
+    return options
+
+def connect():
+    url = os.environ.get('DB_CONNECTION_STRING')
+    if not url:
+        raise RuntimeError("DB_CONNECTION_STRING is not set")
+    return create_async_engine(async_url(url), **async_engine_options(url))
+
+engine = None  # created when the server starts, see lifespan()
+configure_hasher({})
+change_feed = configure_changes({})
+entity_cache = configure_cache({})
+entity_cache.shared = None  # the redis client would block the event loop
+rate_limiter = configure_ratelimit({})
+
+# helpers
+
+def json_response(obj, status_code=200, headers=None):
+    return Response(dumps(obj), status_code=status_code, media_type='application/json', headers=headers)
+
+def not_modified(request, etag, last_modified):
+    environ = {'REQUEST_METHOD': request.method}
+    if 'if-none-match' in request.headers:
+        environ['HTTP_IF_NONE_MATCH'] = request.headers['if-none-match']
+    if 'if-modified-since' in request.headers:
+        environ['HTTP_IF_MODIFIED_SINCE'] = request.headers['if-modified-since']
+    return not is_resource_modified(environ, etag=etag, last_modified=last_modified)
+
+def validator_headers(etag, last_modified):
+    headers = {'ETag': '"%s"' % etag}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        raise APIException("Expected a JSON body", status_code=400)
+
+def create_access_token(identity):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    claims = {
+        "fresh": False,
+        "iat": now,
+        "jti": str(uuid.uuid4()),
+        "type": "access",
+        "sub": identity,
+        "nbf": now,
+        "exp": now + JWT_ACCESS_TOKEN_EXPIRES
+    }
+    return pyjwt.encode(claims, JWT_SECRET_KEY, algorithm='HS256')
+
+def decode_claims(token):
+    return pyjwt.decode(token, JWT_SECRET_KEY, algorithms=['HS256'])
+
+rate_limiter.decode = decode_claims
+
+def jwt_identity(request):
+    header = request.headers.get('authorization')
+    if not header:
+        raise APIException("Missing Authorization Header", status_code=401)
+    scheme, _, token = header.partition(' ')
+    if scheme != 'Bearer' or not token:
+        raise APIException("Missing 'Bearer' type in 'Authorization' header", status_code=401)
+    try:
+        claims = decode_claims(token)
+    except pyjwt.ExpiredSignatureError:
+        raise APIException("Token has expired", status_code=401)
+    except pyjwt.InvalidTokenError as e:
+        raise APIException(str(e), status_code=422)
+    if claims.get('type') != 'access':
+        raise APIException("Only non-refresh tokens are allowed", status_code=422)
+    return claims['sub']
+
+# collections and items
+
+async def list_collection(request, model):
+    args = request.query_params
+    query = CollectionQuery.parse(model, args)
+    fmt = stream_format(args.get('stream'), 'application/x-ndjson' in request.headers.get('accept', ''))
+    async with engine.connect() as conn:
+        version = (await conn.execute(version_statement(model))).one()
+        etag, last_modified = version_validators(model, tuple(version), request.url.query)
+        headers = validator_headers(etag, last_modified)
+        if not_modified(request, etag, last_modified):
+            return Response(status_code=304, headers=headers)
+        if fmt is not None:
+            return stream_collection(query, args, fmt, headers)
+
+        limit = page_limit(args)
+        statement = query.statement(cursor=query.start_after(args))
+        rows = (await conn.execute(statement, dict(query.params, limit=limit + 1))).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    encode = serializer_for(model).encoder(query.fields)
+    if has_more:
+        name, cursor = query.next_cursor(rows[-1])
+        next_url = request.url.remove_query_params(['after', 'cursor']).include_query_params(limit=limit, **{name: cursor})
+        headers['Link'] = '<%s>; rel="next"' % next_url
+        headers['X-Next-Cursor'] = str(cursor)
+    return Response(dumps([encode(row) for row in rows]), media_type='application/json', headers=headers)
+
+def stream_collection(query, args, fmt, headers):
+    encode = serializer_for(query.model).encoder(query.fields)
+    statement = query.statement(cursor=query.start_after(args), paged=False)
+
+    async def generate():
+        async with engine.connect() as conn:
+            result = await conn.stream(statement, query.params)
+            if fmt == 'json':
+                yield b'['
+            separator = b''
+            async for batch in result.partitions(STREAM_BATCH_SIZE):
+                if fmt == 'ndjson':
+                    yield b''.join(dumps(encode(row)) for row in batch)
+                else:
+                    yield separator + dumps([encode(row) for row in batch])[1:-2]
+                    separator = b','
+            if fmt == 'json':
+                yield b']\n'
+
+    media_type = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    return StreamingResponse(generate(), media_type=media_type, headers=headers)
+
+async def revalidate_entities():
+    """Async counterpart of EntityCache.revalidate(): drops the entries written since the last check."""
+    if not entity_cache.due():
+        return
+    entity_cache.checked_at = time.monotonic()  # the other requests don't check meanwhile
+    entity_cache.revalidations += 1
+    async with engine.connect() as conn:
+        if entity_cache.position is None:
+            entity_cache.start((await conn.execute(LATEST)).scalar() or 0)
+            return
+        while True:
+            rows = (await conn.execute(CHANGES, {"since": entity_cache.position, "limit": REVALIDATE_BATCH + 1})).all()
+            try:
+                found = batch(rows, entity_cache.position, REVALIDATE_BATCH, CACHED_TABLES, change_feed.gap_seconds)
+            except APIException:
+                # the changes since the last check were pruned
+                entity_cache.start((await conn.execute(LATEST)).scalar() or 0)
+                return
+            entity_cache.drop(found)
+            if not found.more:
+                return
+
+async def load_entity(model, id):
+    await revalidate_entities()
+    entity = entity_cache.get(model, id)
+    if entity is None:
+        serializer = serializer_for(model)
+        async with engine.connect() as conn:
+            row = (await conn.execute(serializer.select().where(model.id == id))).first()
+        if row is None:
+            raise APIException("%s %s not found" % (model.__name__, id), status_code=404)
+        column = timestamp_column(model)
+        last_modified = as_utc(row[serializer.names.index(column.key)]) if column is not None else None
+        entity = make_entity(dumps(serializer.encoder()(row)), last_modified)
+        entity_cache.set(model, id, entity)
+    return entity
+
+async def get_item(request, model):
+    entity = await load_entity(model, request.path_params['id'])
+    headers = validator_headers(entity.etag, entity.last_modified)
+    if not_modified(request, entity.etag, entity.last_modified):
+        return Response(status_code=304, headers=headers)
+    return Response(entity.body, media_type='application/json', headers=headers)
+
+async def create_item(request, model):
+    row, errors = validate(model, await read_json(request))
+    if errors:
+        raise APIException("This is a wrong request", status_code=400, payload={"errors": errors})
+    async with engine.begin() as conn:
+        result = await conn.execute(model.__table__.insert(), row)
+        id = result.inserted_primary_key[0]
+    entity_cache.invalidate(model, id)
+    entity = await load_entity(model, id)
+    return Response(entity.body, media_type='application/json', headers=validator_headers(entity.etag, entity.last_modified))
+
+def collection(model):
+    async def endpoint(request):
+        if request.method == 'POST':
+            return await create_item(request, model)
+        return await list_collection(request, model)
+    return endpoint
+
+def item(model):
+    async def endpoint(request):
+        return await get_item(request, model)
+    return endpoint
+
+# users, token and favorites
+
+async def users(request):
+    if request.method == 'GET':
+        return await list_collection(request, User)
+    data = await read_json(request)
+    row, errors = validate(User, data)
+    if errors:
+        raise APIException("This is a wrong request", status_code=400, payload={"errors": errors})
+    row['password'] = await hasher.hash_async(row['password'])
+    try:
+        async with engine.begin() as conn:
+            result = await conn.execute(User.__table__.insert(), row)
+    except IntegrityError:
+        raise APIException("A user with this email already exists", status_code=400)
+    entity = await load_entity(User, result.inserted_primary_key[0])
+    return Response(entity.body, media_type='application/json')
+
+async def token(request):
+    data = await read_json(request)
+    email, password = data.get('email'), data.get('password')
+    check_credentials(email, password)
+    async with engine.connect() as conn:
+        user = (await conn.execute(select(User.id, User.password).where(User.email == email))).first()
+    # an unknown email is checked against a dummy hash, as slow as a wrong password
+    valid, new_hash = await hasher.verify_async(user.password if user is not None else None, password)
+    if not valid:
+        return JSONResponse({"msg": "Bad email or password"}, status_code=401)
+    if new_hash is not None:
+        async with engine.begin() as conn:
+            await conn.execute(update(User).where(User.id == user.id).values(password=new_hash))
+    return JSONResponse({"token": create_access_token(user.id), "user_id": user.id})
+
+async def count_favorites(conn, resource, ids, delta):
+    """Async counterpart of favorites.count_favorites()."""
+    if not ids:
+        return
+    table = FavoriteCount.__table__
+    counted = (table.c.entity_type == resource) & table.c.entity_id.in_(ids)
+    statement = count_upsert(engine.dialect.name)
+    if delta < 0:
+        await conn.execute(table.update().where(counted).values(favorites=table.c.favorites + delta))
+    elif statement is not None:
+        await conn.execute(statement, [{"entity_type": resource, "entity_id": id, "favorites": delta} for id in ids])
+    else:
+        existing = set((await conn.execute(select(table.c.entity_id).where(counted))).scalars())
+        if existing:
+            await conn.execute(table.update().where(counted).values(favorites=table.c.favorites + delta))
+        missing = [{"entity_type": resource, "entity_id": id, "favorites": delta} for id in ids if id not in existing]
+        if missing:
+            await conn.execute(table.insert(), missing)
+
+async def add_fav(request):
+    user_id = jwt_identity(request)
+    character_id = request.path_params['character_id']
+    await load_entity(Character, character_id)  # 404 when the character does not exist
+    try:
+        async with engine.begin() as conn:
+            result = await conn.execute(FavoriteCharacter.__table__.insert(), {"user_id": user_id, "character_id": character_id})
+            await count_favorites(conn, 'people', [character_id], 1)
+    except IntegrityError:
+        raise APIException("This favorite character already exists for this user", status_code=400)
+    return json_response({"id": result.inserted_primary_key[0], "user_id": user_id, "character_id": character_id})
+
+async def check_user(conn, user_id):
+    if (await conn.execute(select(User.id).where(User.id == user_id))).first() is None:
+        raise APIException("User %s not found" % user_id, status_code=404)
+
+async def favorites_of(user_id):
+    """Same payload as favorites.user_favorites(), 4 queries."""
+    payload = {"user_id": user_id}
+    async with engine.connect() as conn:
+        await check_user(conn, user_id)
+        for resource, (favorite, entity, key) in FAVORITE_TYPES.items():
+            foreign_key = getattr(favorite, key + '_id')
+            statement = (
+                select(favorite.id, favorite.user_id, foreign_key, entity.id.label('entity_id'), entity.name)
+                .outerjoin(entity, entity.id == foreign_key)
+                .where(favorite.user_id == user_id)
+                .order_by(favorite.id)
+            )
+            payload[resource] = [{
+                "id": row.id,
+                "user_id": row.user_id,
+                key + "_id": row[2],
+                key: None if row.entity_id is None else {"id": row.entity_id, "name": row.name}
+            } for row in await conn.execute(statement)]
+    return payload
+
+async def insert_favorites(user_id, wanted):
+    """Same as favorites.add_favorites(): unknown entities fail the request before anything is written."""
+    added = 0
+    async with engine.begin() as conn:
+        await check_user(conn, user_id)
+        missing = {}
+        for resource, ids in wanted.items():
+            entity = FAVORITE_TYPES[resource][1]
+            found = set((await conn.execute(select(entity.id).where(entity.id.in_(ids)))).scalars())
+            if found != ids:
+                missing[resource] = sorted(ids - found)
+        if missing:
+            raise APIException("Some favorites do not exist", status_code=404, payload={"missing": missing})
+        for resource, ids in wanted.items():
+            favorite, entity, key = FAVORITE_TYPES[resource]
+            foreign_key = getattr(favorite, key + '_id')
+            existing = set((await conn.execute(
+                select(foreign_key).where(favorite.user_id == user_id, foreign_key.in_(ids))
+            )).scalars())
+            new = sorted(ids - existing)
+            if new:
+                await conn.execute(favorite.__table__.insert(), [{"user_id": user_id, key + "_id": id} for id in new])
+                await count_favorites(conn, resource, new, 1)
+                added += len(new)
+    return added
+
+async def delete_favorites(user_id, wanted):
+    """Same as favorites.remove_favorites(): only the rows this transaction deleted are uncounted."""
+    removed = 0
+    async with engine.begin() as conn:
+        await check_user(conn, user_id)
+        for resource, ids in wanted.items():
+            favorite, entity, key = FAVORITE_TYPES[resource]
+            foreign_key = getattr(favorite, key + '_id')
+            existing = set((await conn.execute(
+                select(foreign_key).where(favorite.user_id == user_id, foreign_key.in_(ids))
+            )).scalars())
+            if not existing:
+                continue
+            deleted = []
+            for statement, id in delete_statements(engine.dialect.name, resource, user_id, existing):
+                deleted.extend(deleted_ids(await conn.execute(statement), id))
+            await count_favorites(conn, resource, sorted(deleted), -1)
+            removed += len(deleted)
+    return removed
+
+async def user_favorites(request):
+    return json_response(await favorites_of(request.path_params['id']))
+
+async def my_favorites(request):
+    """GET, POST (add) and DELETE (remove) [{"type": "people", "id": 1}, ...], as the WSGI app."""
+    user_id = jwt_identity(request)
+    if request.method == 'GET':
+        return json_response(await favorites_of(user_id))
+    wanted = parse_favorites(await read_json(request))
+    if request.method == 'DELETE':
+        removed = await delete_favorites(user_id, wanted)
+        return json_response(dict(await favorites_of(user_id), removed=removed))
+    try:
+        added = await insert_favorites(user_id, wanted)
+    except IntegrityError:
+        # a concurrent request added some of them first, the retry skips those
+        added = await insert_favorites(user_id, wanted)
+    return json_response(dict(await favorites_of(user_id), added=added))
+
+async def health_db(request):
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(text('SELECT 1'))
+    except Exception:
+        # the driver's message can name the host, the user, parts of the DSN: logged, not returned
+        log.error("database health check failed", exc_info=True)
+        return json_response({"status": "error", "error": "database unreachable"}, status_code=503)
+    return json_response({"status": "ok", "pool": pool_status(engine.sync_engine)})
+
+# change feed, see changes.py: each waiting consumer reads every CHANGES_POLL_SECONDS
+
+async def read_changes(since, limit, tables):
+    async with engine.connect() as conn:
+        rows = (await conn.execute(CHANGES, {"since": since, "limit": limit + 1})).all()
+    return batch(rows, since, limit, tables, change_feed.gap_seconds)
+
+def stream_changes(first, since, limit, tables):
+
+    async def generate():
+        yield b'retry: 1000\n\n'
+        current, position = first, since
+        deadline = time.monotonic() + change_feed.stream_seconds
+        heartbeat_at = time.monotonic() + change_feed.heartbeat_seconds
+        while True:
+            if current.next != position:
+                yield event_stream_chunk(current)
+                heartbeat_at = time.monotonic() + change_feed.heartbeat_seconds
+                position = current.next
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            if not current.more:
+                if now >= heartbeat_at:
+                    yield b': keepalive\n\n'
+                    heartbeat_at = now + change_feed.heartbeat_seconds
+                await asyncio.sleep(min(change_feed.poll_seconds, deadline - now))
+            current = await read_changes(position, limit, tables)
+
+    headers = {'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'}
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=headers)
+
+async def changes(request):
+    args = request.query_params
+    since = request.headers.get('last-event-id') or args.get('since')
+    if since == 'now':
+        async with engine.connect() as conn:
+            since = (await conn.execute(LATEST)).scalar() or 0
+    else:
+        since = int_arg({'since': since}, 'since', 0)
+    limit = page_limit(args)
+    tables = parse_types(args.get('type'))
+    current = await read_changes(since, limit, tables)
+    if 'text/event-stream' in request.headers.get('accept', ''):
+        return stream_changes(current, since, limit, tables)
+    deadline = time.monotonic() + min(int_arg(args, 'wait', 0), change_feed.max_wait)
+    while not (current.changes or current.more) and time.monotonic() < deadline:
+        await asyncio.sleep(min(change_feed.poll_seconds, deadline - time.monotonic()))
+        current = await read_changes(current.next, limit, tables)
+    return json_response({"changes": current.changes, "next": current.next, "more": current.more},
+                         headers={'Cache-Control': 'no-store'})
+
+async def handle_api_exception(request, error):
+    return json_response(error.to_dict(), status_code=error.status_code)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # not at import: importing the module needs no database (tools, tests)
+    global engine
+    engine = connect()
+    yield
+    await engine.dispose()
+
+routes = [
+    Route('/user', users, methods=['GET', 'POST']),
+    Route('/user/{id:int}', item(User)),
+    Route('/user/{id:int}/favorites', user_favorites),
+    Route('/me/favorites', my_favorites, methods=['GET', 'POST', 'DELETE']),
+    Route('/token', token, methods=['POST']),
+    Route('/people', collection(Character), methods=['GET', 'POST']),
+    Route('/people/{id:int}', item(Character)),
+    Route('/planet', collection(Planet), methods=['GET', 'POST']),
+    Route('/planet/{id:int}', item(Planet)),
+    Route('/vehicle', collection(Vehicle), methods=['GET', 'POST']),
+    Route('/vehicle/{id:int}', item(Vehicle)),
+    Route('/user/favorite/people/{character_id:int}', add_fav, methods=['POST']),
+    Route('/changes', changes),
+    Route('/health/db', health_db)
+]
+
+# (path, method) -> endpoint name in main.py, the rate limits are configured by those names
+ENDPOINTS = {
+    ('/user', 'GET'): 'get_users',
+    ('/user', 'POST'): 'create_user',
+    ('/user/{id:int}', 'GET'): 'get_specific_user',
+    ('/user/{id:int}/favorites', 'GET'): 'get_user_favorites',
+    ('/me/favorites', 'GET'): 'get_my_favorites',
+    ('/me/favorites', 'POST'): 'add_my_favorites',
+    ('/me/favorites', 'DELETE'): 'remove_my_favorites',
+    ('/token', 'POST'): 'create_token',
+    ('/people', 'GET'): 'get_all_people',
+    ('/people', 'POST'): 'create_character',
+    ('/people/{id:int}', 'GET'): 'get_a_person',
+    ('/planet', 'GET'): 'get_all_planets',
+    ('/planet', 'POST'): 'create_planet',
+    ('/planet/{id:int}', 'GET'): 'get_a_planet',
+    ('/vehicle', 'GET'): 'get_all_vehicles',
+    ('/vehicle', 'POST'): 'create_vehicle',
+    ('/vehicle/{id:int}', 'GET'): 'get_a_vehicle',
+    ('/user/favorite/people/{character_id:int}', 'POST'): 'add_fav',
+    ('/changes', 'GET'): 'changes',
+    ('/health/db', 'GET'): 'health_db'
+}
+
+def endpoint_of(scope):
+    method = 'GET' if scope['method'] == 'HEAD' else scope['method']
+    for route in routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return ENDPOINTS.get((route.path, method))
+    return None
+
+def client_environ(scope):
+    """The WSGI environ keys RateLimiter.client_key() reads."""
+    headers = {name: value for name, value in scope['headers'] if name in (b'authorization', b'x-forwarded-for')}
+    environ = {'REMOTE_ADDR': scope['client'][0] if scope.get('client') else None}
+    if b'authorization' in headers:
+        environ['HTTP_AUTHORIZATION'] = headers[b'authorization'].decode('latin-1')
+    if b'x-forwarded-for' in headers:
+        environ['HTTP_X_FORWARDED_FOR'] = headers[b'x-forwarded-for'].decode('latin-1')
+    return environ
+
+class RateLimitMiddleware:
+    """RateLimiter.check() and add_headers() of the WSGI app, for the ASGI routes."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not rate_limiter.enabled:
+            return await self.app(scope, receive, send)
+        endpoint, environ = endpoint_of(scope), client_environ(scope)
+        if isinstance(rate_limiter.store, LocalBuckets):
+            result = rate_limiter.consume(endpoint, environ)
+        else:
+            result = await run_in_threadpool(rate_limiter.consume, endpoint, environ)  # the redis client blocks
+        if result is None:
+            return await self.app(scope, receive, send)
+        limit, allowed, tokens = result
+        if not allowed:
+            response = json_response(rate_limiter.too_many(limit, tokens), status_code=429,
+                                     headers=dict(rate_limiter.headers(limit, tokens, 429)))
+            return await response(scope, receive, send)
+        added = [(name.lower().encode(), value.encode()) for name, value in rate_limiter.headers(limit, tokens, 200)]
+
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                message = dict(message, headers=list(message.get('headers', [])) + added)
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+                Middleware(RateLimitMiddleware)],
+    exception_handlers={APIException: handle_api_exception},
+    lifespan=lifespan
+)
@@ -0,0 +1,123 @@
+"""
+Password hashing of the users created and of the logins (POST /token).
+
+Hashing is CPU bound on purpose, so it runs in a small bounded thread pool
+(hashlib releases the GIL while hashing): a burst of logins can only use
+PASSWORD_HASH_WORKERS cores per process and the other requests keep being served.
+That bound only holds where a process serves requests concurrently: threaded
+gunicorn workers (--threads) and the ASGI app, whose event loop never waits
+for a hash. A sync gunicorn worker (the Procfile's) serves one request at a
+time, there the number of workers (WEB_CONCURRENCY) is what bounds the hashes.
+"""
+import os
+import hmac
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+from utils import APIException
+
+DEFAULT_METHOD = 'pbkdf2:sha256:260000'
+HASH_PREFIXES = ('pbkdf2:', 'scrypt')
+
+class PasswordHasher:
+
+    def __init__(self, method=DEFAULT_METHOD, workers=2, max_pending=64, timeout=10):
+        self.configure(method, workers, max_pending, timeout)
+
+    def configure(self, method=DEFAULT_METHOD, workers=2, max_pending=64, timeout=10):
+        previous = getattr(self, '_pool', None)
+        self.method = method
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        # past this many queued hashes new logins are rejected instead of piling up
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._dummy_hash = None
+        if previous is not None:
+            # its queued hashes still finish, then its threads exit
+            previous.shutdown(wait=False)
+
+    def _submit(self, fn, *args):
+        if not self._pending.acquire(blocking=False):
+            raise APIException("Too many login attempts in progress, try again later", status_code=503)
+        future = self._pool.submit(fn, *args)
+        future.add_done_callback(lambda f: self._pending.release())
+        return future
+
+    def _run(self, fn, *args):
+        return self._submit(fn, *args).result(timeout=self.timeout)
+
+    async def _run_async(self, fn, *args):
+        return await asyncio.wait_for(asyncio.wrap_future(self._submit(fn, *args)), self.timeout)
+
+    @staticmethod
+    def is_hashed(stored):
+        return stored.startswith(HASH_PREFIXES) and stored.count('$') == 2
+
+    def needs_rehash(self, stored):
+        return not self.is_hashed(stored) or stored.split('$', 1)[0] != self.method
+
+    def _check_unknown(self, password):
+        """A check as slow as the one of a wrong password, for a login with an unknown email."""
+        if self._dummy_hash is None:
+            self._dummy_hash = generate_password_hash(os.urandom(16).hex(), self.method, 16)
+        check_password_hash(self._dummy_hash, password)
+        return False
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, 16)
+
+    def verify(self, stored, password):
+        """
+        Returns (valid, new_hash). new_hash is set when the stored value is a
+        legacy plain text password or was hashed with other settings. `stored`
+        is None for an unknown user: the password is checked against a dummy
+        hash, so the time of the answer doesn't tell which emails exist.
+        """
+        if stored is None:
+            return self._run(self._check_unknown, password), None
+        if self.is_hashed(stored):
+            valid = self._run(check_password_hash, stored, password)
+        else:
+            valid = hmac.compare_digest(stored.encode(), password.encode())
+        if valid and self.needs_rehash(stored):
+            return True, self.hash(password)
+        return valid, None
+
+    # same as hash() / verify() for the asyncio app (asgi.py), the event loop is never blocked
+
+    async def hash_async(self, password):
+        return await self._run_async(generate_password_hash, password, self.method, 16)
+
+    async def verify_async(self, stored, password):
+        if stored is None:
+            return await self._run_async(self._check_unknown, password), None
+        if self.is_hashed(stored):
+            valid = await self._run_async(check_password_hash, stored, password)
+        else:
+            valid = hmac.compare_digest(stored.encode(), password.encode())
+        if valid and self.needs_rehash(stored):
+            return True, await self.hash_async(password)
+        return valid, None
+
+hasher = PasswordHasher()
+
+def check_credentials(email, password):
+    """400 unless the login's email and password are strings."""
+    if not isinstance(email, str) or not isinstance(password, str):
+        raise APIException("'email' and 'password' must be strings", status_code=400)
+
+def configure_hasher(config):
+    config.setdefault('PASSWORD_HASH_METHOD', os.environ.get('PASSWORD_HASH_METHOD', DEFAULT_METHOD))
+    config.setdefault('PASSWORD_HASH_WORKERS', int(os.environ.get('PASSWORD_HASH_WORKERS', 2)))
+    config.setdefault('PASSWORD_HASH_MAX_PENDING', int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 64)))
+    hasher.configure(
+        method=config['PASSWORD_HASH_METHOD'],
+        workers=config['PASSWORD_HASH_WORKERS'],
+        max_pending=config['PASSWORD_HASH_MAX_PENDING']
+    )
+    return hasher
+
+def setup_auth(app):
+    configure_hasher(app.config)
+    return hasher
@@ -0,0 +1,181 @@
+"""
+Bulk import of catalog entities (characters, planets, vehicles).
+
+Rows are validated one by one against the model columns, then inserted in
+batches with a single executemany per batch and one transaction per batch.
+Used by the POST /<resource>/bulk endpoints and the `flask import-swapi` command,
+or by the bulk_import job (see jobs.py) when the request asked for an async import.
+"""
+import json
+import click
+from flask import current_app, request
+from flask.cli import with_appcontext
+from sqlalchemy import Integer, String, DateTime
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, Character, Planet, Vehicle
+from utils import APIException
+from jobs import task
+
+RESOURCES = {
+    'people': Character,
+    'planet': Planet,
+    'vehicle': Vehicle
+}
+
+# keys used by the SWAPI dumps
+ALIASES = {
+    'characters': 'people',
+    'planets': 'planet',
+    'vehicles': 'vehicle'
+}
+
+DEFAULT_BATCH_SIZE = 500
+
+def importable_columns(model):
+    # primary keys and timestamps are filled by the database / column defaults
+    return [c for c in model.__table__.columns if not c.primary_key and not isinstance(c.type, DateTime)]
+
+def validate(model, item):
+    """Returns (row, errors) for one incoming object. Unknown keys are ignored."""
+    if not isinstance(item, dict):
+        return None, {"_": "must be an object"}
+    row, errors = {}, {}
+    for column in importable_columns(model):
+        value = item.get(column.name)
+        if value is None or value == '':
+            if not column.nullable and column.default is None:
+                errors[column.name] = "is required"
+            continue
+        if isinstance(column.type, Integer):
+            if isinstance(value, str):
+                value = value.replace(',', '')
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                errors[column.name] = "must be an integer"
+                continue
+        elif isinstance(column.type, String):
+            value = str(value)
+            if column.type.length is not None and len(value) > column.type.length:
+                errors[column.name] = "must be at most %d characters" % column.type.length
+                continue
+        row[column.name] = value
+    return row, errors
+
+def _insert_batch(model, batch, report):
+    if not batch:
+        return
+    table = model.__table__
+    try:
+        db.session.execute(table.insert(), [row for _, row in batch])
+        db.session.commit()
+        report['inserted'] += len(batch)
+        return
+    except SQLAlchemyError:
+        db.session.rollback()
+    # the batch failed as a whole, retry row by row to find which ones are bad
+    for index, row in batch:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert(), row)
+            report['inserted'] += 1
+        except SQLAlchemyError as e:
+            report['errors'].append({"index": index, "errors": {"_": str(e.orig if hasattr(e, 'orig') else e)}})
+    db.session.commit()
+
+def import_rows(model, items, batch_size=None):
+    """
+    Validates and inserts an iterable of dicts, returns a report like
+    {"inserted": 10, "failed": 1, "errors": [{"index": 3, "errors": {"name": "is required"}}]}
+    """
+    batch_size = batch_size or current_app.config.get('BULK_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    report = {"inserted": 0, "errors": []}
+    batch = []
+    for index, item in enumerate(items):
+        if isinstance(item, Exception):
+            report['errors'].append({"index": index, "errors": {"_": str(item)}})
+            continue
+        row, errors = validate(model, item)
+        if errors:
+            report['errors'].append({"index": index, "errors": errors})
+            continue
+        batch.append((index, row))
+        if len(batch) >= batch_size:
+            _insert_batch(model, batch, report)
+            batch = []
+    _insert_batch(model, batch, report)
+    report['failed'] = len(report['errors'])
+    return report
+
+def iter_ndjson(lines):
+    """Parses NDJSON lazily, a line that is not valid JSON is yielded as the exception."""
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield e
+
+def request_items():
+    """Items of a bulk request: a JSON array, or NDJSON read line by line from the body."""
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        return iter_ndjson(request.stream)
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        raise APIException("Expected a JSON array or an application/x-ndjson body", status_code=400)
+    return items
+
+def bulk_payload(resource):
+    """Payload of a bulk_import job: the items of the request, lines that are not JSON as {"_invalid": error}."""
+    items = [{"_invalid": str(item)} if isinstance(item, Exception) else item for item in request_items()]
+    return {"resource": resource, "items": items, "batch_size": request_batch_size()}
+
+# a retry would insert the rows of the batches already committed again
+@task('bulk_import', max_attempts=1)
+def bulk_import(payload):
+    # the caches of the API processes see the new rows when they revalidate the table version
+    items = (ValueError(item['_invalid']) if isinstance(item, dict) and '_invalid' in item else item for item in payload['items'])
+    return import_rows(RESOURCES[payload['resource']], items, payload.get('batch_size'))
+
+def request_batch_size():
+    batch_size = request.args.get('batch_size', type=int)
+    if batch_size is not None and batch_size < 1:
+        raise APIException("'batch_size' must be greater than 0", status_code=400)
+    return batch_size
+
+def resource_model(name):
+    name = ALIASES.get(name, name)
+    if name not in RESOURCES:
+        raise click.BadParameter("unknown resource '%s', use one of: %s" % (name, ", ".join(RESOURCES)))
+    return RESOURCES[name]
+
+@click.command('import-swapi')
+@click.argument('file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--type', 'resource', default=None, help="people, planet or vehicle when the file is a plain list / NDJSON")
+@click.option('--batch-size', default=None, type=int, help="rows per insert batch")
+@with_appcontext
+def import_swapi_command(file, resource, batch_size):
+    """Imports a SWAPI dump: {"people": [...], "planets": [...], "vehicles": [...]}, a JSON list or NDJSON."""
+    with open(file) as f:
+        if file.endswith('.ndjson') or file.endswith('.jsonl'):
+            if resource is None:
+                raise click.UsageError("--type is required for NDJSON files")
+            sources = {resource: iter_ndjson(f)}
+        else:
+            data = json.load(f)
+            if isinstance(data, list):
+                if resource is None:
+                    raise click.UsageError("--type is required when the file is a list")
+                sources = {resource: data}
+            else:
+                sources = data
+        for name, items in sources.items():
+            model = resource_model(name)
+            report = import_rows(model, items, batch_size)
+            click.echo("%s: %d inserted, %d failed" % (name, report['inserted'], report['failed']))
+            for error in report['errors'][:20]:
+                click.echo("  row %d: %s" % (error['index'], error['errors']))
@@ -0,0 +1,296 @@
+"""
+Read-through cache for the single item endpoints (/people/<id>, /planet/<id>, /vehicle/<id>).
+
+Entries are the serialized JSON bodies (plus their ETag and Last-Modified validators)
+keyed by table name and id. Every worker keeps
+a small in-process LRU; an optional shared backend (redis) sits behind it so a miss in
+one worker can be filled by another without touching the database.
+
+Writes through this worker invalidate their entry right away. Every other write
+(other workers, the ASGI app, bulk import jobs, raw SQL) is found in the change
+feed (changes.py): a worker reads the changes made since its last check at most
+every ENTITY_CACHE_REVALIDATE_SECONDS and drops the entries they name, so an
+entry is never served more than that long after a write.
+
+    ENTITY_CACHE_SIZE                 entries kept per process (1024)
+    ENTITY_CACHE_TTL                  seconds an entry is kept (60)
+    ENTITY_CACHE_REVALIDATE_SECONDS   see above, 0 checks on every read (2)
+    CACHE_REDIS_URL                   the shared backend, memory:// for an in-process stand-in
+"""
+import os
+import time
+import threading
+import hashlib
+import datetime
+from collections import OrderedDict, namedtuple
+from models import db
+from utils import APIException
+from conditional import last_modified_of
+from serializers import serializer_for, dumps
+from snapshot import catalog
+
+CachedEntity = namedtuple('CachedEntity', ['body', 'etag', 'last_modified'])
+
+def make_entity(body, last_modified):
+    return CachedEntity(body, hashlib.sha1(body).hexdigest(), last_modified)
+
+class LRUCache:
+    """In-process LRU with a max size and a per entry time to live (in seconds)."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                self.evictions += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+class DictBackend:
+    """
+    Shared backend stand-in that keeps everything in a dict, same interface
+    as RedisBackend. Useful for local development and tests.
+    """
+
+    def __init__(self):
+        self._data = {}
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (value, time.monotonic() + ttl if ttl else None)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+class RedisBackend:
+
+    def __init__(self, url):
+        import redis  # only needed when CACHE_REDIS_URL is set
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ex=ttl or None)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+# the tables of the cached entities, changes to the others are not read
+CACHED_TABLES = {'user', 'character', 'planet', 'vehicle'}
+
+# changes read per query when revalidating
+REVALIDATE_BATCH = 1000
+
+class EntityCache:
+
+    def __init__(self, local=None, shared=None, shared_ttl=3600, revalidate_seconds=2):
+        self.local = local or LRUCache()
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self.shared_hits = 0
+        self.shared_misses = 0
+        self.revalidate_seconds = revalidate_seconds
+        self.position = None   # seq of the change feed the entries were checked against
+        self.checked_at = None
+        self.revalidations = 0
+        self._check_lock = threading.Lock()
+
+    @staticmethod
+    def key(model, id):
+        return "%s:%s" % (model.__tablename__, id)
+
+    @staticmethod
+    def pack(entity):
+        # shared backends only store bytes: "<last modified epoch>\n<body>"
+        stamp = b'' if entity.last_modified is None else b'%f' % entity.last_modified.timestamp()
+        return stamp + b'\n' + entity.body
+
+    @staticmethod
+    def unpack(value):
+        stamp, body = value.split(b'\n', 1)
+        last_modified = datetime.datetime.fromtimestamp(float(stamp), datetime.timezone.utc) if stamp else None
+        return make_entity(body, last_modified)
+
+    def get(self, model, id):
+        key = self.key(model, id)
+        entity = self.local.get(key)
+        if entity is not None or self.shared is None:
+            return entity
+        value = self.shared.get(key)
+        if value is None:
+            self.shared_misses += 1
+            return None
+        self.shared_hits += 1
+        entity = self.unpack(value)
+        self.local.set(key, entity)
+        return entity
+
+    def set(self, model, id, entity):
+        key = self.key(model, id)
+        self.local.set(key, entity)
+        if self.shared is not None:
+            self.shared.set(key, self.pack(entity), self.shared_ttl)
+
+    def invalidate(self, model, id):
+        key = self.key(model, id)
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def due(self):
+        """True when the entries have to be checked against the change feed."""
+        return self.checked_at is None or time.monotonic() - self.checked_at >= self.revalidate_seconds
+
+    def start(self, position):
+        """Starts following the change feed from `position`, the entries of before are dropped."""
+        self.local.clear()
+        self.position = position
+
+    def drop(self, found):
+        """Drops the entries of the changes of a changes.Batch, the next check reads after it."""
+        from changes import TABLES
+        for change in found.changes:
+            key = "%s:%s" % (TABLES[change['type']], change['id'])
+            self.local.delete(key)
+            if self.shared is not None:
+                self.shared.delete(key)
+        self.position = found.next
+
+    def revalidate(self):
+        """Drops the entries written since the last check (in an app context), see the module docstring."""
+        if not self.due() or not self._check_lock.acquire(blocking=False):
+            return  # checked recently, or by another thread right now
+        # changes imports pagination, which imports this module
+        from changes import CHANGES, LATEST, batch, change_feed
+        try:
+            self.checked_at = time.monotonic()
+            self.revalidations += 1
+            if self.position is None:
+                self.start(db.session.execute(LATEST).scalar() or 0)
+                return
+            while True:
+                rows = db.session.execute(CHANGES, {"since": self.position, "limit": REVALIDATE_BATCH + 1}).all()
+                try:
+                    found = batch(rows, self.position, REVALIDATE_BATCH, CACHED_TABLES, change_feed.gap_seconds)
+                except APIException:
+                    # the changes since the last check were pruned
+                    self.start(db.session.execute(LATEST).scalar() or 0)
+                    return
+                self.drop(found)
+                if not found.more:
+                    return
+        finally:
+            self._check_lock.release()
+
+    def refresh(self, row):
+        """Serializes the row, stores it and returns the cached entity."""
+        entity = make_entity(dumps(serializer_for(type(row)).encode_object(row)), last_modified_of(row))
+        self.set(type(row), row.id, entity)
+        return entity
+
+    def load(self, model, id):
+        """Returns the cached entity of the row, reading the database only on a miss."""
+        snapshot = catalog.table(model)
+        if snapshot is not None:
+            # as fast as the cache and never older than the snapshot
+            return make_entity(*snapshot.item(id))
+        self.revalidate()
+        entity = self.get(model, id)
+        if entity is not None:
+            return entity
+        row = model.query.get(id)
+        if row is None:
+            raise APIException("%s %s not found" % (model.__name__, id), status_code=404)
+        return self.refresh(row)
+
+    def stats(self):
+        stats = dict(self.local.stats(), revalidations=self.revalidations, position=self.position)
+        if self.shared is not None:
+            stats["shared"] = {"hits": self.shared_hits, "misses": self.shared_misses}
+        return stats
+
+entity_cache = EntityCache()
+
+def configure_cache(config):
+    config.setdefault('ENTITY_CACHE_SIZE', int(os.environ.get('ENTITY_CACHE_SIZE', 1024)))
+    config.setdefault('ENTITY_CACHE_TTL', int(os.environ.get('ENTITY_CACHE_TTL', 60)))
+    config.setdefault('ENTITY_CACHE_REVALIDATE_SECONDS', float(os.environ.get('ENTITY_CACHE_REVALIDATE_SECONDS', 2)))
+    config.setdefault('CACHE_REDIS_URL', os.environ.get('CACHE_REDIS_URL'))
+
+    entity_cache.local = LRUCache(config['ENTITY_CACHE_SIZE'], config['ENTITY_CACHE_TTL'])
+    entity_cache.revalidate_seconds = config['ENTITY_CACHE_REVALIDATE_SECONDS']
+    entity_cache.position = entity_cache.checked_at = None
+    url = config['CACHE_REDIS_URL']
+    if url == 'memory://':
+        entity_cache.shared = DictBackend()
+    elif url:
+        entity_cache.shared = RedisBackend(url)
+    else:
+        entity_cache.shared = None
+    return entity_cache
+
+def setup_cache(app):
+    configure_cache(app.config)
+    app.extensions['entity_cache'] = entity_cache
+    return entity_cache
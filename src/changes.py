@@ -0,0 +1,368 @@
+"""
+Change feed: every insert, update and delete of the tables in TRACKED is
+recorded in change_log by database triggers, in the transaction of the write
+(ORM, bulk executemany, admin, ASGI app alike). Consumers sync incrementally:
+
+    GET /changes?since=0&limit=100      {"changes": [{"seq", "type", "id", "op", "at"}...],
+                                         "next": 57, "more": false}, then ?since=57
+    GET /changes?since=57&wait=30       long poll: answers as soon as there is a change,
+                                        or with none after 30 seconds
+    GET /changes?since=now              "next" is the latest seq: read it before a full
+                                        sync, then follow the feed from there
+    GET /changes?type=people,planet     only some types (people, planet, vehicle, user,
+                                        favorite-people, favorite-planet, favorite-vehicle)
+    Accept: text/event-stream           Server-Sent Events: one event per change, id = seq,
+                                        resumed from Last-Event-ID on reconnection
+
+A change only says what changed, consumers read the entity itself. A
+consumer that fell behind the retention gets a 410 and has to sync in full.
+
+Sequence numbers are allocated when a transaction writes but become visible
+when it commits, possibly after a later one. A missing seq holds delivery back
+until it shows up or until the change after it is CHANGES_GAP_SECONDS old (the
+transaction rolled back), so no change is skipped unless a writing transaction
+lasts longer than that. SQLite serializes writers and has no such gaps.
+
+    CHANGES_POLL_SECONDS        how often waiting requests look for changes made by
+                                other processes, one query per process (0.5)
+    CHANGES_MAX_WAIT            longest ?wait=, seconds (30)
+    CHANGES_GAP_SECONDS         see above (10)
+    CHANGES_STREAM_SECONDS      an event stream is closed after this long, the client
+                                reconnects with Last-Event-ID (300)
+    CHANGES_HEARTBEAT_SECONDS   comment sent on an idle event stream (15)
+    CHANGES_RETENTION_SECONDS   `flask prune-changes` deletes older changes (7 days)
+
+A long poll or an event stream holds a WSGI worker thread while it waits, many
+consumers are better served by the ASGI app (asgi.py).
+"""
+import os
+import time
+import datetime
+import threading
+from collections import namedtuple
+import click
+from flask import request, jsonify, Response, stream_with_context
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, update, delete, func, bindparam, Integer
+from sqlalchemy.orm import Session
+from werkzeug.http import http_date
+from models import db, Change, User, Character, Planet, Vehicle, FavoriteCharacter, FavoritePlanet, FavoriteVehicle
+from pagination import int_arg, page_limit
+from serializers import dumps
+from utils import APIException
+from jobs import task
+
+TRACKED = (User, Character, Planet, Vehicle, FavoriteCharacter, FavoritePlanet, FavoriteVehicle)
+
+# table -> type in the feed, the path of the resource where there is one
+TYPES = {
+    'user': 'user',
+    'character': 'people',
+    'planet': 'planet',
+    'vehicle': 'vehicle',
+    'favorite-character': 'favorite-people',
+    'favorite-planet': 'favorite-planet',
+    'favorite-vehicle': 'favorite-vehicle'
+}
+TABLES = {name: table for table, name in TYPES.items()}
+
+# marks where `flask prune-changes` cut the log, a consumer before it missed changes
+PRUNED = 'pruned'
+
+# triggers
+
+POSTGRES_FUNCTION = """
+CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO %(log)s (entity_type, entity_id, op, created) VALUES (TG_TABLE_NAME, OLD.id, 'delete', now() AT TIME ZONE 'utc');
+        RETURN OLD;
+    END IF;
+    INSERT INTO %(log)s (entity_type, entity_id, op, created) VALUES (TG_TABLE_NAME, NEW.id, lower(TG_OP), now() AT TIME ZONE 'utc');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+
+# current UTC time, the DateTime columns hold naive UTC
+NOW = {'sqlite': 'CURRENT_TIMESTAMP', 'mysql': 'UTC_TIMESTAMP()'}
+
+def trigger_statements(dialect_name, quote):
+    """(drop, create) statements of the triggers that fill change_log, `quote` quotes an identifier."""
+    log = quote(Change.__tablename__)
+    drop, create = [], []
+    if dialect_name == 'postgresql':
+        create.append(POSTGRES_FUNCTION % {'log': log})
+    elif dialect_name not in NOW:
+        return drop, create
+    for model in TRACKED:
+        table = model.__tablename__
+        name = 'change_log_' + table.replace('-', '_')
+        if dialect_name == 'postgresql':
+            drop.append('DROP TRIGGER IF EXISTS %s ON %s' % (name, quote(table)))
+            create.append('CREATE TRIGGER %s AFTER INSERT OR UPDATE OR DELETE ON %s FOR EACH ROW EXECUTE PROCEDURE record_change()'
+                          % (name, quote(table)))
+            continue
+        for op in ('insert', 'update', 'delete'):
+            insert = "INSERT INTO %s (entity_type, entity_id, op, created) VALUES ('%s', %s.id, '%s', %s)" % (
+                log, table, 'OLD' if op == 'delete' else 'NEW', op, NOW[dialect_name])
+            drop.append('DROP TRIGGER IF EXISTS %s_%s' % (name, op))
+            if dialect_name == 'sqlite':
+                create.append('CREATE TRIGGER %s_%s AFTER %s ON %s BEGIN %s; END' % (name, op, op.upper(), quote(table), insert))
+            else:
+                create.append('CREATE TRIGGER %s_%s AFTER %s ON %s FOR EACH ROW %s' % (name, op, op.upper(), quote(table), insert))
+    return drop, create
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def create_triggers(metadata, connection, **kw):
+    # db.create_all(), the migrations create them for migrated databases
+    tables = kw.get('tables') or ()
+    if Change.__table__ not in tables and not any(model.__table__ in tables for model in TRACKED):
+        return  # the tables of another bind (a read replica) or nothing created
+    drop, create = trigger_statements(connection.dialect.name, connection.dialect.identifier_preparer.quote)
+    for statement in drop + create:
+        connection.exec_driver_sql(statement)
+
+# reading the feed
+
+CHANGES = (
+    select(Change.seq, Change.entity_type, Change.entity_id, Change.op, Change.created)
+    .where(Change.seq > bindparam('since'))
+    .order_by(Change.seq)
+    .limit(bindparam('limit', type_=Integer))
+)
+
+LATEST = select(func.max(Change.seq))
+
+# changes: the encoded changes to send, next: the ?since= of the next request,
+# more: more changes can be read right away, seen: the last seq read, held: changes held back by a gap
+Batch = namedtuple('Batch', 'changes next more seen held')
+
+def encode(row):
+    return {"seq": row.seq, "type": TYPES.get(row.entity_type, row.entity_type), "id": row.entity_id,
+            "op": row.op, "at": http_date(row.created)}
+
+def batch(rows, since, limit, tables=None, gap_seconds=10):
+    """The Batch of `rows` (up to limit + 1 rows after `since`, in seq order)."""
+    if rows and rows[0].op == PRUNED:
+        raise APIException("Changes after %d were pruned, sync in full and follow the feed from ?since=now" % since,
+                           status_code=410)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    old = datetime.datetime.utcnow() - datetime.timedelta(seconds=gap_seconds)
+    expected, settled = since + 1, 0
+    for row in rows:
+        # a missing seq is a transaction not committed yet, or rolled back long ago
+        if row.seq != expected and row.created > old:
+            break
+        settled += 1
+        expected = row.seq + 1
+    held = settled < len(rows)
+    changes = [encode(row) for row in rows[:settled] if tables is None or row.entity_type in tables]
+    return Batch(changes, rows[settled - 1].seq if settled else since, more and not held,
+                 rows[-1].seq if rows else since, held)
+
+def event_stream_chunk(batch):
+    """Server-Sent Events of a batch, one per change (its id is its seq)."""
+    chunk = b''.join(b'id: %d\nevent: change\ndata: %s\n\n' % (change['seq'], dumps(change)[:-1]) for change in batch.changes)
+    if batch.changes and batch.changes[-1]['seq'] == batch.next:
+        return chunk
+    # changes filtered out by ?type=: an event without data moves Last-Event-ID forward
+    return chunk + b'id: %d\n\n' % batch.next
+
+def parse_types(value):
+    """?type=people,planet as a set of tables, None for every type."""
+    if not value:
+        return None
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in TABLES]
+    if unknown:
+        raise APIException("Unknown type(s): %s, use: %s" % (", ".join(unknown), ", ".join(TABLES)), status_code=400)
+    return {TABLES[name] for name in names}
+
+class ChangeFeed:
+
+    def __init__(self):
+        self.configure()
+        self.condition = threading.Condition()
+        self.latest = 0         # highest seq seen by this process
+        self.checked_at = 0     # when `latest` was last read from the database
+        self.checking = False
+        self.generation = 0     # commits made by this process
+        self.long_polls = 0
+        self.streams = 0
+        self.checks = 0
+
+    def configure(self, poll_seconds=0.5, max_wait=30, gap_seconds=10, stream_seconds=300, heartbeat_seconds=15,
+                  retention=7 * 86400):
+        self.poll_seconds = poll_seconds
+        self.max_wait = max_wait
+        self.gap_seconds = gap_seconds
+        self.stream_seconds = stream_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.retention = retention
+
+    def current(self):
+        """The highest seq in change_log, read on its own connection (the request's stays free)."""
+        with db.engine.connect() as connection:
+            return connection.execute(LATEST).scalar() or 0
+
+    def read(self, since, limit, tables=None):
+        rows = db.session.execute(CHANGES, {"since": since, "limit": limit + 1}).all()
+        # nothing is locked while the caller waits for the next batch
+        db.session.close()
+        return batch(rows, since, limit, tables, self.gap_seconds)
+
+    def notify(self):
+        """A transaction of this process committed, the waiting requests look again."""
+        with self.condition:
+            self.generation += 1
+            self.checked_at = 0
+            self.condition.notify_all()
+
+    def wait(self, since, timeout):
+        """
+        Waits until a change after `since` may be readable (or a commit of this
+        process) for at most `timeout` seconds. The waiting requests of a process
+        share one query every poll_seconds.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            generation = self.generation
+            while self.latest <= since and self.generation == generation:
+                now = time.monotonic()
+                if now >= deadline:
+                    return False
+                if now - self.checked_at >= self.poll_seconds and not self.checking:
+                    self.checking = True
+                    self.condition.release()
+                    try:
+                        latest = self.current()
+                    finally:
+                        self.condition.acquire()
+                        self.checking = False
+                        self.checked_at = time.monotonic()
+                    self.checks += 1
+                    if latest > self.latest:
+                        self.latest = latest
+                        self.condition.notify_all()
+                    continue
+                self.condition.wait(min(deadline - now, max(self.checked_at + self.poll_seconds - now, 0.01)))
+            return True
+
+    def idle(self, batch, timeout):
+        """Waits after `batch` until the next read is worth it."""
+        if batch.held or self.latest > batch.seen:
+            # a gap to be filled, or reading from a replica behind: look again after a poll interval
+            with self.condition:
+                self.condition.wait(min(timeout, self.poll_seconds))
+        else:
+            self.wait(batch.seen, timeout)
+
+    def long_poll(self, since, limit, tables, wait):
+        deadline = time.monotonic() + wait
+        while True:
+            batch = self.read(since, limit, tables)
+            remaining = deadline - time.monotonic()
+            if batch.changes or batch.more or remaining <= 0:
+                return batch
+            since = batch.next
+            self.long_polls += 1
+            self.idle(batch, remaining)
+
+    def stream(self, batch, since, limit, tables):
+        """Event stream generator from a first batch read after `since`, for stream_seconds."""
+        self.streams += 1
+        yield b'retry: 1000\n\n'
+        deadline = time.monotonic() + self.stream_seconds
+        heartbeat_at = time.monotonic() + self.heartbeat_seconds
+        while True:
+            if batch.next != since:
+                yield event_stream_chunk(batch)
+                heartbeat_at = time.monotonic() + self.heartbeat_seconds
+                since = batch.next
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            if not batch.more:
+                if now >= heartbeat_at:
+                    yield b': keepalive\n\n'
+                    heartbeat_at = now + self.heartbeat_seconds
+                self.idle(batch, min(deadline, heartbeat_at) - now)
+            batch = self.read(since, limit, tables)
+
+    def prune(self, before):
+        """Deletes the changes older than `before`, returns how many. Consumers behind them get a 410."""
+        horizon = db.session.execute(select(func.max(Change.seq)).where(Change.created < before)).scalar()
+        if horizon is None:
+            return 0
+        # the newest pruned change stays as the marker of the cut
+        db.session.execute(update(Change).where(Change.seq == horizon).values(op=PRUNED))
+        deleted = db.session.execute(delete(Change).where(Change.seq < horizon)).rowcount
+        db.session.commit()
+        return deleted
+
+    def stats(self):
+        return {"latest": self.latest, "checks": self.checks, "long_polls": self.long_polls, "streams": self.streams}
+
+change_feed = ChangeFeed()
+
+@event.listens_for(Session, 'after_commit')
+def wake_up_waiters(session):
+    change_feed.notify()
+
+def request_since(args, headers):
+    """?since= (or Last-Event-ID when an event stream reconnects), "now" for the latest seq."""
+    value = headers.get('Last-Event-ID') or args.get('since')
+    if value == 'now':
+        return change_feed.current()
+    return int_arg({'since': value}, 'since', 0)
+
+def changes_response():
+    """GET /changes?since=<seq>, see the module docstring."""
+    since = request_since(request.args, request.headers)
+    limit = page_limit(request.args)
+    tables = parse_types(request.args.get('type'))
+    if request.accept_mimetypes.best == 'text/event-stream':
+        # read before answering, so a consumer behind the retention gets its 410
+        batch = change_feed.read(since, limit, tables)
+        response = Response(stream_with_context(change_feed.stream(batch, since, limit, tables)), mimetype='text/event-stream')
+        response.headers['X-Accel-Buffering'] = 'no'  # nginx would hold the events back
+    else:
+        wait = min(int_arg(request.args, 'wait', 0), change_feed.max_wait)
+        batch = change_feed.long_poll(since, limit, tables, wait)
+        response = jsonify({"changes": batch.changes, "next": batch.next, "more": batch.more})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@task('prune_changes')
+def prune_changes_job(payload):
+    before = datetime.datetime.utcnow() - datetime.timedelta(seconds=payload.get('older_than', change_feed.retention))
+    return {"deleted": change_feed.prune(before)}
+
+@click.command('prune-changes')
+@click.option('--older-than', type=float, default=None, help="seconds, CHANGES_RETENTION_SECONDS by default")
+@with_appcontext
+def prune_changes_command(older_than):
+    """Deletes the old changes of the change feed (run it daily)."""
+    seconds = change_feed.retention if older_than is None else older_than
+    deleted = change_feed.prune(datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds))
+    click.echo("%d changes deleted" % deleted)
+
+def configure_changes(config):
+    config.setdefault('CHANGES_POLL_SECONDS', float(os.environ.get('CHANGES_POLL_SECONDS', 0.5)))
+    config.setdefault('CHANGES_MAX_WAIT', int(os.environ.get('CHANGES_MAX_WAIT', 30)))
+    config.setdefault('CHANGES_GAP_SECONDS', float(os.environ.get('CHANGES_GAP_SECONDS', 10)))
+    config.setdefault('CHANGES_STREAM_SECONDS', float(os.environ.get('CHANGES_STREAM_SECONDS', 300)))
+    config.setdefault('CHANGES_HEARTBEAT_SECONDS', float(os.environ.get('CHANGES_HEARTBEAT_SECONDS', 15)))
+    config.setdefault('CHANGES_RETENTION_SECONDS', float(os.environ.get('CHANGES_RETENTION_SECONDS', 7 * 86400)))
+    change_feed.configure(config['CHANGES_POLL_SECONDS'], config['CHANGES_MAX_WAIT'], config['CHANGES_GAP_SECONDS'],
+                          config['CHANGES_STREAM_SECONDS'], config['CHANGES_HEARTBEAT_SECONDS'],
+                          config['CHANGES_RETENTION_SECONDS'])
+    return change_feed
+
+def setup_changes(app):
+    configure_changes(app.config)
+    app.cli.add_command(prune_changes_command)
+    app.extensions['change_feed'] = change_feed
+    return change_feed
@@ -0,0 +1,167 @@
+"""
+Pre-encoded collection pages (/people, /planet, /vehicle, /user): the JSON body
+of each requested page, its validators and its compressed variants, kept until
+the table changes.
+
+A page is served straight from bytes (no query, no encoding, no compression)
+when this process saw no write to the table and it was checked against the
+table's version (max timestamp, count, max id, latest change) less than
+COLLECTION_CACHE_REVALIDATE_SECONDS ago; writes made by other processes are
+therefore visible after at most that delay (0 checks the version on every hit).
+Writes through this process (create / bulk endpoints, admin) invalidate the
+table's pages and rebuild the most recent ones in a background thread.
+
+    COLLECTION_CACHE_SIZE                 pages kept per process (256)
+    COLLECTION_CACHE_REVALIDATE_SECONDS   see above (2)
+    COLLECTION_CACHE_MAX_BODY             bigger pages are not kept (8 MB)
+"""
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from flask import request, Response
+from cache import LRUCache
+from conditional import table_version, version_validators, not_modified, not_modified_response, add_validators
+from compression import compressor, vary_on_encoding
+
+# pages of a table rebuilt after a write, the most recently used first
+REBUILD_LIMIT = 32
+
+class CachedPage:
+
+    def __init__(self, body, headers, etag, last_modified, version, generation, path, base_url):
+        self.body = body
+        self.headers = headers
+        self.etag = etag
+        self.last_modified = last_modified
+        self.version = version
+        self.generation = generation
+        self.path = path
+        self.base_url = base_url
+        self.checked_at = time.monotonic()
+        self.encoded = {}  # encoding -> compressed body
+
+class CollectionCache:
+
+    def __init__(self, maxsize=256, revalidate_seconds=2, max_body_size=8 * 2 ** 20):
+        self.pages = LRUCache(maxsize, ttl=0)
+        self.revalidate_seconds = revalidate_seconds
+        self.max_body_size = max_body_size
+        self.generations = {}  # table -> number of invalidations seen by this process
+        self.builders = {}     # table -> (model, build function)
+        self.pending = set()
+        self.rebuilds = 0
+        self.app = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='collection-cache')
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(table):
+        return (table, request.host, urlencode(sorted(request.args.items(multi=True))))
+
+    def _build(self, model, build, version, generation, query):
+        body, headers = build(model)
+        etag, last_modified = version_validators(model, version, query)
+        return CachedPage(body, headers, etag, last_modified, version, generation, request.path, request.host_url)
+
+    def _store(self, key, page):
+        if len(page.body) <= self.max_body_size:
+            self.pages.set(key, page)
+
+    def page(self, model, build):
+        """
+        (CachedPage, etag, last_modified) of the current request, revalidated or
+        rebuilt when needed. The page is None when the client's copy is current
+        and nothing had to be built.
+        """
+        table = model.__tablename__
+        self.builders[table] = (model, build)
+        key = self.key(table)
+        generation = self.generations.get(table, 0)
+        page = self.pages.get(key)
+        if page is not None and page.generation == generation:
+            if time.monotonic() - page.checked_at < self.revalidate_seconds:
+                return page, page.etag, page.last_modified
+            version = table_version(model)
+            if version == page.version:
+                page.checked_at = time.monotonic()
+                return page, page.etag, page.last_modified
+        else:
+            version = table_version(model)
+        etag, last_modified = version_validators(model, version, key[2])
+        if not_modified(etag, last_modified):
+            return None, etag, last_modified
+        page = self._build(model, build, version, generation, key[2])
+        self._store(key, page)
+        return page, page.etag, page.last_modified
+
+    def encoded_body(self, page):
+        """(body, encoding) for the client, compressed bodies are computed once per page and encoding."""
+        encoding = compressor.negotiate(len(page.body))
+        if encoding is None:
+            return page.body, None
+        body = page.encoded.get(encoding)
+        if body is None:
+            body = page.encoded[encoding] = compressor.compress(page.body, encoding, cached=True)
+        return body, encoding
+
+    def response(self, model, build):
+        page, etag, last_modified = self.page(model, build)
+        if page is None or not_modified(etag, last_modified):
+            return vary_on_encoding(not_modified_response(etag, last_modified))
+        body, encoding = self.encoded_body(page)
+        response = add_validators(Response(page.body, mimetype='application/json', headers=page.headers),
+                                  page.etag, page.last_modified)
+        vary_on_encoding(response)
+        if encoding is not None:
+            compressor.apply(response, encoding, body)
+        return response
+
+    def invalidate(self, model):
+        """Called after a write to the model's table, schedules the rebuild of its pages."""
+        table = model.__tablename__
+        with self._lock:
+            self.generations[table] = self.generations.get(table, 0) + 1
+            if self.app is None or table in self.pending or table not in self.builders:
+                return
+            self.pending.add(table)
+        self._executor.submit(self._rebuild, table)
+
+    def _rebuild(self, table):
+        with self._lock:
+            self.pending.discard(table)
+            generation = self.generations[table]
+        model, build = self.builders[table]
+        keys = [key for key in self.pages.keys() if key[0] == table][-REBUILD_LIMIT:]
+        for key in reversed(keys):
+            old = self.pages.get(key)
+            if old is None or old.generation == generation:
+                continue
+            try:
+                with self.app.test_request_context(old.path, base_url=old.base_url, query_string=key[2]):
+                    page = self._build(model, build, table_version(model), generation, key[2])
+                    for encoding in old.encoded:
+                        page.encoded[encoding] = compressor.compress(page.body, encoding, cached=True)
+            except Exception:
+                self.app.logger.exception("rebuilding the cached page %s?%s failed", old.path, key[2])
+                self.pages.delete(key)
+                continue
+            self._store(key, page)
+            self.rebuilds += 1
+
+    def stats(self):
+        return dict(self.pages.stats(), rebuilds=self.rebuilds, revalidate_seconds=self.revalidate_seconds)
+
+collection_cache = CollectionCache()
+
+def setup_collection_cache(app):
+    app.config.setdefault('COLLECTION_CACHE_SIZE', int(os.environ.get('COLLECTION_CACHE_SIZE', 256)))
+    app.config.setdefault('COLLECTION_CACHE_REVALIDATE_SECONDS', float(os.environ.get('COLLECTION_CACHE_REVALIDATE_SECONDS', 2)))
+    app.config.setdefault('COLLECTION_CACHE_MAX_BODY', int(os.environ.get('COLLECTION_CACHE_MAX_BODY', 8 * 2 ** 20)))
+    collection_cache.pages = LRUCache(app.config['COLLECTION_CACHE_SIZE'], ttl=0)
+    collection_cache.revalidate_seconds = app.config['COLLECTION_CACHE_REVALIDATE_SECONDS']
+    collection_cache.max_body_size = app.config['COLLECTION_CACHE_MAX_BODY']
+    collection_cache.app = app
+    app.extensions['collection_cache'] = collection_cache
+    return collection_cache
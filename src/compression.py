@@ -0,0 +1,90 @@
+"""
+Negotiated response compression (Accept-Encoding): brotli and zstd when their
+packages are installed, gzip otherwise.
+
+    COMPRESS_MIN_SIZE     smaller bodies are sent as is (1024 bytes)
+    COMPRESS_ALGORITHMS   comma separated preference order among the available ones (br,zstd,gzip)
+
+Compressed responses carry a weak ETag (like nginx does), so If-None-Match
+keeps matching whatever encoding the client received.
+"""
+import os
+import gzip
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/html', 'text/plain')
+
+# encoding -> (compress a response, compress a cached body: compressed once, served many times)
+ENCODERS = {'gzip': (lambda data: gzip.compress(data, 6), lambda data: gzip.compress(data, 9))}
+if brotli is not None:
+    ENCODERS['br'] = (lambda data: brotli.compress(data, quality=5), lambda data: brotli.compress(data, quality=9))
+if zstandard is not None:
+    ENCODERS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                        lambda data: zstandard.ZstdCompressor(level=12).compress(data))
+
+class Compressor:
+
+    def __init__(self, min_size=1024, algorithms=('br', 'zstd', 'gzip')):
+        self.configure(min_size, algorithms)
+
+    def configure(self, min_size, algorithms):
+        self.min_size = min_size
+        self.algorithms = [a for a in algorithms if a in ENCODERS]
+
+    def negotiate(self, size):
+        """Encoding to use for a body of `size` bytes, None to send it as is."""
+        if size < self.min_size or not self.algorithms:
+            return None
+        return request.accept_encodings.best_match(self.algorithms)
+
+    def compress(self, data, encoding, cached=False):
+        return ENCODERS[encoding][1 if cached else 0](data)
+
+    def apply(self, response, encoding, body):
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+compressor = Compressor()
+
+def vary_on_encoding(response):
+    response.vary.add('Accept-Encoding')
+    return response
+
+def compress_response(response):
+    """after_request hook: compresses the JSON / text responses that are big enough."""
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    vary_on_encoding(response)
+    data = response.get_data()
+    encoding = compressor.negotiate(len(data))
+    if encoding is None:
+        return response
+    return compressor.apply(response, encoding, compressor.compress(data, encoding))
+
+def setup_compression(app):
+    app.config.setdefault('COMPRESS_MIN_SIZE', int(os.environ.get('COMPRESS_MIN_SIZE', 1024)))
+    app.config.setdefault('COMPRESS_ALGORITHMS', os.environ.get('COMPRESS_ALGORITHMS', 'br,zstd,gzip'))
+    compressor.configure(app.config['COMPRESS_MIN_SIZE'],
+                         [a.strip() for a in app.config['COMPRESS_ALGORITHMS'].split(',') if a.strip()])
+
+    @app.after_request
+    def compress(response):
+        return compress_response(response)
+
+    app.extensions['compressor'] = compressor
+    return compressor
@@ -0,0 +1,86 @@
+"""
+Conditional GET support: ETag / Last-Modified validators and 304 answers,
+computed from the modification time columns of the models and from the
+change_log the triggers of src/changes.py fill, which sees every write
+(raw SQL and other processes included).
+"""
+import hashlib
+import datetime
+from flask import request, Response
+from sqlalchemy import select, func, null
+from werkzeug.http import is_resource_modified
+from models import db, Change
+
+# first column found on the model is used as its modification time
+TIMESTAMP_COLUMNS = ('edited', 'created', 'join_date')
+
+def timestamp_column(model):
+    for name in TIMESTAMP_COLUMNS:
+        if name in model.__table__.columns:
+            return getattr(model, name)
+    return None
+
+def as_utc(value):
+    if value is not None and value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+def last_modified_of(row):
+    column = timestamp_column(type(row))
+    if column is None:
+        return None
+    return as_utc(getattr(row, column.key))
+
+def version_statement(model):
+    column = timestamp_column(model)
+    last_modified = func.max(column) if column is not None else null()
+    latest = select(Change.seq).where(Change.entity_type == model.__tablename__).order_by(Change.seq.desc()).limit(1)
+    changed = select(Change.created).where(Change.entity_type == model.__tablename__).order_by(Change.seq.desc()).limit(1)
+    # once the table's changes are pruned, the first change left (the prune marker) is newer than them
+    first = select(func.min(Change.seq))
+    seq = func.coalesce(latest.scalar_subquery(), first.scalar_subquery())
+    return select(last_modified, func.count(model.id), func.max(model.id), seq, changed.scalar_subquery())
+
+# model -> function returning its version without a query (snapshot.py)
+version_sources = {}
+
+def table_version(model):
+    """(max timestamp, count, max id, latest change seq, time of that change) of a table, from one query."""
+    source = version_sources.get(model)
+    if source is not None:
+        return source(model)
+    return tuple(db.session.execute(version_statement(model)).one())
+
+def version_validators(model, version, query_string):
+    last_modified, count, max_id, seq, changed = version
+    # different pages / filters of the same table must not share an ETag
+    version = "%s:%s:%s:%s:%s:%s" % (model.__tablename__, last_modified, count, max_id, seq, query_string)
+    if changed is not None and (last_modified is None or changed > last_modified):
+        last_modified = changed
+    return hashlib.sha1(version.encode()).hexdigest(), as_utc(last_modified)
+
+def collection_validators(model):
+    """
+    ETag and Last-Modified of a collection from one aggregate query
+    (max timestamp, count, max id and latest change) so no row has to be loaded.
+    """
+    return version_validators(model, table_version(model), request.query_string.decode())
+
+def not_modified(etag, last_modified=None):
+    return not is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+
+def not_modified_response(etag, last_modified=None):
+    response = Response(status=304)
+    return add_validators(response, etag, last_modified)
+
+def add_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+def entity_response(entity):
+    """Response for a cache.CachedEntity, answering 304 when the client copy is still valid."""
+    if not_modified(entity.etag, entity.last_modified):
+        return not_modified_response(entity.etag, entity.last_modified)
+    return add_validators(Response(entity.body, mimetype='application/json'), entity.etag, entity.last_modified)
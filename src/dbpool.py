@@ -0,0 +1,200 @@
+"""
+SQLAlchemy engine / connection pool settings read from the environment, pool
+warm-up for the gunicorn workers and pool / query instrumentation.
+
+    DB_POOL_SIZE              connections kept open per worker (5)
+    DB_MAX_OVERFLOW           extra connections allowed under load (10)
+    DB_POOL_TIMEOUT           seconds to wait for a connection before failing (30)
+    DB_POOL_RECYCLE           seconds after which a connection is replaced (1800)
+    DB_POOL_PRE_PING          test connections on checkout, survives failovers (true)
+    DB_STATEMENT_TIMEOUT_MS   server side statement timeout, 0 disables it (0)
+    DB_POOL_WARMUP            connections opened when a worker boots (1)
+
+Size workers so that workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) stays under
+the database's connection limit.
+"""
+import os
+import time
+import threading
+from flask import current_app
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import Pool, QueuePool
+from models import db
+from utils import env_bool
+
+# upper bounds (seconds) of the latency histograms
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+            if value > self.max:
+                self.max = value
+
+    def cumulative(self):
+        """[(upper bound, cumulative count)] ending with ('+Inf', count)."""
+        total, result = 0, []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "max": round(self.max, 6),
+            "avg": round(self.sum / self.count, 6) if self.count else 0.0
+        }
+
+class PoolMetrics:
+
+    def __init__(self):
+        self.checkout_wait = Histogram()
+        self.queries = Histogram()
+        self.connects = 0
+        self.invalidations = 0
+        self.checkout_timeouts = 0
+
+pool_metrics = PoolMetrics()
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            pool_metrics.checkout_timeouts += 1
+            raise
+        finally:
+            pool_metrics.checkout_wait.observe(time.perf_counter() - start)
+
+def engine_options(url):
+    """SQLALCHEMY_ENGINE_OPTIONS for the connection string."""
+    if not url:
+        return {}
+    backend = make_url(url).get_backend_name()
+    options = {"pool_pre_ping": env_bool('DB_POOL_PRE_PING', 'true')}
+    if backend == 'sqlite':
+        # no server connections to pool, flask_sqlalchemy picks the pool
+        return options
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    )
+    timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    if timeout and backend == 'postgresql':
+        options['connect_args'] = {"options": "-c statement_timeout=%d" % timeout}
+    return options
+
+def _is_mysql(dbapi_connection):
+    return type(dbapi_connection).__module__.split('.')[0] in ('MySQLdb', 'mysql', 'pymysql')
+
+# registered on the classes so every engine (and every pool) is instrumented
+
+@event.listens_for(Pool, 'connect')
+def on_connect(dbapi_connection, connection_record):
+    pool_metrics.connects += 1
+    timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    if timeout and _is_mysql(dbapi_connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SET SESSION max_execution_time = %d" % timeout)
+        cursor.close()
+
+@event.listens_for(Pool, 'invalidate')
+def on_invalidate(dbapi_connection, connection_record, exception):
+    pool_metrics.invalidations += 1
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    pool_metrics.queries.observe(time.perf_counter() - conn.info['query_start'].pop())
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {"class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow
+        )
+    status.update(
+        connects=pool_metrics.connects,
+        invalidations=pool_metrics.invalidations,
+        checkout_timeouts=pool_metrics.checkout_timeouts,
+        checkout_wait=pool_metrics.checkout_wait.to_dict(),
+        queries=pool_metrics.queries.to_dict()
+    )
+    return status
+
+def setup_database(app):
+    """Call before db.init_app(app), which would set empty engine options."""
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config.get('SQLALCHEMY_DATABASE_URI')))
+
+def warm_up(app, connections=None):
+    """Opens connections up front so the first requests of a worker don't pay for them."""
+    connections = int(os.environ.get('DB_POOL_WARMUP', 1)) if connections is None else connections
+    with app.app_context():
+        opened = [db.engine.connect() for _ in range(connections)]
+        for connection in opened:
+            connection.execute(text('SELECT 1'))
+            connection.close()
+
+def dispose_after_fork(app):
+    """In a forked worker: forgets the connections inherited from the parent, without closing the parent's."""
+    with app.app_context():
+        # the primary and the read replicas (binds)
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+            engine = db.get_engine(app, bind=bind)
+            # Engine.dispose(close=False) from SQLAlchemy 1.4.33 on: a new, empty pool, the old one is
+            # dropped without closing its connections (they belong to the parent)
+            engine.pool = engine.pool.recreate()
+
+def health():
+    """(payload, status code) for /health/db"""
+    start = time.perf_counter()
+    try:
+        db.session.execute(text('SELECT 1'))
+        ok = True
+        error = None
+    except Exception:
+        db.session.rollback()
+        ok = False
+        # the driver's message can name the host, the user, parts of the DSN: logged, not returned
+        current_app.logger.error("database health check failed", exc_info=True)
+        error = "database unreachable"
+    payload = {
+        "status": "ok" if ok else "error",
+        "latency_ms": round((time.perf_counter() - start) * 1000, 3),
+        "pool": pool_status(db.engine)
+    }
+    if error:
+        payload["error"] = error
+    return payload, 200 if ok else 503
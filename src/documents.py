@@ -0,0 +1,67 @@
+"""
+Responses that only depend on the route table (the sitemap on / and
+/openapi.json): built on their first request, then served as cached bytes
+with a strong ETag and their compressed variants. They are rebuilt if routes
+are added.
+"""
+import os
+import hashlib
+import threading
+from flask import current_app, Response
+from conditional import not_modified, not_modified_response, add_validators
+from compression import compressor, vary_on_encoding
+from serializers import dumps
+from openapi import openapi_spec
+from utils import generate_sitemap
+
+class CachedDocument:
+
+    def __init__(self, build, mimetype):
+        self.build = build  # app -> bytes, called within a request
+        self.mimetype = mimetype
+        self.body = None
+        self.etag = None
+        self.encoded = {}  # encoding -> compressed body
+        self.routes = None
+        self.builds = 0
+        self._lock = threading.Lock()
+
+    def current(self, app):
+        # the rule count is the cheapest route table version there is
+        routes = len(app.url_map._rules)
+        if self.routes != routes:
+            with self._lock:
+                if self.routes != routes:
+                    body = self.build(app)
+                    self.encoded = {}
+                    self.etag = hashlib.sha1(body).hexdigest()
+                    self.body = body
+                    self.routes = routes
+                    self.builds += 1
+        return self.body
+
+    def response(self):
+        body = self.current(current_app)
+        if not_modified(self.etag):
+            return vary_on_encoding(not_modified_response(self.etag))
+        response = vary_on_encoding(add_validators(Response(body, mimetype=self.mimetype), self.etag))
+        encoding = compressor.negotiate(len(body))
+        if encoding is not None:
+            compressed = self.encoded.get(encoding)
+            if compressed is None:
+                compressed = self.encoded[encoding] = compressor.compress(body, encoding, cached=True)
+            compressor.apply(response, encoding, compressed)
+        return response
+
+def sitemap_document():
+    return CachedDocument(lambda app: generate_sitemap(app).encode(), 'text/html')
+
+def openapi_document():
+    return CachedDocument(lambda app: dumps(openapi_spec(app, app.config['OPENAPI_TITLE'], app.config['OPENAPI_VERSION'])),
+                          'application/json')
+
+def setup_documents(app):
+    app.config.setdefault('OPENAPI_TITLE', os.environ.get('OPENAPI_TITLE', 'Star Wars API'))
+    app.config.setdefault('OPENAPI_VERSION', os.environ.get('OPENAPI_VERSION', '1.0.0'))
+    documents = app.extensions['documents'] = {'sitemap': sitemap_document(), 'openapi': openapi_document()}
+    return documents
@@ -0,0 +1,202 @@
+"""
+Favorites of a user, loaded with a fixed number of queries whatever the number of favorites,
+and added / removed in batches (POST / DELETE /me/favorites).
+"""
+from flask import request
+from sqlalchemy import select, delete
+from sqlalchemy.dialects import postgresql, mysql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from models import db, User, Character, Planet, Vehicle, FavoriteCharacter, FavoritePlanet, FavoriteVehicle, FavoriteCount
+from utils import APIException
+
+# resource name -> (favorite model, entity model, entity key)
+FAVORITE_TYPES = {
+    'people': (FavoriteCharacter, Character, 'character'),
+    'planet': (FavoritePlanet, Planet, 'planet'),
+    'vehicle': (FavoriteVehicle, Vehicle, 'vehicle')
+}
+
+TYPE_ALIASES = {
+    'character': 'people',
+    'characters': 'people',
+    'planets': 'planet',
+    'vehicles': 'vehicle'
+}
+
+# items accepted in one POST / DELETE /me/favorites
+MAX_BATCH = 1000
+
+# session.info key of the count changes of the current transaction, applied
+# to the in-memory leaderboards once it commits (see popularity.py)
+COUNT_CHANGES = 'favorite_count_changes'
+
+def summary(entity):
+    if entity is None:
+        return None
+    return {"id": entity.id, "name": entity.name}
+
+def user_favorites(user_id):
+    """
+    One query for the user plus one SELECT ... IN per favorite table, each joined
+    with the entity it points to: 4 queries in total.
+    """
+    user = User.query.options(
+        selectinload(User.favorite_character).joinedload(FavoriteCharacter.character),
+        selectinload(User.favorite_planet).joinedload(FavoritePlanet.planet),
+        selectinload(User.favorite_vehicle).joinedload(FavoriteVehicle.vehicle)
+    ).filter_by(id=user_id).first()
+    if user is None:
+        raise APIException("User %s not found" % user_id, status_code=404)
+
+    return {
+        "user_id": user.id,
+        "people": [dict(fav.serialize(), character=summary(fav.character)) for fav in user.favorite_character],
+        "planet": [dict(fav.serialize(), planet=summary(fav.planet)) for fav in user.favorite_planet],
+        "vehicle": [dict(fav.serialize(), vehicle=summary(fav.vehicle)) for fav in user.favorite_vehicle]
+    }
+
+def count_upsert(dialect_name):
+    """
+    INSERT of {entity_type, entity_id, favorites} rows that adds to the existing
+    counts (executemany friendly), None when the database has no upsert.
+    """
+    table = FavoriteCount.__table__
+    if dialect_name in ('postgresql', 'sqlite'):
+        statement = (postgresql if dialect_name == 'postgresql' else sqlite).insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=[table.c.entity_type, table.c.entity_id],
+            set_={'favorites': table.c.favorites + statement.excluded.favorites}
+        )
+    if dialect_name == 'mysql':
+        statement = mysql.insert(table)
+        return statement.on_duplicate_key_update(favorites=table.c.favorites + statement.inserted.favorites)
+    return None
+
+def count_favorites(resource, ids, delta):
+    """Adds `delta` to the favorite counts of `ids`, in the current transaction."""
+    if not ids:
+        return
+    table = FavoriteCount.__table__
+    counted = (table.c.entity_type == resource) & table.c.entity_id.in_(ids)
+    statement = count_upsert(db.engine.dialect.name)
+    if delta < 0:
+        db.session.execute(table.update().where(counted).values(favorites=table.c.favorites + delta))
+    elif statement is not None:
+        db.session.execute(statement, [{"entity_type": resource, "entity_id": id, "favorites": delta} for id in ids])
+    else:
+        existing = set(db.session.execute(select(table.c.entity_id).where(counted)).scalars())
+        if existing:
+            db.session.execute(table.update().where(counted).values(favorites=table.c.favorites + delta))
+        missing = [{"entity_type": resource, "entity_id": id, "favorites": delta} for id in ids if id not in existing]
+        if missing:
+            db.session.execute(table.insert(), missing)
+    db.session.info.setdefault(COUNT_CHANGES, []).append((resource, tuple(ids), delta))
+
+def parse_favorites(items):
+    """[{"type": "people", "id": 1}, ...] -> {"people": {1}, ...}, duplicates collapse."""
+    if not isinstance(items, list):
+        raise APIException("Expected a JSON array of {\"type\": ..., \"id\": ...} objects", status_code=400)
+    if len(items) > MAX_BATCH:
+        raise APIException("At most %d favorites per request" % MAX_BATCH, status_code=400)
+    wanted, errors = {}, {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[index] = "must be an object"
+            continue
+        resource = TYPE_ALIASES.get(item.get('type'), item.get('type'))
+        if resource not in FAVORITE_TYPES:
+            errors[index] = "'type' must be one of: %s" % ", ".join(FAVORITE_TYPES)
+            continue
+        id = item.get('id')
+        if not isinstance(id, int) or isinstance(id, bool):
+            errors[index] = "'id' must be an integer"
+            continue
+        wanted.setdefault(resource, set()).add(id)
+    if errors:
+        raise APIException("This is a wrong request", status_code=400, payload={"errors": errors})
+    return wanted
+
+def request_favorites():
+    return parse_favorites(request.get_json(silent=True))
+
+def _check_user(user_id):
+    if db.session.execute(select(User.id).where(User.id == user_id)).first() is None:
+        raise APIException("User %s not found" % user_id, status_code=404)
+
+def _insert_missing(user_id, wanted):
+    """One SELECT of the existing favorites and one executemany INSERT per type."""
+    added = 0
+    for resource, ids in wanted.items():
+        favorite, entity, key = FAVORITE_TYPES[resource]
+        foreign_key = getattr(favorite, key + '_id')
+        existing = set(db.session.execute(
+            select(foreign_key).where(favorite.user_id == user_id, foreign_key.in_(ids))
+        ).scalars())
+        new = sorted(ids - existing)
+        if new:
+            db.session.execute(favorite.__table__.insert(), [{"user_id": user_id, key + "_id": id} for id in new])
+            count_favorites(resource, new, 1)
+            added += len(new)
+    return added
+
+def add_favorites(user_id, wanted):
+    """
+    Adds every favorite of `wanted` that the user does not have yet, in one transaction.
+    Unknown entities fail the whole request with a 404 before anything is written.
+    """
+    _check_user(user_id)
+    missing = {}
+    for resource, ids in wanted.items():
+        entity = FAVORITE_TYPES[resource][1]
+        found = set(db.session.execute(select(entity.id).where(entity.id.in_(ids))).scalars())
+        if found != ids:
+            missing[resource] = sorted(ids - found)
+    if missing:
+        raise APIException("Some favorites do not exist", status_code=404, payload={"missing": missing})
+    try:
+        added = _insert_missing(user_id, wanted)
+        db.session.commit()
+    except IntegrityError:
+        # a concurrent request added some of them first, the retry skips those
+        db.session.rollback()
+        added = _insert_missing(user_id, wanted)
+        db.session.commit()
+    return dict(user_favorites(user_id), added=added)
+
+def delete_statements(dialect_name, resource, user_id, ids):
+    """
+    [(DELETE, id)] removing the user's favorites of `ids`, whose results tell
+    which rows this transaction deleted: one DELETE ... RETURNING on PostgreSQL
+    (id None), elsewhere one DELETE per id and its rowcount. Only those are
+    uncounted, when two requests remove the same favorite one of them deletes it.
+    """
+    favorite, entity, key = FAVORITE_TYPES[resource]
+    foreign_key = getattr(favorite, key + '_id')
+    if dialect_name == 'postgresql':
+        return [(delete(favorite.__table__).where(favorite.user_id == user_id, foreign_key.in_(ids)).returning(foreign_key), None)]
+    return [(delete(favorite.__table__).where(favorite.user_id == user_id, foreign_key == id), id) for id in sorted(ids)]
+
+def deleted_ids(result, id):
+    return list(result.scalars()) if id is None else [id] * result.rowcount
+
+def remove_favorites(user_id, wanted):
+    """Removes the favorites of `wanted`, absent ones are ignored."""
+    _check_user(user_id)
+    removed = 0
+    for resource, ids in wanted.items():
+        favorite, entity, key = FAVORITE_TYPES[resource]
+        foreign_key = getattr(favorite, key + '_id')
+        # the DELETEs are only run for favorites that exist
+        existing = set(db.session.execute(
+            select(foreign_key).where(favorite.user_id == user_id, foreign_key.in_(ids))
+        ).scalars())
+        if not existing:
+            continue
+        deleted = []
+        for statement, id in delete_statements(db.engine.dialect.name, resource, user_id, existing):
+            deleted.extend(deleted_ids(db.session.execute(statement), id))
+        count_favorites(resource, sorted(deleted), -1)
+        removed += len(deleted)
+    db.session.commit()
+    return dict(user_favorites(user_id), removed=removed)
@@ -0,0 +1,264 @@
+"""
+Background jobs: a queue table in the application database (models.Job) and
+`flask worker`, which runs them. Request handlers enqueue the slow side effects
+of a write and answer without waiting for them.
+
+    JOBS_INLINE                 run the jobs right away, in the process that
+                                enqueues them (local development, no worker) (false)
+    JOB_MAX_ATTEMPTS            attempts of a job before it is marked failed (5)
+    JOB_BACKOFF_SECONDS         delay before the first retry, doubled at each
+                                attempt with some jitter (2)
+    JOB_BACKOFF_MAX_SECONDS     longest delay between two attempts (300)
+    JOB_LOCK_SECONDS            a job running for longer is considered lost
+                                (worker killed) and run again (300)
+    JOB_RETENTION_SECONDS       finished jobs are deleted after this long (7 days)
+
+A job is added to the transaction of the caller: it is queued if and only if
+the write that needs it commits. Each job has an idempotency key, enqueuing a
+key that is already in the table does nothing. Jobs run at least once: a task
+must be safe to run again for the same payload, or be registered with
+max_attempts=1.
+
+    @task('send_welcome', on=(User,))       # also enqueued by enqueue_side_effects(user, 'created')
+    def send_welcome(payload): ...
+
+    enqueue('rebuild_favorite_counts', key='rebuild-2026-10-18')
+"""
+import os
+import json
+import time
+import uuid
+import random
+import signal
+import socket
+import datetime
+import traceback
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, update, delete, or_, and_
+from sqlalchemy.dialects import postgresql, sqlite, mysql
+from models import db, Job
+from utils import env_bool
+
+class Task:
+
+    def __init__(self, name, function, max_attempts=None):
+        self.name = name
+        self.function = function
+        self.max_attempts = max_attempts
+
+tasks = {}          # name -> Task
+side_effects = {}   # model -> names of the tasks run after its writes
+
+def task(name, on=(), max_attempts=None):
+    """Registers a job function `function(payload) -> JSON result`, `on` the models whose writes enqueue it."""
+    def register(function):
+        tasks[name] = Task(name, function, max_attempts)
+        for model in on:
+            side_effects.setdefault(model, []).append(name)
+        return function
+    return register
+
+def insert_ignore(dialect_name):
+    """INSERT of a job that does nothing when its idempotency key is taken."""
+    table = Job.__table__
+    if dialect_name in ('postgresql', 'sqlite'):
+        statement = (postgresql if dialect_name == 'postgresql' else sqlite).insert(table)
+        return statement.on_conflict_do_nothing(index_elements=[table.c.idempotency_key])
+    if dialect_name == 'mysql':
+        return mysql.insert(table).prefix_with('IGNORE')
+    return None
+
+class JobQueue:
+
+    def __init__(self):
+        self.configure()
+        self.enqueued = 0
+        self.inline_runs = 0
+
+    def configure(self, inline=False, max_attempts=5, backoff=2, backoff_max=300, lock_seconds=300, retention=7 * 86400):
+        self.inline = inline
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.lock_seconds = lock_seconds
+        self.retention = retention
+
+    def enqueue(self, name, payload=None, key=None, delay=0, max_attempts=None):
+        """
+        Adds a job to the current transaction (queued when the caller commits) and
+        returns its idempotency key, a random one when `key` is None.
+        """
+        if name not in tasks:
+            raise KeyError("unknown task %r" % name)
+        key = key or uuid.uuid4().hex
+        if self.inline:
+            self.inline_runs += 1
+            tasks[name].function(payload or {})
+            return key
+        now = datetime.datetime.utcnow()
+        values = {
+            "name": name, "payload": json.dumps(payload or {}), "idempotency_key": key, "status": 'queued', "attempts": 0,
+            "max_attempts": max_attempts or tasks[name].max_attempts or self.max_attempts,
+            "run_at": now + datetime.timedelta(seconds=delay), "created": now
+        }
+        statement = insert_ignore(db.engine.dialect.name)
+        if statement is None:
+            exists = select(Job.id).where(Job.idempotency_key == key)
+            if db.session.execute(exists).first() is not None:
+                return key
+            statement = Job.__table__.insert()
+        db.session.execute(statement.values(**values))
+        self.enqueued += 1
+        return key
+
+    def retry_delay(self, attempts):
+        delay = min(self.backoff * 2 ** (attempts - 1), self.backoff_max)
+        # jitter, so jobs that failed together don't all retry together
+        return delay * random.uniform(0.5, 1)
+
+job_queue = JobQueue()
+
+def enqueue(name, payload=None, key=None, delay=0, max_attempts=None):
+    return job_queue.enqueue(name, payload, key, delay, max_attempts)
+
+def enqueue_side_effects(row, event):
+    """Enqueues the tasks registered for writes of `row`'s model, payload {"type", "id", "event"}."""
+    names = side_effects.get(type(row))
+    if not names:
+        return
+    if row.id is None:
+        db.session.flush()  # the id is part of the payload
+    table = type(row).__tablename__
+    payload = {"type": table, "id": row.id, "event": event}
+    for name in names:
+        # a row is created or deleted once, so is its job; updates each get their own
+        key = '%s:%s:%s:%s' % (name, table, row.id, event) if event in ('created', 'deleted') else None
+        enqueue(name, payload, key)
+
+def job_by_key(key):
+    return Job.query.filter_by(idempotency_key=key).first()
+
+class Worker:
+    """Claims due jobs in batches and runs them, see `flask worker`."""
+
+    def __init__(self, queue=job_queue, name=None, batch_size=10, poll_seconds=1):
+        self.queue = queue
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.stopping = False
+        self.done = 0
+        self.retried = 0
+        self.failed = 0
+        self.cleaned_at = 0
+
+    def claim(self):
+        """Marks up to batch_size due jobs as running by this worker and returns them."""
+        now = datetime.datetime.utcnow()
+        due = or_(
+            and_(Job.status == 'queued', Job.run_at <= now),
+            # lost: the worker that claimed it stopped without finishing it
+            and_(Job.status == 'running', Job.locked_at < now - datetime.timedelta(seconds=self.queue.lock_seconds))
+        )
+        candidates = select(Job.id).where(due).order_by(Job.run_at).limit(self.batch_size)
+        if db.engine.dialect.name == 'postgresql':
+            # concurrent workers skip the rows another one is claiming instead of waiting
+            candidates = candidates.with_for_update(skip_locked=True)
+        ids = [id for id, in db.session.execute(candidates)]
+        if not ids:
+            db.session.commit()
+            return []
+        # a token per claim: the UPDATE only takes the jobs still due, another worker may have been faster
+        token = '%s:%s' % (self.name, uuid.uuid4().hex[:8])
+        db.session.execute(
+            update(Job).where(Job.id.in_(ids), due)
+            .values(status='running', locked_by=token, locked_at=now, attempts=Job.attempts + 1)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        return Job.query.filter(Job.locked_by == token, Job.status == 'running').order_by(Job.run_at).all()
+
+    def run(self, job):
+        task = tasks.get(job.name)
+        try:
+            if task is None:
+                raise KeyError("unknown task %r" % job.name)
+            result = task.function(json.loads(job.payload))
+        except Exception:
+            db.session.rollback()
+            error = traceback.format_exc()[-4000:]
+            current_app.logger.warning("job %s (%s) failed, attempt %d of %d", job.id, job.name, job.attempts, job.max_attempts, exc_info=True)
+            job.last_error = error
+            if job.attempts >= job.max_attempts:
+                job.status = 'failed'
+                job.finished_at = datetime.datetime.utcnow()
+                self.failed += 1
+            else:
+                job.status = 'queued'
+                job.run_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.queue.retry_delay(job.attempts))
+                self.retried += 1
+        else:
+            job.status = 'done'
+            job.result = json.dumps(result) if result is not None else None
+            job.finished_at = datetime.datetime.utcnow()
+            self.done += 1
+        db.session.commit()
+
+    def clean(self):
+        """Deletes the finished jobs older than the retention, at most once a minute."""
+        if time.monotonic() - self.cleaned_at < 60:
+            return
+        self.cleaned_at = time.monotonic()
+        before = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.queue.retention)
+        db.session.execute(delete(Job).where(Job.status.in_(('done', 'failed')), Job.finished_at < before))
+        db.session.commit()
+
+    def work(self, once=False):
+        """Runs jobs until stopped (SIGTERM / SIGINT finish the current job first), or until none is due with `once`."""
+        while not self.stopping:
+            jobs = self.claim()
+            for job in jobs:
+                if self.stopping:
+                    # not run: give it back
+                    job.status, job.attempts = 'queued', job.attempts - 1
+                    db.session.commit()
+                    continue
+                self.run(job)
+            if not jobs:
+                self.clean()
+                if once:
+                    break
+                time.sleep(self.poll_seconds)
+            db.session.remove()
+
+    def stop(self, *args):
+        self.stopping = True
+
+@click.command('worker')
+@click.option('--batch-size', default=10, help="jobs claimed at a time")
+@click.option('--poll', 'poll_seconds', default=1.0, help="seconds between two looks at an empty queue")
+@click.option('--once', is_flag=True, help="exit once no job is due")
+@with_appcontext
+def worker_command(batch_size, poll_seconds, once):
+    """Runs the background jobs (start as many as needed)."""
+    worker = Worker(batch_size=batch_size, poll_seconds=poll_seconds)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    click.echo("worker %s started, tasks: %s" % (worker.name, ", ".join(sorted(tasks))))
+    worker.work(once=once)
+    click.echo("worker %s stopped: %d done, %d retried, %d failed" % (worker.name, worker.done, worker.retried, worker.failed))
+
+def setup_jobs(app):
+    app.config.setdefault('JOBS_INLINE', env_bool('JOBS_INLINE', 'false'))
+    app.config.setdefault('JOB_MAX_ATTEMPTS', int(os.environ.get('JOB_MAX_ATTEMPTS', 5)))
+    app.config.setdefault('JOB_BACKOFF_SECONDS', float(os.environ.get('JOB_BACKOFF_SECONDS', 2)))
+    app.config.setdefault('JOB_BACKOFF_MAX_SECONDS', float(os.environ.get('JOB_BACKOFF_MAX_SECONDS', 300)))
+    app.config.setdefault('JOB_LOCK_SECONDS', float(os.environ.get('JOB_LOCK_SECONDS', 300)))
+    app.config.setdefault('JOB_RETENTION_SECONDS', float(os.environ.get('JOB_RETENTION_SECONDS', 7 * 86400)))
+    job_queue.configure(app.config['JOBS_INLINE'], app.config['JOB_MAX_ATTEMPTS'], app.config['JOB_BACKOFF_SECONDS'],
+                        app.config['JOB_BACKOFF_MAX_SECONDS'], app.config['JOB_LOCK_SECONDS'], app.config['JOB_RETENTION_SECONDS'])
+    app.cli.add_command(worker_command)
+    app.extensions['job_queue'] = job_queue
+    return job_queue
@@ -1,126 +1,275 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
+
+The app is built by create_app(config), `app` is created on first access so
+importing this module stays cheap. Feature toggles (config or environment):
+
+    ENABLE_ADMIN   serve Flask-Admin under /admin, built on its first request (true)
+    ENABLE_CORS    send the CORS headers (true)
+
+Rate limits of the routes: see ratelimit.py, read replicas: see replicas.py,
+serving the catalog from memory: see snapshot.py, background jobs (`flask
+worker`): see jobs.py, the change feed (/changes): see changes.py.
+
+Flask-Migrate is only set up when the app is loaded by the `flask` command
+(`flask db ...`), servers never import alembic.
 """
 import os
-from flask import Flask, request, jsonify, url_for, json
-from flask_migrate import Migrate
-from flask_swagger import swagger
-from flask_cors import CORS
-from utils import APIException, generate_sitemap
-from admin import setup_admin
-from models import db, User, Character, Planet, Vehicle, FavoriteCharacter, FavoritePlanet, FavoriteVehicle
-from datetime import datetime
+import threading
+import click
+from flask import Flask, Blueprint, request, jsonify, current_app
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from utils import APIException, env_bool
+from pagination import list_response
+from cache import entity_cache, setup_cache
+from collection_cache import collection_cache, setup_collection_cache
+from snapshot import catalog, setup_snapshot
+from compression import setup_compression
+from documents import setup_documents
+from openapi import secured
+from conditional import entity_response
+from bulk import import_rows, request_items, request_batch_size, bulk_payload, import_swapi_command
+from favorites import user_favorites, add_favorites, remove_favorites, request_favorites, count_favorites
+from auth import hasher, setup_auth, check_credentials
+from ratelimit import setup_ratelimit
+from search import search_engine, search_response, setup_search, MemoryBackend, SEARCH_FIELDS
+from dbpool import setup_database, health
+from replicas import replica_router, setup_replicas
+from popularity import setup_popularity, leaderboard_response
+from jobs import job_queue, setup_jobs, enqueue, enqueue_side_effects, job_by_key
+from changes import change_feed, setup_changes, changes_response
+from metrics import setup_metrics, render_metrics
+from models import db, User, Character, Planet, Vehicle, FavoriteCharacter, Job
+from sqlalchemy.exc import IntegrityError
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config["JWT_SECRET_KEY"] = "secret_key"  # Change this "super secret" with something else!
-jwt = JWTManager(app)
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
+api = Blueprint('api', __name__)
+
+class LazyAdmin:
+    """WSGI app mounted on /admin that imports Flask-Admin and builds its views on the first request."""
+
+    def __init__(self, app):
+        self.app = app
+        self.admin_app = None
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if self.admin_app is None:
+            with self._lock:
+                if self.admin_app is None:
+                    from admin import create_admin_app
+                    self.admin_app = create_admin_app(self.app)
+        return self.admin_app(environ, start_response)
+
+def create_app(config=None):
+    """The API app, `config` overrides the settings read from the environment."""
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config["JWT_SECRET_KEY"] = os.environ.get('JWT_SECRET_KEY', "secret_key")  # Set JWT_SECRET_KEY on every real deployment!
+    app.config.update(config or {})
+    app.config.setdefault('ENABLE_ADMIN', env_bool('ENABLE_ADMIN', 'true'))
+    app.config.setdefault('ENABLE_CORS', env_bool('ENABLE_CORS', 'true'))
+    setup_metrics(app)
+    JWTManager(app)
+    setup_auth(app)
+    setup_ratelimit(app)
+    setup_database(app)
+    setup_replicas(app)
+    db.init_app(app)
+    if app.config['ENABLE_CORS']:
+        from flask_cors import CORS
+        CORS(app)
+    if click.get_current_context(silent=True) is not None:
+        # loaded by the flask command, `flask db` needs the extension
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    setup_cache(app)
+    setup_collection_cache(app)
+    setup_snapshot(app)
+    setup_compression(app)
+    setup_search(app)
+    setup_popularity(app)
+    setup_documents(app)
+    setup_jobs(app)
+    setup_changes(app)
+    if app.config['ENABLE_ADMIN']:
+        app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {'/admin': LazyAdmin(app)})
+    app.cli.add_command(import_swapi_command)
+    app.register_error_handler(APIException, handle_invalid_usage)
+    app.register_blueprint(api)
+    return app
+
+def warm(app):
+    """
+    Work done once in the gunicorn master when the app is preloaded (see
+    gunicorn.conf.py), the workers fork with it done: the in-process search
+    index and the catalog snapshot are loaded. Connections used here are
+    closed before forking.
+    """
+    with app.app_context():
+        try:
+            if catalog.enabled:
+                catalog.load()
+            if isinstance(search_engine.backend, MemoryBackend):
+                for resource in SEARCH_FIELDS:
+                    search_engine.backend.sync(resource, force=True)
+            db.session.remove()
+            db.engine.dispose()
+        except Exception:
+            # e.g. the database is not migrated yet: the workers load the index lazily
+            app.logger.warning("warming up the app failed", exc_info=True)
+
+_app = None
+
+def __getattr__(name):
+    # `from main import app` (wsgi.py, FLASK_APP=src/main.py, the benchmarks) builds the app once
+    global _app
+    if name == 'app':
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
-# generate sitemap with all your endpoints
-@app.route('/')
+# generate sitemap with all your endpoints, built once and served from memory
+@api.route('/')
 def sitemap():
-    return generate_sitemap(app)
+    return current_app.extensions['documents']['sitemap'].response()
+
+@api.route('/openapi.json')
+def openapi():
+    return current_app.extensions['documents']['openapi'].response()
+
+@api.route('/search')
+def search():
+    return search_response()
+
+@api.route('/leaderboard/<resource>')
+def leaderboard(resource):
+    return leaderboard_response(resource)
+
+@api.route('/changes')
+def changes():
+    return changes_response()
+
+@api.route('/health/db')
+def health_db():
+    payload, status = health()
+    if replica_router.replicas:
+        payload['replicas'] = replica_router.stats()
+    return jsonify(payload), status
+
+@api.route('/metrics')
+def metrics():
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@api.route('/cache/stats')
+def cache_stats():
+    stats = dict(entity_cache.stats(), collections=collection_cache.stats())
+    if catalog.enabled:
+        stats['snapshot'] = catalog.stats()
+    stats['changes'] = change_feed.stats()
+    return jsonify(stats), 200
 
 # All the GET Methods
-@app.route('/user', methods=['GET'])
+@api.route('/user', methods=['GET'])
 def get_users():
-    users = User.query.all()
-    users = list(map(lambda user: user.serialize(), users))
-    return jsonify(users), 200
+    return list_response(User)
 
-@app.route('/user/<int:id>')
+@api.route('/user/<int:id>')
 def get_specific_user(id):
-    user = User.query.filter_by(id=id)
-    user = user.serialize()
-    return jsonify(user), 200
+    return entity_response(entity_cache.load(User, id))
 
-@app.route('/people')
+@api.route('/people')
 def get_all_people():
-    people = Character.query.all()
-    people = list(map(lambda person: person.serialize(), people))
-    return jsonify(people), 200
+    return list_response(Character)
 
-@app.route('/people/<int:id>')
+@api.route('/people/<int:id>')
 def get_a_person(id):
-    person = Character.query.get(id)
-    person = person.serialize()
-    return jsonify(person), 200
+    return entity_response(entity_cache.load(Character, id))
 
-@app.route('/planet')
+@api.route('/planet')
 def get_all_planets():
-    planets = Planet.query.all()
-    planets = list(map(lambda planet: planet.serialize(), planets))
-    return jsonify(planets), 200
+    return list_response(Planet)
 
-@app.route('/planet/<int:id>')
+@api.route('/planet/<int:id>')
 def get_a_planet(id):
-    planet = Planet.query.get(id)
-    planet = planet.serialize()
-    return jsonify(planet), 200
+    return entity_response(entity_cache.load(Planet, id))
 
-@app.route('/vehicle')
+@api.route('/vehicle')
 def get_all_vehicles():
-    vehicles = Vehicle.query.all()
-    vehicles = list(map(lambda vehicle: vehicle.serialize(), vehicles))
-    return jsonify(vehicles), 200
+    return list_response(Vehicle)
 
-@app.route('/vehicle/<int:id>')
+@api.route('/vehicle/<int:id>')
 def get_a_vehicle(id):
-    vehicle = Vehicle.query.get(id)
-    vehicle = vehicle.serialize()
-    return jsonify(vehicle), 200
-
-# @app.route('/favorite/people/')
-# def get_favorite_characters(id):
-#     vehicle = Vehicle.query.get(id)
-#     vehicle = vehicle.serialize()
-#     return jsonify(vehicle), 200
-
-# @app.route('/user/favorite/people', methods=['GET'])
-# def user_favorite():
-#     favorite_query = FavoriteCharacter.query.filter_by(user_id = 1)
-#     map_favorite = [item.serialize() for item in favorite_query]
-#     return jsonify(map_favorite)
+    return entity_response(entity_cache.load(Vehicle, id))
+
+@api.route('/user/<int:id>/favorites')
+def get_user_favorites(id):
+    return jsonify(user_favorites(id)), 200
+
+@api.route('/me/favorites')
+@secured
+@jwt_required()
+def get_my_favorites():
+    return jsonify(user_favorites(get_jwt_identity())), 200
+
+@api.route('/me/favorites', methods=['POST'])
+@secured
+@jwt_required()
+def add_my_favorites():
+    return jsonify(add_favorites(get_jwt_identity(), request_favorites())), 200
+
+@api.route('/me/favorites', methods=['DELETE'])
+@secured
+@jwt_required()
+def remove_my_favorites():
+    return jsonify(remove_favorites(get_jwt_identity(), request_favorites())), 200
 
 # ALL THE POST METHODS
 
-@app.route('/user', methods=['POST'])
+@api.route('/user', methods=['POST'])
 def create_user():
     request_data = request.get_json()
-    new_user = User(first_name=request_data['first_name'], last_name=request_data['last_name'], email=request_data['email'], password=request_data['password'])
+    new_user = User(first_name=request_data['first_name'], last_name=request_data['last_name'], email=request_data['email'], password=hasher.hash(request_data['password']))
     db.session.add(new_user)
-    db.session.commit()
+    try:
+        enqueue_side_effects(new_user, 'created')
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise APIException("A user with this email already exists", status_code=400)
+    collection_cache.invalidate(User)
     return jsonify(new_user.serialize())
 
-@app.route("/token", methods=["POST"])
+@api.route("/token", methods=["POST"])
 def create_token():
-    email = request.json.get("email", None)
-    password = request.json.get("password", None)
-    # Query your database for username and password
-    user = User.query.filter_by(email=email, password=password).first()
-    if user is None:
-        # the user was not found on the database
+    data = request.get_json(silent=True) or {}
+    email, password = data.get("email"), data.get("password")
+    check_credentials(email, password)
+    # Query your database for the user, the password is checked against its salted hash
+    user = User.query.filter_by(email=email).first()
+    # an unknown email is checked against a dummy hash, as slow as a wrong password
+    valid, new_hash = hasher.verify(user.password if user is not None else None, password)
+    if not valid:
         return jsonify({"msg": "Bad email or password"}), 401
-    
+    if new_hash is not None:
+        # legacy plain text password or old hash settings, upgrade it transparently
+        user.password = new_hash
+        db.session.commit()
+
     # create a new token with the user id inside
     access_token = create_access_token(identity=user.id)
     return jsonify({ "token": access_token, "user_id": user.id })
 
 # POST methods for creating new STARWARS items
 
-@app.route('/people', methods=['POST'])
+@api.route('/people', methods=['POST'])
 def create_character():
     request_data = request.get_json()
     if 'name' in request_data:
@@ -128,10 +277,13 @@ def create_character():
     else:
         return "This is a wrong request", 400
     db.session.add(character)
+    enqueue_side_effects(character, 'created')
     db.session.commit()
-    return jsonify(character.serialize())
+    search_engine.add(character)
+    collection_cache.invalidate(Character)
+    return entity_response(entity_cache.refresh(character))
 
-@app.route('/planet', methods=['POST'])
+@api.route('/planet', methods=['POST'])
 def create_planet():
     request_data = request.get_json()
     if 'orbital_period' in request_data:
@@ -139,10 +291,13 @@ def create_planet():
     else:
         return "This is a wrong request", 400
     db.session.add(planet)
+    enqueue_side_effects(planet, 'created')
     db.session.commit()
-    return jsonify(planet.serialize())
+    search_engine.add(planet)
+    collection_cache.invalidate(Planet)
+    return entity_response(entity_cache.refresh(planet))
 
-@app.route('/vehicle', methods=['POST'])
+@api.route('/vehicle', methods=['POST'])
 def create_vehicle():
     request_data = request.get_json()
     if 'model' in request_data:
@@ -150,33 +305,77 @@ def create_vehicle():
     else:
         return "This is a wrong request", 400
     db.session.add(vehicle)
+    enqueue_side_effects(vehicle, 'created')
     db.session.commit()
-    return jsonify(vehicle.serialize())
+    search_engine.add(vehicle)
+    collection_cache.invalidate(Vehicle)
+    return entity_response(entity_cache.refresh(vehicle))
+
+# Bulk imports, the body is a JSON array or NDJSON (Content-Type: application/x-ndjson).
+# With `Prefer: respond-async` the import runs in a worker: 202 and the job to poll
+# in Location (GET /jobs/<id>), an Idempotency-Key header makes retries of the
+# request safe. Without workers (JOBS_INLINE) the preference is ignored.
+
+def bulk_response(resource, model):
+    if 'respond-async' in request.headers.get('Prefer', '') and not job_queue.inline:
+        key = request.headers.get('Idempotency-Key')
+        if key and len(key) > 200:
+            raise APIException("'Idempotency-Key' must be at most 200 characters", status_code=400)
+        key = enqueue('bulk_import', bulk_payload(resource), key and 'bulk:%s:%s' % (resource, key))
+        db.session.commit()
+        job = job_by_key(key)
+        response = jsonify(job.serialize())
+        response.headers['Location'] = '/jobs/%d' % job.id
+        response.headers['Preference-Applied'] = 'respond-async'
+        return response, 202
+    report = import_rows(model, request_items(), request_batch_size())
+    collection_cache.invalidate(model)
+    return jsonify(report), 200
+
+@api.route('/people/bulk', methods=['POST'])
+def bulk_create_characters():
+    return bulk_response('people', Character)
+
+@api.route('/planet/bulk', methods=['POST'])
+def bulk_create_planets():
+    return bulk_response('planet', Planet)
+
+@api.route('/vehicle/bulk', methods=['POST'])
+def bulk_create_vehicles():
+    return bulk_response('vehicle', Vehicle)
+
+@api.route('/jobs/<int:id>', methods=['GET'])
+def get_job(id):
+    job = Job.query.get(id)
+    if job is None:
+        raise APIException("Job not found", status_code=404)
+    return jsonify(job.serialize()), 200
 
 # POST Methods for Creating Favorites
 
-@app.route('/user/favorite/people/<int:character_id>', methods=["POST"])
+@api.route('/user/favorite/people/<int:character_id>', methods=["POST"])
+@secured
 @jwt_required()
 def add_fav(character_id):
     user_id = get_jwt_identity()
-    character = FavoriteCharacter.query.filter_by(character_id=character_id, user_id=user_id).first()
-    if character.character_id == character_id and character.user_id == user_id:
-        raise APIException("This favorite character already exists for this user", status_code=400)
+    # 404 when the character does not exist, usually answered from the entity cache
+    entity_cache.load(Character, character_id)
     fav = FavoriteCharacter(
         user_id = user_id,
         character_id = character_id
     )
     db.session.add(fav)
-    db.session.commit()
+    # the unique (user_id, character_id) index rejects duplicates, no need to read first
+    try:
+        db.session.flush()
+        count_favorites('people', [character_id], 1)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise APIException("This favorite character already exists for this user", status_code=400)
     return jsonify(fav.serialize())
 
-# @app.route('/user/<user_id>/favorite/people')
-# def get_favorite_character(user_id):
-#     fav = FavoriteCharacter.query.get(user_id)
-#     fav = list(map(lambda person: person.serialize(), fav))
-#     return jsonify(fav), 200
-
 # this only runs if `$ python src/main.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
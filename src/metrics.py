@@ -0,0 +1,218 @@
+"""
+Per request instrumentation: latency and response size histograms per endpoint,
+SQL query count / time and serialization time of each request, a Server-Timing
+header and a Prometheus text exposition for /metrics.
+
+    PROFILE_TOKEN         enables the profiler, requests sent with `X-Profile: <token>` are profiled
+    PROFILE_SAMPLE_RATE   share of those requests actually profiled (0.1)
+    PROFILE_DIR           where the cProfile dumps (.prof, open with pstats / snakeviz) go
+    PROFILE_MAX_FILES     older dumps are removed past this count (100)
+
+Metrics are per process: with several gunicorn workers each one exposes its own.
+"""
+import os
+import hmac
+import time
+import random
+import cProfile
+import tempfile
+import threading
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from dbpool import Histogram, pool_metrics
+
+# upper bounds (bytes) of the response size histograms
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class EndpointMetrics:
+
+    def __init__(self):
+        self.duration = Histogram()
+        self.size = Histogram(SIZE_BUCKETS)
+        self.statuses = {}
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.serialize_seconds = 0.0
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def endpoint(self, rule, method):
+        key = (rule, method)
+        metrics = self.endpoints.get(key)
+        if metrics is None:
+            with self._lock:
+                metrics = self.endpoints.setdefault(key, EndpointMetrics())
+        return metrics
+
+    def observe(self, rule, method, status, seconds, size, timings):
+        metrics = self.endpoint(rule, method)
+        metrics.duration.observe(seconds)
+        if size is not None:
+            metrics.size.observe(size)
+        with self._lock:
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.sql_queries += timings.get('db_count', 0)
+            metrics.sql_seconds += timings.get('db', 0.0)
+            metrics.serialize_seconds += timings.get('serialize', 0.0)
+
+request_metrics = RequestMetrics()
+
+def add_timing(name, seconds):
+    """Adds time spent in `name` to the current request (no-op outside a request)."""
+    if has_request_context():
+        timings = g.setdefault('timings', {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+# SQL time of the current request, from the same class-level events as dbpool
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('request_query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['request_query_start'].pop()
+    if has_request_context():
+        add_timing('db', elapsed)
+        g.timings['db_count'] = g.timings.get('db_count', 0) + 1
+
+def server_timing(total, timings):
+    parts = ["app;dur=%.3f" % (total * 1000)]
+    if 'db_count' in timings:
+        parts.append('db;dur=%.3f;desc="%d queries"' % (timings['db'] * 1000, timings['db_count']))
+    if 'serialize' in timings:
+        parts.append("serialize;dur=%.3f" % (timings['serialize'] * 1000))
+    return ", ".join(parts)
+
+# Prometheus text format
+
+def _labels(**labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items())
+
+def _histogram(lines, name, histogram, **labels):
+    for bound, count in histogram.cumulative():
+        lines.append("%s_bucket%s %d" % (name, _labels(le=bound, **labels), count))
+    lines.append("%s_sum%s %.6f" % (name, _labels(**labels), histogram.sum))
+    lines.append("%s_count%s %d" % (name, _labels(**labels), histogram.count))
+
+def render_metrics():
+    lines = [
+        "# HELP http_request_duration_seconds Request latency per endpoint.",
+        "# TYPE http_request_duration_seconds histogram"
+    ]
+    endpoints = sorted(request_metrics.endpoints.items())
+    for (rule, method), metrics in endpoints:
+        _histogram(lines, "http_request_duration_seconds", metrics.duration, endpoint=rule, method=method)
+    lines += ["# HELP http_response_size_bytes Response body size per endpoint (streamed responses excluded).",
+              "# TYPE http_response_size_bytes histogram"]
+    for (rule, method), metrics in endpoints:
+        _histogram(lines, "http_response_size_bytes", metrics.size, endpoint=rule, method=method)
+    lines += ["# HELP http_requests_total Requests per endpoint and status.", "# TYPE http_requests_total counter"]
+    for (rule, method), metrics in endpoints:
+        for status, count in sorted(metrics.statuses.items()):
+            lines.append("http_requests_total%s %d" % (_labels(endpoint=rule, method=method, status=status), count))
+    for name, attribute, help in (
+        ("http_request_sql_queries_total", "sql_queries", "SQL statements executed while serving the endpoint."),
+        ("http_request_sql_seconds_total", "sql_seconds", "Time spent in SQL statements while serving the endpoint."),
+        ("http_request_serialize_seconds_total", "serialize_seconds", "Time spent encoding JSON for the endpoint.")
+    ):
+        lines += ["# HELP %s %s" % (name, help), "# TYPE %s counter" % name]
+        for (rule, method), metrics in endpoints:
+            lines.append("%s%s %s" % (name, _labels(endpoint=rule, method=method), getattr(metrics, attribute)))
+
+    lines += ["# HELP db_pool_checkout_wait_seconds Time waited for a pooled connection.",
+              "# TYPE db_pool_checkout_wait_seconds histogram"]
+    _histogram(lines, "db_pool_checkout_wait_seconds", pool_metrics.checkout_wait)
+    lines += ["# HELP db_query_duration_seconds SQL statement latency.", "# TYPE db_query_duration_seconds histogram"]
+    _histogram(lines, "db_query_duration_seconds", pool_metrics.queries)
+    for name, value in (("db_pool_connects_total", pool_metrics.connects),
+                        ("db_pool_invalidations_total", pool_metrics.invalidations),
+                        ("db_pool_checkout_timeouts_total", pool_metrics.checkout_timeouts)):
+        lines += ["# TYPE %s counter" % name, "%s %d" % (name, value)]
+    return "\n".join(lines) + "\n"
+
+# opt-in profiler
+
+class Profiler:
+
+    def __init__(self, token=None, sample_rate=0.1, directory=None, max_files=100):
+        self.token = token
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.max_files = max_files
+
+    def wanted(self):
+        header = request.headers.get('X-Profile')
+        if not self.token or header is None or not hmac.compare_digest(header, self.token):
+            return False
+        return random.random() < self.sample_rate
+
+    def start(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # another profiler is already running in this thread
+            return None
+        return profile
+
+    def dump(self, profile, endpoint):
+        profile.disable()
+        os.makedirs(self.directory, exist_ok=True)
+        name = "%d-%s.prof" % (time.time() * 1000, (endpoint or 'unmatched').replace('.', '_'))
+        profile.dump_stats(os.path.join(self.directory, name))
+        self.prune()
+        return name
+
+    def prune(self):
+        files = sorted(f for f in os.listdir(self.directory) if f.endswith('.prof'))
+        for name in files[:max(len(files) - self.max_files, 0)]:
+            os.remove(os.path.join(self.directory, name))
+
+profiler = Profiler()
+
+def setup_metrics(app):
+    app.config.setdefault('PROFILE_TOKEN', os.environ.get('PROFILE_TOKEN'))
+    app.config.setdefault('PROFILE_SAMPLE_RATE', float(os.environ.get('PROFILE_SAMPLE_RATE', 0.1)))
+    app.config.setdefault('PROFILE_DIR', os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'api-profiles')))
+    app.config.setdefault('PROFILE_MAX_FILES', int(os.environ.get('PROFILE_MAX_FILES', 100)))
+    profiler.token = app.config['PROFILE_TOKEN']
+    profiler.sample_rate = app.config['PROFILE_SAMPLE_RATE']
+    profiler.directory = app.config['PROFILE_DIR']
+    profiler.max_files = app.config['PROFILE_MAX_FILES']
+
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        g.profile = profiler.start() if profiler.wanted() else None
+
+    @app.after_request
+    def record_request(response):
+        start = g.get('request_start')
+        if start is None:  # a before_request hook failed before ours ran
+            return response
+        profile = g.pop('profile', None)
+        if profile is not None:
+            response.headers['X-Profile-File'] = profiler.dump(profile, request.endpoint)
+        total = time.perf_counter() - start
+        timings = g.get('timings', {})
+        rule = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+        size = None if response.is_streamed else response.calculate_content_length()
+        request_metrics.observe(rule, request.method, response.status_code, total, size, timings)
+        response.headers['Server-Timing'] = server_timing(total, timings)
+        return response
+
+    @app.teardown_request
+    def stop_profile(error=None):
+        profile = g.pop('profile', None)
+        if profile is not None:  # unhandled error, after_request did not run
+            profile.disable()
+
+    app.extensions['request_metrics'] = request_metrics
+    return request_metrics
@@ -1,24 +1,46 @@
-import os, datetime
+import os, datetime, json
 import sys
 from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, DDL
 
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
 
-db = SQLAlchemy()
+class RoutingSession(SignallingSession):
+    """
+    Reads go to the bind chosen for the request in session.info['read_bind']
+    (a read replica, see replicas.py), flushes and DML statements always go
+    to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        bind_key = self.info.get('read_bind')
+        if bind_key is not None and not self._flushing and not getattr(clause, 'is_dml', False):
+            return get_state(self.app).db.get_engine(self.app, bind=bind_key)
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
 
 # class Users(db.Model)
 
 class User(db.Model):
     __tablename__ = 'user'
+    # (column, id): filters and sorts of the collection endpoints, see src/query.py
+    __table_args__ = (db.Index('ix_user_join_date_id', 'join_date', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.String(250), nullable=False)
     last_name = db.Column(db.String(250), nullable=False)
-    email = db.Column(db.String(250), nullable=False)
-    password = db.Column(db.String(80), nullable=False)
+    email = db.Column(db.String(250), nullable=False, unique=True, index=True)
+    password = db.Column(db.String(255), nullable=False)
     join_date = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    edited = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, nullable=True)
     favorite_character = db.relationship('FavoriteCharacter', back_populates="user")
     favorite_planet = db.relationship('FavoritePlanet', back_populates="user")
     favorite_vehicle = db.relationship('FavoriteVehicle', back_populates="user")
@@ -33,19 +55,24 @@ class User(db.Model):
             "last_name": self.last_name,
             "email": self.email,
             # do not serialize the password, its a security breach
-            "join_date": self.join_date
+            "join_date": self.join_date,
+            "edited": self.edited
         }
 
 class Character(db.Model):
     __tablename__ = 'character'
+    # (column, id): filters and sorts of the collection endpoints, see src/query.py
+    __table_args__ = (db.Index('ix_character_gender_id', 'gender', 'id'),
+                      db.Index('ix_character_eye_color_id', 'eye_color', 'id'),
+                      db.Index('ix_character_hair_color_id', 'hair_color', 'id'))
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(250), nullable=False)
+    name = db.Column(db.String(250), nullable=False, index=True)
     hair_color = db.Column(db.String(80), nullable=True)
     skin_color = db.Column(db.String(80), nullable=True)
     eye_color = db.Column(db.String(80), nullable=True)
     birth_year = db.Column(db.String(250), nullable=False)
     gender = db.Column(db.String(250), nullable=True)
-    edited = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    edited = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, nullable=False)
     users = db.relationship("FavoriteCharacter", back_populates="character")
 
     def __repr__(self):
@@ -64,13 +91,17 @@ class Character(db.Model):
         }
 
 class Planet(db.Model):
+    # (column, id): filters and sorts of the collection endpoints, see src/query.py
+    __table_args__ = (db.Index('ix_planet_climate_id', 'climate', 'id'),
+                      db.Index('ix_planet_population_id', 'population', 'id'),
+                      db.Index('ix_planet_orbital_period_id', 'orbital_period', 'id'))
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(250), nullable=False)
+    name = db.Column(db.String(250), nullable=False, index=True)
     orbital_period = db.Column(db.Integer, nullable=False)
     gravity = db.Column(db.String(250), nullable=False)
     population = db.Column(db.Integer, nullable=False)
     climate = db.Column(db.String(250), nullable=False)
-    edited = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=True)
+    edited = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, nullable=True)
     users = db.relationship("FavoritePlanet", back_populates="planet")
 
     def __repr__(self):
@@ -89,14 +120,21 @@ class Planet(db.Model):
 
 class Vehicle(db.Model):
     __tablename__ = 'vehicle'
+    # (column, id): filters and sorts of the collection endpoints, see src/query.py
+    __table_args__ = (db.Index('ix_vehicle_model_id', 'model', 'id'),
+                      db.Index('ix_vehicle_manufacturer_id', 'manufacturer', 'id'),
+                      db.Index('ix_vehicle_cost_in_credits_id', 'cost_in_credits', 'id'),
+                      db.Index('ix_vehicle_length_id', 'length', 'id'),
+                      db.Index('ix_vehicle_cargo_capacity_id', 'cargo_capacity', 'id'))
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(250), nullable=False)
+    name = db.Column(db.String(250), nullable=False, index=True)
     model = db.Column(db.String(250), nullable=False)
     manufacturer = db.Column(db.String(250), nullable=False)
     cost_in_credits = db.Column(db.Integer, nullable=False)
     length = db.Column(db.Integer, nullable=False)
     cargo_capacity = db.Column(db.Integer, nullable=False)
     created = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    edited = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, nullable=True)
     users = db.relationship("FavoriteVehicle", back_populates="vehicle")
 
     def __repr__(self):
@@ -111,11 +149,19 @@ class Vehicle(db.Model):
             "cost_in_credits": self.cost_in_credits,
             "length": self.length,
             "cargo_capacity": self.cargo_capacity,
-            "created": self.created
+            "created": self.created,
+            "edited": self.edited
         }
 
+# ?name= prefixes are ranges compared COLLATE "C" on PostgreSQL (see src/query.py),
+# an index in the database's collation can't serve them
+for _model in (Character, Planet, Vehicle):
+    event.listen(_model.__table__, 'after_create',
+                 DDL('CREATE INDEX ix_%(table)s_name_c ON %(fullname)s (name COLLATE "C")').execute_if(dialect='postgresql'))
+
 class FavoriteCharacter(db.Model):
     __tablename__ = 'favorite-character'
+    __table_args__ = (db.Index('ix_favorite_character_user_id_character_id', 'user_id', 'character_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.ForeignKey('user.id'))
     character_id = db.Column(db.ForeignKey('character.id'))
@@ -134,6 +180,7 @@ class FavoriteCharacter(db.Model):
 
 class FavoritePlanet(db.Model):
     __tablename__ = 'favorite-planet'
+    __table_args__ = (db.Index('ix_favorite_planet_user_id_planet_id', 'user_id', 'planet_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.ForeignKey('user.id'))
     planet_id = db.Column(db.ForeignKey('planet.id'))
@@ -152,6 +199,7 @@ class FavoritePlanet(db.Model):
 
 class FavoriteVehicle(db.Model):
     __tablename__ = 'favorite-vehicle'
+    __table_args__ = (db.Index('ix_favorite_vehicle_user_id_vehicle_id', 'user_id', 'vehicle_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.ForeignKey('user.id'))
     vehicle_id = db.Column(db.ForeignKey('vehicle.id'))
@@ -166,4 +214,67 @@ class FavoriteVehicle(db.Model):
             "id": self.id,
             "user_id": self.user_id,
             "vehicle_id": self.vehicle_id
-        }
\ No newline at end of file
+        }
+class FavoriteCount(db.Model):
+    """How many users favorited each entity, kept up to date by src/popularity.py."""
+    __tablename__ = 'favorite_count'
+    __table_args__ = (db.Index('ix_favorite_count_entity_type_favorites', 'entity_type', 'favorites', 'entity_id'),)
+    entity_type = db.Column(db.String(20), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+    favorites = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<FavoriteCount %s %r: %r>' % (self.entity_type, self.entity_id, self.favorites)
+
+class Job(db.Model):
+    """Background work queued by src/jobs.py and run by `flask worker`."""
+    __tablename__ = 'job'
+    # the worker looks for due jobs: status = 'queued' AND run_at <= now
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    idempotency_key = db.Column(db.String(255), nullable=False, unique=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    run_at = db.Column(db.DateTime, nullable=False)
+    locked_by = db.Column(db.String(100), nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    result = db.Column(db.Text, nullable=True)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return '<Job %r %s>' % (self.id, self.name)
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "attempts": self.attempts,
+            "max_attempts": self.max_attempts,
+            "run_at": self.run_at,
+            # the traceback is in the admin, the API shows the exception
+            "last_error": self.last_error.strip().splitlines()[-1] if self.last_error else None,
+            "result": json.loads(self.result) if self.result is not None else None,
+            "created": self.created,
+            "finished_at": self.finished_at
+        }
+
+class Change(db.Model):
+    """One insert / update / delete of a tracked table, written by the triggers of src/changes.py."""
+    __tablename__ = 'change_log'
+    # latest change of a table, part of its version (src/conditional.py)
+    __table_args__ = (db.Index('ix_change_log_entity_type_seq', 'entity_type', 'seq'),)
+    # INTEGER PRIMARY KEY on SQLite: the rowid, allocated in commit order
+    seq = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    entity_type = db.Column(db.String(50), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return '<Change %r %s %s:%s>' % (self.seq, self.op, self.entity_type, self.entity_id)
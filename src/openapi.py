@@ -0,0 +1,143 @@
+"""
+OpenAPI 3 description of the API (/openapi.json), generated from the route
+table and the columns of the models: every route is listed, the collection,
+item and create routes of a resource get its schema.
+"""
+import re
+from sqlalchemy import Integer, Float, Numeric, Boolean, DateTime, String
+from models import User, Character, Planet, Vehicle
+from serializers import serializer_for
+import pagination
+import query
+
+# first path segment -> model
+RESOURCES = {'user': User, 'people': Character, 'planet': Planet, 'vehicle': Vehicle}
+
+# <int:id> -> (converter, name)
+ARGUMENT = re.compile(r'<(?:(\w+)(?:\([^)]*\))?:)?(\w+)>')
+CONVERTER_TYPES = {'int': 'integer', 'float': 'number'}
+
+def query_parameter(name, schema, description):
+    return {"name": name, "in": "query", "required": False, "schema": schema, "description": description}
+
+COLLECTION_PARAMETERS = [
+    query_parameter('limit', {"type": "integer", "minimum": 1, "maximum": pagination.MAX_LIMIT,
+                              "default": pagination.DEFAULT_LIMIT}, "Rows per page."),
+    query_parameter('after', {"type": "integer", "minimum": 0}, "Cursor: id of the last row of the previous page (X-Next-Cursor)."),
+    query_parameter('cursor', {"type": "string"}, "Cursor of a sorted listing (X-Next-Cursor)."),
+    query_parameter('fields', {"type": "string"}, "Comma separated columns to return, id is always included."),
+    query_parameter('stream', {"type": "string", "enum": ["json", "ndjson"]}, "Streams the whole table instead of a page.")
+]
+
+def filter_parameters(model):
+    """?sort= and one filter per queryable column of the model (see query.py)."""
+    sortable = sorted(query.sortable(model))
+    parameters = [query_parameter('sort', {"type": "string"}, "Comma separated columns to sort by, "
+                                  "prefixed with - for descending: %s." % ", ".join(sortable))]
+    table = model.__table__
+    for name in sorted(query.queryable(model)):
+        operators = ", ".join('%s__%s' % (name, op) for op in query.OPERATORS if op != 'eq')
+        description = "Keeps the rows whose %s %s this value, also: %s." % (
+            name, 'starts with' if name == 'name' else 'equals', operators)
+        parameters.append(query_parameter(name, column_schema(table.c[name]), description))
+    return parameters
+
+def column_schema(column):
+    kind = column.type
+    if isinstance(kind, Boolean):
+        schema = {"type": "boolean"}
+    elif isinstance(kind, Integer):
+        schema = {"type": "integer"}
+    elif isinstance(kind, (Float, Numeric)):
+        schema = {"type": "number"}
+    elif isinstance(kind, DateTime):
+        # encoded as an HTTP date by the serializers
+        schema = {"type": "string", "example": "Tue, 15 Nov 1994 08:12:31 GMT"}
+    else:
+        schema = {"type": "string"}
+        if isinstance(kind, String) and kind.length:
+            schema["maxLength"] = kind.length
+    if column.nullable:
+        schema["nullable"] = True
+    return schema
+
+def model_schemas(model):
+    """(output schema, input schema) of a model: the serialized columns, the columns a client sends."""
+    serializer = serializer_for(model)
+    output = {"type": "object", "properties": {c.key: column_schema(c) for c in serializer.columns},
+              "required": [c.key for c in serializer.columns if not c.nullable]}
+    writable = [c for c in model.__table__.columns if not c.primary_key and c.default is None]
+    schema_input = {"type": "object", "properties": {c.key: column_schema(c) for c in writable},
+                    "required": [c.key for c in writable if not c.nullable]}
+    return output, schema_input
+
+def secured(view):
+    """Marks a view that needs a bearer token (next to @jwt_required()), its operation gets `security`."""
+    view.requires_token = True
+    return view
+
+def requires_token(view):
+    return getattr(view, 'requires_token', False)
+
+def json_content(schema):
+    return {"application/json": {"schema": schema}}
+
+def ref(name):
+    return {"$ref": "#/components/schemas/%s" % name}
+
+def operation(rule, method, view, path, parameters):
+    endpoint = rule.endpoint.rsplit('.', 1)[-1]
+    doc = (view.__doc__ or '').strip()
+    segments = path.strip('/').split('/')
+    model = RESOURCES.get(segments[0])
+    spec = {
+        "operationId": endpoint,
+        "summary": doc.splitlines()[0] if doc else endpoint.replace('_', ' ').capitalize(),
+        "tags": [segments[0] or 'index'],
+        "parameters": list(parameters),
+        "responses": {"200": {"description": "OK"}, "default": {"description": "Error", "content": json_content(ref('Error'))}}
+    }
+    if model is not None:
+        name = model.__name__
+        if len(segments) == 1 and method == 'get':
+            spec["parameters"] += COLLECTION_PARAMETERS + filter_parameters(model)
+            spec["responses"]["200"] = {"description": "One page, the next one is in the Link header",
+                                        "content": json_content({"type": "array", "items": ref(name)})}
+            spec["responses"]["304"] = {"description": "Not modified"}
+        elif len(segments) == 1 and method == 'post':
+            spec["requestBody"] = {"required": True, "content": json_content(ref(name + 'Input'))}
+            spec["responses"]["200"] = {"description": "Created", "content": json_content(ref(name))}
+        elif segments[1:] == ['{id}'] and method == 'get':
+            spec["responses"]["200"] = {"description": "OK", "content": json_content(ref(name))}
+            spec["responses"]["304"] = {"description": "Not modified"}
+            spec["responses"]["404"] = {"description": "Not found", "content": json_content(ref('Error'))}
+    if requires_token(view):
+        spec["security"] = [{"bearerAuth": []}]
+    return spec
+
+def openapi_spec(app, title='API', version='1.0.0'):
+    """The OpenAPI document (a dict) of the routes of `app`."""
+    paths = {}
+    for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+        if rule.endpoint == 'static':
+            continue
+        parameters = []
+        for converter, name in ARGUMENT.findall(rule.rule):
+            parameters.append({"name": name, "in": "path", "required": True,
+                               "schema": {"type": CONVERTER_TYPES.get(converter, "string")}})
+        path = ARGUMENT.sub(lambda m: '{%s}' % m.group(2), rule.rule)
+        view = app.view_functions[rule.endpoint]
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            paths.setdefault(path, {})[method.lower()] = operation(rule, method.lower(), view, path, parameters)
+    schemas = {"Error": {"type": "object", "properties": {"message": {"type": "string"}}, "required": ["message"]}}
+    for model in RESOURCES.values():
+        schemas[model.__name__], schemas[model.__name__ + 'Input'] = model_schemas(model)
+    return {
+        "openapi": "3.0.3",
+        "info": {"title": title, "version": version},
+        "paths": paths,
+        "components": {
+            "schemas": schemas,
+            "securitySchemes": {"bearerAuth": {"type": "http", "scheme": "bearer", "bearerFormat": "JWT"}}
+        }
+    }
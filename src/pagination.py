@@ -0,0 +1,115 @@
+"""
+Keyset (cursor) pagination and streaming exports for the collection endpoints,
+the filters, sort and fields of a listing are parsed by query.py
+"""
+import time
+from flask import request, url_for, Response, stream_with_context
+from models import db
+from utils import APIException
+from serializers import serializer_for, dumps
+from metrics import add_timing
+from conditional import collection_validators, not_modified, not_modified_response, add_validators
+from collection_cache import collection_cache
+from query import CollectionQuery
+from snapshot import catalog
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_BATCH_SIZE = 1000
+
+def int_arg(args, name, default=None, minimum=0):
+    value = args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise APIException("'%s' must be an integer" % name, status_code=400)
+    if value < minimum:
+        raise APIException("'%s' must be greater than or equal to %d" % (name, minimum), status_code=400)
+    return value
+
+def page_limit(args):
+    return min(int_arg(args, 'limit', DEFAULT_LIMIT, minimum=1), MAX_LIMIT)
+
+def next_link(limit, **cursor):
+    # keep every other query param (fields, filters...) so the next page has the same shape
+    args = request.args.to_dict()
+    args.pop('after', None)
+    args.pop('cursor', None)
+    args.update(cursor, limit=limit)
+    args.update(request.view_args or {})
+    return url_for(request.endpoint, _external=True, **args)
+
+def page(model):
+    """(JSON body, Link / X-Next-Cursor headers) of the requested page."""
+    query = CollectionQuery.parse(model, request.args)
+    limit = page_limit(request.args)
+    cursor = query.start_after(request.args)
+    snapshot = catalog.table(model)
+    # fetch one extra row to know if there is a next page without a COUNT(*)
+    rows = snapshot.rows(query, limit + 1, cursor) if snapshot is not None else None
+    if rows is None:
+        rows = db.session.execute(query.statement(cursor=cursor), dict(query.params, limit=limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    encode = serializer_for(model).encoder(query.fields)
+    start = time.perf_counter()
+    items = [encode(row) for row in rows]
+    add_timing('serialize', time.perf_counter() - start)  # dumps() times the JSON encoding itself
+    headers = {}
+    if has_more:
+        name, cursor = query.next_cursor(rows[-1])
+        headers['Link'] = '<%s>; rel="next"' % next_link(limit, **{name: cursor})
+        headers['X-Next-Cursor'] = str(cursor)
+    return dumps(items), headers
+
+def stream_format(fmt, accept_ndjson=False):
+    if fmt is None and accept_ndjson:
+        fmt = 'ndjson'
+    if fmt in (None, '', '0', 'false'):
+        return None
+    if fmt in ('1', 'true', 'json'):
+        return 'json'
+    if fmt == 'ndjson':
+        return 'ndjson'
+    raise APIException("'stream' must be one of: json, ndjson", status_code=400)
+
+def stream_rows(model, fmt):
+    query = CollectionQuery.parse(model, request.args)
+    encode = serializer_for(model).encoder(query.fields)
+    statement = query.statement(cursor=query.start_after(request.args), paged=False)
+    # server side cursor, only one batch of rows is held in memory at a time
+    result = db.session.execute(statement, query.params, execution_options={'stream_results': True})
+
+    def generate_ndjson():
+        for batch in result.partitions(STREAM_BATCH_SIZE):
+            yield b''.join(dumps(encode(row)) for row in batch)
+
+    def generate_json():
+        yield b'['
+        separator = b''
+        for batch in result.partitions(STREAM_BATCH_SIZE):
+            # encode the batch as one list and drop its brackets ("[...]\n")
+            yield separator + dumps([encode(row) for row in batch])[1:-2]
+            separator = b','
+        yield b']\n'
+
+    if fmt == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json()), mimetype='application/json')
+
+def list_response(model):
+    """
+    Returns one page of the model table, from the pre-encoded page cache, or
+    the whole table as a stream when ?stream=json|ndjson is requested. Answers
+    304 before loading any row when the client's ETag / Last-Modified are still current.
+    """
+    fmt = stream_format(request.args.get('stream'), request.accept_mimetypes.best == 'application/x-ndjson')
+    if fmt is None:
+        return collection_cache.response(model, page)
+    etag, last_modified = collection_validators(model)
+    if not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    return add_validators(stream_rows(model, fmt), etag, last_modified)
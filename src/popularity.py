@@ -0,0 +1,196 @@
+"""
+"Most favorited" leaderboards served from memory.
+
+The favorite_count table holds how many users favorited each entity, it is
+updated in the same transaction as the favorites by every path that writes
+them (favorites.count_favorites, the ASGI app), from the rows each statement
+actually inserted or deleted, so concurrent requests keep it exact.
+`flask rebuild-favorite-counts` (`--queue` leaves it to a worker, see jobs.py)
+is a repair tool for favorites written around the app (raw SQL, restores).
+
+Each process keeps the top CAPACITY counters of every type, loaded with one
+indexed query, and applies the count changes of its own commits to them. An
+entity outside that buffer cannot have more favorites than the smallest one
+loaded (the floor) plus the changes seen since, so the top MAX_LIMIT stays
+exact until one of them could enter it: the buffer is then reloaded. Changes
+made by other processes are picked up every LEADERBOARD_REFRESH_SECONDS.
+"""
+import os
+import time
+import threading
+import click
+from flask import request, Response
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, delete, func, literal, desc
+from sqlalchemy.orm import Session
+from models import db, FavoriteCount
+from favorites import FAVORITE_TYPES, TYPE_ALIASES, COUNT_CHANGES
+from pagination import int_arg
+from serializers import dumps
+from utils import APIException
+from jobs import task, enqueue
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+CAPACITY = 2 * MAX_LIMIT
+
+class Leaderboard:
+
+    def __init__(self, resource, capacity=CAPACITY, refresh_seconds=5):
+        self.resource = resource
+        self.capacity = capacity
+        self.refresh_seconds = refresh_seconds
+        self.entries = {}       # id -> [favorites, name]
+        self.ranking = []       # ids by favorites desc, id desc
+        self.floor = 0          # upper bound of the counts not loaded
+        self.outside = {}       # id -> changes seen since the load, for ids not loaded
+        self.loaded_at = None
+        self.stale = True
+        self.encoded = {}       # limit -> response body
+        self._lock = threading.Lock()
+
+    def statement(self):
+        favorite, entity, key = FAVORITE_TYPES[self.resource]
+        table = FavoriteCount.__table__
+        # ties: highest id first, the order of a backward scan of the (entity_type, favorites, entity_id) index
+        return (
+            select(table.c.entity_id, table.c.favorites, entity.name)
+            .join(entity, entity.id == table.c.entity_id)
+            .where(table.c.entity_type == self.resource, table.c.favorites > 0)
+            .order_by(desc(table.c.favorites), desc(table.c.entity_id))
+            .limit(self.capacity)
+        )
+
+    def load(self):
+        rows = db.session.execute(self.statement()).all()
+        with self._lock:
+            self.entries = {row.entity_id: [row.favorites, row.name] for row in rows}
+            self.ranking = [row.entity_id for row in rows]
+            self.floor = rows[-1].favorites if len(rows) == self.capacity else 0
+            self.outside = {}
+            self.encoded = {}
+            self.stale = False
+            self.loaded_at = time.monotonic()
+
+    def _threshold(self):
+        # count an entity outside the buffer has to reach to possibly enter the top MAX_LIMIT
+        if len(self.ranking) < MAX_LIMIT:
+            return 1
+        return self.entries[self.ranking[MAX_LIMIT - 1]][0]
+
+    def apply(self, ids, delta):
+        with self._lock:
+            if self.stale:
+                return
+            for id in ids:
+                entry = self.entries.get(id)
+                if entry is not None:
+                    entry[0] += delta
+                else:
+                    self.outside[id] = self.outside.get(id, 0) + delta
+            self.ranking.sort(key=lambda id: (self.entries[id][0], id), reverse=True)
+            threshold = self._threshold()
+            top = self.ranking[:MAX_LIMIT]
+            if any(self.floor + change >= threshold for change in self.outside.values() if change > 0) \
+                    or (self.floor and top and self.entries[top[-1]][0] < self.floor):
+                self.stale = True
+            self.encoded = {}
+
+    def top(self, limit):
+        """Encoded response of the `limit` most favorited entities."""
+        if self.stale or time.monotonic() - self.loaded_at >= self.refresh_seconds:
+            self.load()
+        body = self.encoded.get(limit)
+        if body is None:
+            with self._lock:
+                results = [{"id": id, "name": self.entries[id][1], "favorites": self.entries[id][0]}
+                           for id in self.ranking[:limit] if self.entries[id][0] > 0]
+                body = self.encoded[limit] = dumps({"type": self.resource, "limit": limit, "results": results})
+        return body
+
+class Leaderboards:
+
+    def __init__(self, refresh_seconds=5):
+        self.boards = {resource: Leaderboard(resource, refresh_seconds=refresh_seconds) for resource in FAVORITE_TYPES}
+
+    def configure(self, refresh_seconds):
+        for board in self.boards.values():
+            board.refresh_seconds = refresh_seconds
+
+    def get(self, resource):
+        resource = TYPE_ALIASES.get(resource, resource)
+        if resource not in self.boards:
+            raise APIException("Unknown type '%s', use one of: %s" % (resource, ", ".join(self.boards)), status_code=404)
+        return self.boards[resource]
+
+    def apply(self, changes):
+        for resource, ids, delta in changes:
+            self.boards[resource].apply(ids, delta)
+
+    def reset(self):
+        for board in self.boards.values():
+            board.stale = True
+
+leaderboards = Leaderboards()
+
+# count changes reach the leaderboards only once their transaction commits
+
+@event.listens_for(Session, 'after_commit')
+def apply_count_changes(session):
+    changes = session.info.pop(COUNT_CHANGES, None)
+    if changes:
+        leaderboards.apply(changes)
+
+@event.listens_for(Session, 'after_rollback')
+def drop_count_changes(session):
+    session.info.pop(COUNT_CHANGES, None)
+
+def leaderboard_response(resource):
+    """GET /leaderboard/<type>?limit=10"""
+    board = leaderboards.get(resource)
+    limit = min(int_arg(request.args, 'limit', DEFAULT_LIMIT, minimum=1), MAX_LIMIT)
+    return Response(board.top(limit), mimetype='application/json')
+
+def rebuild_counts():
+    """Recomputes favorite_count from the favorite tables, in one transaction. Returns {type: entities}."""
+    table = FavoriteCount.__table__
+    counts = {}
+    db.session.execute(delete(table))
+    for resource, (favorite, entity, key) in FAVORITE_TYPES.items():
+        foreign_key = getattr(favorite, key + '_id')
+        totals = (
+            select(literal(resource), foreign_key, func.count())
+            .where(foreign_key.isnot(None))
+            .group_by(foreign_key)
+        )
+        db.session.execute(table.insert().from_select(['entity_type', 'entity_id', 'favorites'], totals))
+        counts[resource] = db.session.execute(
+            select(func.count()).select_from(table).where(table.c.entity_type == resource)
+        ).scalar()
+    db.session.commit()
+    leaderboards.reset()
+    return counts
+
+@task('rebuild_favorite_counts')
+def rebuild_counts_job(payload):
+    return rebuild_counts()
+
+@click.command('rebuild-favorite-counts')
+@click.option('--queue', is_flag=True, help="run it in a worker (`flask worker`)")
+@with_appcontext
+def rebuild_counts_command(queue):
+    """Recomputes the favorite counts from the favorite tables (after writes made around the app)."""
+    if queue:
+        key = enqueue('rebuild_favorite_counts')
+        db.session.commit()
+        click.echo("queued, job key %s" % key)
+        return
+    for resource, entities in rebuild_counts().items():
+        click.echo("%s: %d entities with favorites" % (resource, entities))
+
+def setup_popularity(app):
+    app.config.setdefault('LEADERBOARD_REFRESH_SECONDS', float(os.environ.get('LEADERBOARD_REFRESH_SECONDS', 5)))
+    leaderboards.configure(app.config['LEADERBOARD_REFRESH_SECONDS'])
+    app.cli.add_command(rebuild_counts_command)
+    app.extensions['leaderboards'] = leaderboards
+    return leaderboards
@@ -0,0 +1,276 @@
+"""
+Filtering, sorting and projection of the collection endpoints, compiled to one
+SELECT that the database answers from an index:
+
+    ?climate=arid                   equality
+    ?population__gt=1000000         also __eq __ne __gte __lt __lte,
+                                    __in=a,b,c  __prefix=Lu  __null=true|false
+    ?sort=-cost_in_credits,name     ORDER BY, "-" for descending (default: id)
+    ?fields=name,model              columns returned (id is always included)
+    ?name=Lu                        name prefix, as before
+
+Only indexed columns (see the indexes in src/models.py) can be filtered on,
+and only the non nullable ones sorted by, so no query scans a table; anything
+else is a 400. A prefix is a range of the index, `name >= 'Lu' AND name < 'Lv'`,
+compared byte by byte: it is case sensitive, except on MySQL whose collations
+ignore case. Values are converted to the column type (ISO 8601 or HTTP
+dates for date columns).
+
+id is always the last sort key, in the direction of the key before it, so a
+(column, id) index gives the whole order. The next page of a sorted listing is
+found with an opaque ?cursor= (the sort values of the last row) instead of
+?after=<id>.
+
+A query shape (columns, operators, sort, projection) is built once with bound
+parameters: the SELECT object is reused, so SQLAlchemy computes its cache key
+and compiles the SQL once per shape, only the values change per request.
+"""
+import json
+import base64
+import datetime
+import functools
+from sqlalchemy import bindparam, and_, or_, Integer, DateTime, String
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.ext.compiler import compiles
+from werkzeug.http import parse_date
+from utils import APIException
+from serializers import serializer_for
+from cache import LRUCache
+
+RESERVED = ('limit', 'after', 'cursor', 'fields', 'sort', 'stream')
+OPERATORS = ('eq', 'ne', 'gt', 'gte', 'lt', 'lte', 'in', 'prefix', 'null')
+COMPARISONS = {
+    'eq': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'gt': lambda column, value: column > value,
+    'gte': lambda column, value: column >= value,
+    'lt': lambda column, value: column < value,
+    'lte': lambda column, value: column <= value
+}
+
+@functools.lru_cache(maxsize=None)
+def queryable(model):
+    """Columns that lead an index (or are the primary key) and are serialized."""
+    table = model.__table__
+    names = {column.key for column in table.primary_key.columns}
+    names.update(index.columns[0].key for index in table.indexes)
+    return frozenset(name for name in names if name in serializer_for(model).names)
+
+@functools.lru_cache(maxsize=None)
+def sortable(model):
+    # NULLs sort first on some databases and last on others, the cursor can't follow both
+    return frozenset(name for name in queryable(model) if not model.__table__.c[name].nullable)
+
+def convert(column, value):
+    """A query string value as a value of the column type."""
+    try:
+        if isinstance(column.type, Integer):
+            return int(value)
+        if isinstance(column.type, DateTime):
+            parsed = parse_date(value) or datetime.datetime.fromisoformat(value)
+            if parsed.tzinfo is not None:
+                # the columns hold naive UTC timestamps
+                parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            return parsed
+    except (TypeError, ValueError):
+        kind = 'an integer' if isinstance(column.type, Integer) else 'a date'
+        raise APIException("'%s' must be %s" % (column.key, kind), status_code=400)
+    return value
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def prefix_end(prefix):
+    """The first string after every string starting with `prefix`: "Lu" -> "Lv"."""
+    head = prefix.rstrip('\U0010ffff')
+    if not head:
+        return prefix + '\U0010ffff'  # can't be incremented, the LIKE keeps the result exact
+    return head[:-1] + chr(ord(head[-1]) + 1)
+
+class byte_order(FunctionElement):
+    """
+    A text column compared by code point, the order of the prefix ranges:
+    COLLATE "C" on PostgreSQL (see the name indexes of src/models.py), unchanged
+    on SQLite (BINARY already) and MySQL (whose indexes follow the column's collation).
+    """
+    name = 'byte_order'
+    inherit_cache = True
+
+    def __init__(self, column):
+        super().__init__(column)
+        self.type = column.type
+
+@compiles(byte_order)
+def compile_byte_order(element, compiler, **kw):
+    return compiler.process(element.clauses, **kw)
+
+@compiles(byte_order, 'postgresql')
+def compile_byte_order_postgresql(element, compiler, **kw):
+    return '%s COLLATE "C"' % compiler.process(element.clauses, **kw)
+
+def encode_cursor(values):
+    data = json.dumps([v.isoformat() if isinstance(v, datetime.datetime) else v for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+def decode_cursor(value):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+    except ValueError:
+        raise APIException("Invalid cursor", status_code=400)
+    if not isinstance(values, list):
+        raise APIException("Invalid cursor", status_code=400)
+    return values
+
+class CollectionQuery:
+    """A parsed query string: the shape of its SELECT, and the values bound to it in `params`."""
+
+    def __init__(self, model, fields, filters, sort, params):
+        self.model = model
+        self.fields = fields    # serialized columns, see ModelSerializer.fields
+        self.filters = filters  # ((column, operator), ...)
+        self.sort = sort        # ((column, descending), ...), id last
+        self.params = params
+        # sort columns the client didn't ask for are selected after `fields`, for the cursor
+        self.columns = fields + tuple(name for name, _ in sort if name not in fields)
+
+    @classmethod
+    def parse(cls, model, args):
+        """`args` is a mapping of the query string (werkzeug or starlette), first value per name."""
+        table = model.__table__
+        serializer = serializer_for(model)
+        fields = serializer.fields(args.get('fields'))
+        allowed = queryable(model)
+        filters, params = [], {}
+        for name, value in args.items():
+            if name in RESERVED:
+                continue
+            column, _, op = name.partition('__')
+            if not op:
+                # ?name=Lu has always been a prefix search
+                op = 'prefix' if column == 'name' else 'eq'
+            if column not in serializer.names:
+                raise APIException("Unknown filter '%s'" % name, status_code=400)
+            if column not in allowed:
+                raise APIException("'%s' can't be filtered on, indexed columns: %s"
+                                   % (column, ", ".join(sorted(allowed))), status_code=400)
+            if op not in OPERATORS:
+                raise APIException("Unknown operator '%s', expected one of: %s" % (op, ", ".join(OPERATORS)), status_code=400)
+            key = '%s__%s' % (column, op)
+            if op == 'null':
+                if value not in ('true', 'false'):
+                    raise APIException("'%s' must be true or false" % name, status_code=400)
+                op = 'null' if value == 'true' else 'notnull'
+            elif op == 'in':
+                params[key] = [convert(table.c[column], v) for v in value.split(',')]
+            elif op == 'prefix':
+                if not isinstance(table.c[column].type, String):
+                    raise APIException("'%s' only applies to text columns" % name, status_code=400)
+                if value == '':
+                    continue  # ?name= keeps every row, as before
+                params[key] = value
+                params[key + '_end'] = prefix_end(value)
+                params[key + '_like'] = escape_like(value) + '%'
+            else:
+                params[key] = convert(table.c[column], value)
+            filters.append((column, op))
+
+        sort = []
+        for key in (args.get('sort') or '').split(','):
+            key = key.strip()
+            name = key.lstrip('-')
+            if not name or any(name == n for n, _ in sort):
+                continue
+            if name not in sortable(model):
+                raise APIException("Can't sort by '%s', sortable columns: %s"
+                                   % (name, ", ".join(sorted(sortable(model)))), status_code=400)
+            sort.append((name, key.startswith('-')))
+            if name == 'id':
+                break  # unique, later keys can't change the order
+        if not sort or sort[-1][0] != 'id':
+            sort.append(('id', sort[-1][1] if sort else False))
+        return cls(model, fields, tuple(sorted(filters)), tuple(sort), params)
+
+    def start_after(self, args):
+        """Binds the cursor of ?after= / ?cursor=, returns True when there is one."""
+        if len(self.sort) == 1:
+            # id order: the cursor is the id, ?cursor= is accepted too
+            name = 'after' if args.get('after') else 'cursor'
+            if not args.get(name):
+                return False
+            try:
+                self.params['cursor_0'] = int(args[name])
+            except ValueError:
+                raise APIException("'%s' must be an integer" % name, status_code=400)
+            return True
+        if args.get('after'):
+            raise APIException("Use 'cursor' to page a sorted listing", status_code=400)
+        if not args.get('cursor'):
+            return False
+        values = decode_cursor(args['cursor'])
+        if len(values) != len(self.sort):
+            raise APIException("Invalid cursor", status_code=400)
+        for i, ((name, _), value) in enumerate(zip(self.sort, values)):
+            self.params['cursor_%d' % i] = convert(self.model.__table__.c[name], str(value))
+        return True
+
+    def next_cursor(self, row):
+        """('after', id) or ('cursor', token) of the page that follows `row`."""
+        values = [row[self.columns.index(name)] for name, _ in self.sort]
+        if len(values) == 1:
+            return 'after', values[0]
+        return 'cursor', encode_cursor(values)
+
+    def statement(self, cursor=False, paged=True):
+        """The SELECT of this shape, to execute with `params` (plus `limit` when paged)."""
+        key = (self.model.__tablename__, self.columns, self.filters, self.sort, cursor, paged)
+        statement = statements.get(key)
+        if statement is None:
+            statement = build_statement(self.model, self.columns, self.filters, self.sort, cursor, paged)
+            statements.set(key, statement)
+        return statement
+
+def filter_clause(column, op, key):
+    if op == 'null':
+        return column.is_(None)
+    if op == 'notnull':
+        return column.isnot(None)
+    if op == 'in':
+        return column.in_(bindparam(key, expanding=True))
+    if op == 'prefix':
+        # LIKE alone is not index backed: SQLite's ignores case while its indexes don't,
+        # PostgreSQL's needs a text_pattern_ops index. The LIKE only checks the rows of the range.
+        ordered = byte_order(column)
+        return and_(ordered >= bindparam(key, type_=column.type), ordered < bindparam(key + '_end', type_=column.type),
+                    column.like(bindparam(key + '_like', type_=column.type), escape='\\'))
+    return COMPARISONS[op](column, bindparam(key, type_=column.type))
+
+def keyset_clause(table, sort):
+    """
+    Rows after the cursor in (k1, ..., id) order: k1 past v1, or k1 = v1 and k2 past v2...
+    The leading `k1 >= v1` is redundant but lets the database seek in the index.
+    """
+    columns = [(table.c[name], descending, bindparam('cursor_%d' % i, type_=table.c[name].type))
+               for i, (name, descending) in enumerate(sort)]
+    alternatives = []
+    for i, (column, descending, value) in enumerate(columns):
+        equal = [c == v for c, _, v in columns[:i]]
+        alternatives.append(and_(*equal, column < value if descending else column > value))
+    if len(columns) == 1:
+        return alternatives[0]
+    column, descending, value = columns[0]
+    return and_(column <= value if descending else column >= value, or_(*alternatives))
+
+def build_statement(model, columns, filters, sort, cursor, paged):
+    table = model.__table__
+    statement = serializer_for(model).select(columns)
+    for name, op in filters:
+        statement = statement.where(filter_clause(table.c[name], op, '%s__%s' % (name, op)))
+    if cursor:
+        statement = statement.where(keyset_clause(table, sort))
+    statement = statement.order_by(*[table.c[name].desc() if descending else table.c[name] for name, descending in sort])
+    if paged:
+        statement = statement.limit(bindparam('limit', type_=Integer))
+    return statement
+
+# query shape -> SELECT, bounded as clients can make up shapes
+statements = LRUCache(512, ttl=0)
@@ -0,0 +1,324 @@
+"""
+Per route rate limits: token buckets keyed by the JWT identity of the caller
+(the client IP without a token), checked before the view runs.
+
+    RATELIMIT_ENABLED       (true)
+    RATELIMIT_LIMITS        per endpoint limits, merged over DEFAULT_LIMITS:
+                            "create_token=10/minute,create_user=none"
+    RATELIMIT_DEFAULT       limit of the endpoints not listed ("" = unlimited)
+    RATELIMIT_STORAGE_URL   "" keeps the buckets in the process (one node),
+                            redis://... shares them between nodes,
+                            memory:// is an in-process stand-in for redis
+    RATELIMIT_PROXY_COUNT   reverse proxies in front of the app: the client IP
+                            is then read from X-Forwarded-For (1 on Heroku,
+                            where DYNO is set, 0 elsewhere)
+
+A limit "10/minute" is a bucket of 10 tokens refilled at 10 per minute: 10
+requests can be made at once, then one every 6 seconds. Responses of limited
+routes carry RateLimit-Limit / RateLimit-Remaining / RateLimit-Reset, a 429
+also carries Retry-After. When the shared store is unreachable requests are
+let through (and counted in the stats). A request carrying X-Forwarded-For
+while RATELIMIT_PROXY_COUNT is 0 logs an error (once): every client behind
+the proxy would share the proxy's bucket.
+
+The WSGI app checks the limits in a before_request hook (setup_ratelimit), the
+ASGI app (asgi.py) in a middleware, with the same limits, endpoint names and
+settings (configure_ratelimit).
+"""
+import os
+import math
+import logging
+import time
+import threading
+from collections import OrderedDict
+from flask import request, g, jsonify
+from flask_jwt_extended import decode_token
+from cache import LRUCache
+from utils import env_bool
+
+log = logging.getLogger(__name__)
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# logins hash a password, writes hit the database
+DEFAULT_LIMITS = {
+    'create_token': '10/minute',
+    'create_user': '5/minute',
+    'create_character': '60/minute',
+    'create_planet': '60/minute',
+    'create_vehicle': '60/minute',
+    'bulk_create_characters': '10/minute',
+    'bulk_create_planets': '10/minute',
+    'bulk_create_vehicles': '10/minute',
+    'add_fav': '120/minute',
+    'add_my_favorites': '60/minute',
+    'remove_my_favorites': '60/minute'
+}
+
+class Limit:
+
+    def __init__(self, count, period):
+        self.capacity = count
+        self.period = period
+        self.rate = count / period  # tokens per second
+        self.policy = "%d;w=%d" % (count, period)
+
+    @classmethod
+    def parse(cls, value):
+        """"10/minute", "100/hour"... None for "none" / "0" / ""."""
+        value = (value or '').strip().lower()
+        if value in ('', '0', 'none', 'off'):
+            return None
+        try:
+            count, period = value.split('/')
+            return cls(int(count), PERIODS[period.strip()])
+        except (ValueError, KeyError):
+            raise ValueError("invalid rate limit %r, expected <count>/<second|minute|hour|day>" % value)
+
+class LocalBuckets:
+    """In-process buckets, the least recently used are dropped past `max_keys` (they restart full)."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, updated]
+        self._lock = threading.Lock()
+
+    def consume(self, key, limit, cost=1):
+        """Takes `cost` tokens if there are enough, returns (allowed, tokens left)."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [limit.capacity, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(limit.capacity, bucket[0] + (now - bucket[1]) * limit.rate)
+                bucket[1] = now
+            allowed = bucket[0] >= cost
+            if allowed:
+                bucket[0] -= cost
+            return allowed, bucket[0]
+
+    def __len__(self):
+        return len(self._buckets)
+
+class DictBuckets:
+    """
+    Shared store stand-in that keeps the buckets in a dict, same interface
+    and expiry as RedisBuckets. Useful for local development and tests.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, limit, cost=1):
+        now = time.time()
+        with self._lock:
+            tokens, updated, expires = self._data.get(key, (limit.capacity, now, now))
+            if expires < now:
+                tokens = limit.capacity
+            tokens = min(limit.capacity, tokens + (now - updated) * limit.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._data[key] = (tokens, now, now + limit.capacity / limit.rate)
+            return allowed, tokens
+
+    def __len__(self):
+        return len(self._data)
+
+# one round trip, atomic, and the server clock so nodes don't need synced clocks
+BUCKET_SCRIPT = """
+local rate, capacity, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1])
+if tokens == nil then
+    tokens = capacity
+else
+    tokens = math.min(capacity, tokens + (now - tonumber(bucket[2])) * rate)
+end
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, tostring(tokens)}
+"""
+
+class RedisBuckets:
+
+    def __init__(self, url):
+        import redis  # only needed when RATELIMIT_STORAGE_URL is a redis URL
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(BUCKET_SCRIPT)
+
+    def consume(self, key, limit, cost=1):
+        allowed, tokens = self.script(keys=['ratelimit:' + key], args=[limit.rate, limit.capacity, cost])
+        return bool(allowed), float(tokens)
+
+    def __len__(self):
+        return 0  # not tracked, the keys expire in redis
+
+class RateLimiter:
+
+    def __init__(self, store=None, limits=None, default=None, proxy_count=0):
+        self.configure(store, limits, default, proxy_count)
+        self.enabled = True
+        self.identity_claim = 'sub'
+        self.tokens = LRUCache(4096, ttl=300)  # raw JWT -> identity, decoded once
+        self.decode = decode_token  # raw JWT -> claims, raises when invalid
+        self.limited = 0
+        self.store_errors = 0
+
+    def configure(self, store=None, limits=None, default=None, proxy_count=0):
+        self.store = store if store is not None else LocalBuckets()
+        self.limits = limits or {}  # endpoint (without blueprint) -> Limit or None
+        self.default = default
+        self.proxy_count = proxy_count
+        self.forwarded_unused = False
+
+    def limit_for(self, endpoint):
+        return self.limits.get(endpoint.rpartition('.')[2], self.default)
+
+    def client_ip(self, environ):
+        if self.proxy_count:
+            forwarded = [ip.strip() for ip in environ.get('HTTP_X_FORWARDED_FOR', '').split(',') if ip.strip()]
+            if len(forwarded) >= self.proxy_count:
+                return forwarded[-self.proxy_count]
+        elif 'HTTP_X_FORWARDED_FOR' in environ and not self.forwarded_unused:
+            self.forwarded_unused = True
+            log.error("X-Forwarded-For is set but RATELIMIT_PROXY_COUNT is 0: the requests are limited "
+                                     "by the address of the proxy, %s", environ.get('REMOTE_ADDR'))
+        return environ.get('REMOTE_ADDR') or 'unknown'
+
+    def client_key(self, environ):
+        """'user:<identity>' for a request with a valid token, 'ip:<address>' otherwise."""
+        header = environ.get('HTTP_AUTHORIZATION', '')
+        if header.startswith('Bearer '):
+            token = header[7:]
+            identity = self.tokens.get(token)
+            if identity is None:
+                try:
+                    identity = self.decode(token)[self.identity_claim]
+                except Exception:
+                    identity = False  # invalid or expired: the view answers 401, limit by IP meanwhile
+                self.tokens.set(token, identity)
+            if identity is not False:
+                return 'user:%s' % identity
+        return 'ip:%s' % self.client_ip(environ)
+
+    def consume(self, endpoint, environ):
+        """(limit, allowed, tokens left) of a request, None when the endpoint is not limited or the store is down."""
+        if not self.enabled or endpoint is None:
+            return None
+        limit = self.limit_for(endpoint)
+        if limit is None:
+            return None
+        key = '%s:%s' % (endpoint, self.client_key(environ))
+        try:
+            allowed, tokens = self.store.consume(key, limit)
+        except Exception:
+            # fail open, a rate limiter outage must not take the API down
+            self.store_errors += 1
+            return None
+        if not allowed:
+            self.limited += 1
+        return limit, allowed, tokens
+
+    def check(self):
+        """before_request hook: None to go on, a 429 response once the bucket is empty."""
+        # the request proxy is resolved once, each access through it costs a context lookup
+        current = request._get_current_object()
+        result = self.consume(current.endpoint, current.environ)
+        if result is None:
+            return None
+        limit, allowed, tokens = result
+        g.rate_limit = (limit, tokens)
+        if allowed:
+            return None
+        response = jsonify(self.too_many(limit, tokens))
+        response.status_code = 429
+        return response
+
+    def too_many(self, limit, tokens):
+        return {"message": "Too many requests, retry in %d seconds" % self.retry_after(limit, tokens)}
+
+    @staticmethod
+    def retry_after(limit, tokens):
+        return max(1, math.ceil((1 - tokens) / limit.rate))
+
+    def headers(self, limit, tokens, status_code):
+        """[(name, value)] of the RateLimit headers of a response."""
+        headers = [
+            ('RateLimit-Limit', str(limit.capacity)),
+            ('RateLimit-Remaining', str(int(tokens))),
+            # seconds until the bucket is full again
+            ('RateLimit-Reset', str(math.ceil((limit.capacity - tokens) / limit.rate))),
+            ('RateLimit-Policy', limit.policy)
+        ]
+        if status_code == 429:
+            headers.append(('Retry-After', str(self.retry_after(limit, tokens))))
+        return headers
+
+    def add_headers(self, response):
+        """after_request hook"""
+        rate_limit = g.get('rate_limit')
+        if rate_limit is None:
+            return response
+        limit, tokens = rate_limit
+        # one extend instead of a duplicate scan per header
+        response.headers.extend(self.headers(limit, tokens, response.status_code))
+        return response
+
+    def stats(self):
+        return {"enabled": self.enabled, "limited": self.limited, "store": type(self.store).__name__,
+                "buckets": len(self.store), "store_errors": self.store_errors}
+
+rate_limiter = RateLimiter()
+
+def parse_limits(value):
+    """"create_token=10/minute,create_user=none" -> {endpoint: Limit or None}"""
+    limits = {}
+    for item in (value or '').split(','):
+        if item.strip():
+            endpoint, _, limit = item.partition('=')
+            limits[endpoint.strip()] = Limit.parse(limit)
+    return limits
+
+def configure_ratelimit(config):
+    config.setdefault('RATELIMIT_ENABLED', env_bool('RATELIMIT_ENABLED', 'true'))
+    config.setdefault('RATELIMIT_LIMITS', os.environ.get('RATELIMIT_LIMITS', ''))
+    config.setdefault('RATELIMIT_DEFAULT', os.environ.get('RATELIMIT_DEFAULT', ''))
+    config.setdefault('RATELIMIT_STORAGE_URL', os.environ.get('RATELIMIT_STORAGE_URL', ''))
+    # the Heroku router is a proxy: without it every client would share the router's bucket
+    config.setdefault('RATELIMIT_PROXY_COUNT', int(os.environ.get('RATELIMIT_PROXY_COUNT', 1 if 'DYNO' in os.environ else 0)))
+
+    limits = {endpoint: Limit.parse(limit) for endpoint, limit in DEFAULT_LIMITS.items()}
+    limits.update(parse_limits(config['RATELIMIT_LIMITS']))
+    url = config['RATELIMIT_STORAGE_URL']
+    if url == 'memory://':
+        store = DictBuckets()
+    elif url:
+        store = RedisBuckets(url)
+    else:
+        store = LocalBuckets()
+    rate_limiter.configure(store, limits, Limit.parse(config['RATELIMIT_DEFAULT']), config['RATELIMIT_PROXY_COUNT'])
+    rate_limiter.enabled = config['RATELIMIT_ENABLED']
+    rate_limiter.identity_claim = config.get('JWT_IDENTITY_CLAIM', 'sub')
+    return rate_limiter
+
+def setup_ratelimit(app):
+    """Call after the JWT manager is set up, the limits are checked before the views run."""
+    configure_ratelimit(app.config)
+    rate_limiter.decode = decode_token
+    app.before_request(rate_limiter.check)
+    app.after_request(rate_limiter.add_headers)
+    app.extensions['rate_limiter'] = rate_limiter
+    return rate_limiter
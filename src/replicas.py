@@ -0,0 +1,175 @@
+"""
+Read replicas for the GET routes.
+
+    DB_REPLICA_URLS                 comma separated connection strings of the replicas ("" = none)
+    DB_REPLICA_STRATEGY             least_loaded (fewest requests in flight, ties in turn) or round_robin
+    DB_REPLICA_HEALTH_SECONDS       a replica is checked (SELECT 1) at most this often, a failed one
+                                    is left out until its next check (5)
+    DB_READ_YOUR_WRITES_SECONDS     reads of a client that just wrote go to the primary this long (5)
+    DB_REPLICA_PRIMARY_ENDPOINTS    GET endpoints that always read the primary (health_db)
+
+The replicas are flask_sqlalchemy binds (replica_1, replica_2...) with the
+pool settings of the primary. For each GET / HEAD request one healthy replica
+is picked and models.RoutingSession sends its reads there; writes, other
+methods (/token is a POST) and the endpoints above use the primary.
+
+Read-your-writes: after a successful write the client (JWT identity or IP,
+as for the rate limits) reads from the primary for DB_READ_YOUR_WRITES_SECONDS,
+which should exceed the replication lag. The worker that served the write
+remembers it, and a `read_primary` cookie carries it to the other workers and
+nodes for clients that keep cookies.
+"""
+import os
+import time
+import threading
+from flask import request, g
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.engine import make_url
+from models import db
+from cache import LRUCache
+from ratelimit import rate_limiter
+
+READ_METHODS = ('GET', 'HEAD')
+STICKY_COOKIE = 'read_primary'
+
+class Replica:
+
+    def __init__(self, bind_key, url):
+        self.bind_key = bind_key
+        self.url = url
+        self.healthy = True
+        self.checked_at = None
+        self.in_flight = 0
+        self.reads = 0
+        self.failures = 0
+        self._check_lock = threading.Lock()
+
+    def to_dict(self):
+        return {"bind": self.bind_key, "url": make_url(self.url).render_as_string(hide_password=True),
+                "healthy": self.healthy, "in_flight": self.in_flight, "reads": self.reads, "failures": self.failures}
+
+class ReplicaRouter:
+
+    def __init__(self):
+        self.configure([])
+        self.sticky = LRUCache(100000, ttl=5)  # client key -> True, clients that just wrote
+
+    def configure(self, urls, strategy='least_loaded', health_seconds=5, primary_endpoints=()):
+        self.replicas = [Replica('replica_%d' % (i + 1), url) for i, url in enumerate(urls)]
+        self.strategy = strategy
+        self.health_seconds = health_seconds
+        self.primary_endpoints = set(primary_endpoints)
+        self.primary_reads = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def check(self, replica, app):
+        """Runs SELECT 1 on the replica when its last check is older than health_seconds."""
+        now = time.monotonic()
+        if replica.checked_at is not None and now - replica.checked_at < self.health_seconds:
+            return replica.healthy
+        if not replica._check_lock.acquire(blocking=False):
+            return replica.healthy  # another thread is checking it
+        try:
+            with db.get_engine(app, bind=replica.bind_key).connect() as connection:
+                connection.execute(text('SELECT 1'))
+            replica.healthy = True
+        except Exception:
+            replica.healthy = False
+            replica.failures += 1
+            app.logger.warning("read replica %s is unreachable", replica.bind_key, exc_info=True)
+        finally:
+            replica.checked_at = time.monotonic()
+            replica._check_lock.release()
+        return replica.healthy
+
+    def choose(self, app):
+        """A healthy replica, None when there is none (the primary serves the reads)."""
+        healthy = [replica for replica in self.replicas if self.check(replica, app)]
+        if not healthy:
+            return None
+        with self._lock:
+            start = self._next
+            self._next += 1
+            # rotate first, so equally loaded replicas take turns
+            ordered = healthy[start % len(healthy):] + healthy[:start % len(healthy)]
+            replica = ordered[0] if self.strategy == 'round_robin' else min(ordered, key=lambda r: r.in_flight)
+            replica.in_flight += 1
+            replica.reads += 1
+        return replica
+
+    def release(self, replica, error=None):
+        with self._lock:
+            replica.in_flight -= 1
+        if isinstance(error, DBAPIError):
+            # leave it out until its next health check
+            replica.healthy = False
+            replica.checked_at = time.monotonic()
+            replica.failures += 1
+
+    def reads_primary(self, current):
+        if current.method not in READ_METHODS or current.endpoint is None:
+            return True
+        if current.endpoint.rpartition('.')[2] in self.primary_endpoints:
+            return True
+        if STICKY_COOKIE in current.cookies:
+            return True
+        return self.sticky.get(rate_limiter.client_key(current.environ)) is not None
+
+    def before_request(self, app):
+        if not self.replicas:
+            return
+        current = request._get_current_object()
+        if self.reads_primary(current):
+            self.primary_reads += 1
+            return
+        replica = self.choose(app)
+        if replica is None:
+            self.primary_reads += 1
+            return
+        g.read_replica = replica
+        db.session.info['read_bind'] = replica.bind_key
+
+    def after_request(self, response):
+        current = request._get_current_object()
+        if self.replicas and current.method not in READ_METHODS and response.status_code < 400:
+            self.sticky.set(rate_limiter.client_key(current.environ), True)
+            response.set_cookie(STICKY_COOKIE, '1', max_age=max(int(self.sticky.ttl), 1), httponly=True, samesite='Lax')
+        return response
+
+    def teardown_request(self, error=None):
+        replica = g.pop('read_replica', None)
+        if replica is not None:
+            db.session.info.pop('read_bind', None)
+            self.release(replica, error)
+
+    def stats(self):
+        return {"strategy": self.strategy, "primary_reads": self.primary_reads,
+                "replicas": [replica.to_dict() for replica in self.replicas]}
+
+replica_router = ReplicaRouter()
+
+def setup_replicas(app):
+    app.config.setdefault('DB_REPLICA_URLS', os.environ.get('DB_REPLICA_URLS', ''))
+    app.config.setdefault('DB_REPLICA_STRATEGY', os.environ.get('DB_REPLICA_STRATEGY', 'least_loaded'))
+    app.config.setdefault('DB_REPLICA_HEALTH_SECONDS', float(os.environ.get('DB_REPLICA_HEALTH_SECONDS', 5)))
+    app.config.setdefault('DB_READ_YOUR_WRITES_SECONDS', float(os.environ.get('DB_READ_YOUR_WRITES_SECONDS', 5)))
+    app.config.setdefault('DB_REPLICA_PRIMARY_ENDPOINTS', os.environ.get('DB_REPLICA_PRIMARY_ENDPOINTS', 'health_db'))
+    if app.config['DB_REPLICA_STRATEGY'] not in ('least_loaded', 'round_robin'):
+        raise ValueError("DB_REPLICA_STRATEGY must be least_loaded or round_robin")
+
+    urls = [url.strip() for url in app.config['DB_REPLICA_URLS'].split(',') if url.strip()]
+    replica_router.configure(urls, app.config['DB_REPLICA_STRATEGY'], app.config['DB_REPLICA_HEALTH_SECONDS'],
+                             [e.strip() for e in app.config['DB_REPLICA_PRIMARY_ENDPOINTS'].split(',') if e.strip()])
+    replica_router.sticky = LRUCache(100000, ttl=app.config['DB_READ_YOUR_WRITES_SECONDS'])
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds.update({replica.bind_key: replica.url for replica in replica_router.replicas})
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+    if replica_router.replicas:
+        app.before_request(lambda: replica_router.before_request(app))
+        app.after_request(replica_router.after_request)
+        app.teardown_request(replica_router.teardown_request)
+    app.extensions['replica_router'] = replica_router
+    return replica_router
@@ -0,0 +1,360 @@
+"""
+Full-text / prefix search over characters, planets and vehicles.
+
+Uses the native full-text indexes of the database when there is one
+(PostgreSQL GIN on to_tsvector, MySQL FULLTEXT, see migration 5c7a9e1b3d20),
+otherwise an in-process inverted index kept current on writes and resynced
+from the change feed (src/changes.py) every SEARCH_REFRESH_SECONDS, so writes
+of other processes (and raw SQL) show up too.
+"""
+import os
+import re
+import time
+import heapq
+import bisect
+import threading
+from flask import request, jsonify
+from sqlalchemy import select, func, desc
+from models import db, Character, Planet, Vehicle
+from changes import CHANGES, batch, change_feed
+from utils import APIException
+
+MAX_LIMIT = 100
+# deeper pages cost offset + limit rows per resource, like pagination's MAX_LIMIT they are capped
+MAX_OFFSET = 1000
+# changes read per query when resyncing
+SYNC_BATCH = 1000
+
+SEARCH_FIELDS = {
+    'people': (Character, ('name',)),
+    'planet': (Planet, ('name',)),
+    'vehicle': (Vehicle, ('name', 'model', 'manufacturer'))
+}
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN_RE.findall(text or '')]
+
+def document_text(model, row):
+    return ' '.join(getattr(row, field) or '' for field in SEARCH_FIELDS[resource_of(model)][1])
+
+def resource_of(model):
+    for resource, (m, _) in SEARCH_FIELDS.items():
+        if m is model:
+            return resource
+    return None
+
+class InvertedIndex:
+    """
+    token -> ids postings plus a sorted vocabulary, a query term matches every
+    token it is a prefix of (found with bisect). Scores: 2 per exact token, 1 per prefix,
+    ties are broken by the static rank of the documents (shortest name, then id).
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.docs = {}
+        self.vocabulary = []
+        self._ranked_cache = {}
+        self._lock = threading.RLock()
+
+    def add(self, id, name, text, sort=True):
+        with self._lock:
+            self.remove(id)
+            tokens = tuple(set(tokenize(text)))
+            self.docs[id] = (name, tokens)
+            for token in tokens:
+                self._ranked_cache.pop(token, None)
+                ids = self.postings.get(token)
+                if ids is None:
+                    self.postings[token] = {id}
+                    if sort:
+                        bisect.insort(self.vocabulary, token)
+                    else:
+                        self.vocabulary.append(token)
+                else:
+                    ids.add(id)
+
+    def remove(self, id):
+        with self._lock:
+            doc = self.docs.pop(id, None)
+            if doc is None:
+                return
+            for token in doc[1]:
+                self._ranked_cache.pop(token, None)
+                ids = self.postings.get(token)
+                ids.discard(id)
+                if not ids:
+                    del self.postings[token]
+                    self.vocabulary.pop(bisect.bisect_left(self.vocabulary, token))
+
+    def bulk_load(self, rows):
+        """rows of (id, name, text), faster than add() one by one: the vocabulary is sorted once."""
+        with self._lock:
+            for id, name, text in rows:
+                self.add(id, name, text, sort=False)
+            self.vocabulary.sort()
+
+    def _expand(self, term):
+        start = bisect.bisect_left(self.vocabulary, term)
+        end = bisect.bisect_left(self.vocabulary, term + '\uffff')
+        return self.vocabulary[start:end]
+
+    def _static_rank(self, id):
+        # shortest name first, then id
+        return (len(self.docs[id][0]) << 32) | id
+
+    def _ranked(self, token):
+        """Ids of a token sorted by static rank, cached until the token's postings change."""
+        ranked = self._ranked_cache.get(token)
+        if ranked is None:
+            ranked = self._ranked_cache[token] = sorted(self.postings[token], key=self._static_rank)
+        return ranked
+
+    def _top_single_term(self, term, count):
+        # no scoring needed: exact matches (score 2) come first, then prefix matches,
+        # each already sorted by static rank, so only `count` ids are looked at
+        exact = self.postings.get(term, set())
+        prefixed = [token for token in self._expand(term) if token != term]
+        top = [(2, id) for id in self._ranked(term)[:count]] if exact else []
+        seen = set()
+        if len(top) < count:
+            for id in heapq.merge(*[self._ranked(token) for token in prefixed], key=self._static_rank):
+                if id in exact or id in seen:
+                    continue
+                seen.add(id)
+                top.append((1, id))
+                if len(top) == count:
+                    break
+        total = len(exact.union(*[self.postings[token] for token in prefixed]))
+        return top, total
+
+    def search(self, terms, limit, offset=0):
+        """Returns ([(score, id, name)], total) for documents matching all the terms."""
+        with self._lock:
+            terms = list(dict.fromkeys(terms))
+            if len(terms) == 1:
+                top, total = self._top_single_term(terms[0], offset + limit)
+                return [(score, id, self.docs[id][0]) for score, id in top[offset:]], total
+
+            matches = []
+            for term in terms:
+                exact = self.postings.get(term, set())
+                prefixed = [self.postings[token] for token in self._expand(term) if token != term]
+                matches.append((exact, prefixed))
+            # start from the most selective term, the others only filter its candidates
+            matches.sort(key=lambda m: len(m[0]) + sum(len(ids) for ids in m[1]))
+            # set operations only, the per id work stays in C
+            exact, prefixed = matches[0]
+            scores = dict.fromkeys(set().union(*prefixed) - exact, 1)
+            scores.update(dict.fromkeys(exact, 2))
+            for exact, prefixed in matches[1:]:
+                if not scores:
+                    break
+                candidates = scores.keys()
+                exact_hits = candidates & exact
+                prefix_hits = set().union(*[candidates & ids for ids in prefixed]) - exact_hits
+                narrowed = {id: scores[id] + 1 for id in prefix_hits}
+                narrowed.update({id: scores[id] + 2 for id in exact_hits})
+                scores = narrowed
+            if not scores:
+                return [], 0
+            # best score first, then static rank
+            ranked = heapq.nsmallest(offset + limit, scores, key=lambda id: (-scores[id] << 48) | self._static_rank(id))
+            return [(scores[id], id, self.docs[id][0]) for id in ranked[offset:]], len(scores)
+
+class MemoryBackend:
+
+    def __init__(self, refresh_seconds=5):
+        self.refresh_seconds = refresh_seconds
+        self.indexes = {resource: InvertedIndex() for resource in SEARCH_FIELDS}
+        self.positions = {}     # resource -> seq of the change feed the index is up to date with
+        self.checked = {}
+        self._lock = threading.Lock()
+
+    def _rows(self, model, statement):
+        fields = SEARCH_FIELDS[resource_of(model)][1]
+        result = db.session.execute(statement, execution_options={'stream_results': True})
+        for batch in result.partitions(5000):
+            for row in batch:
+                yield row.id, row.name, ' '.join(getattr(row, field) or '' for field in fields)
+
+    def _select(self, model):
+        fields = SEARCH_FIELDS[resource_of(model)][1]
+        return select(model.id, *[getattr(model, field) for field in set(fields) | {'name'}])
+
+    def sync(self, resource, force=False):
+        """Brings the index of a resource up to date, at most every refresh_seconds."""
+        now = time.monotonic()
+        if not force and now - self.checked.get(resource, -self.refresh_seconds) < self.refresh_seconds:
+            return
+        with self._lock:
+            model = SEARCH_FIELDS[resource][0]
+            self.checked[resource] = now
+            position = self.positions.get(resource)
+            if position is None:
+                self.rebuild(resource)
+                return
+            # ids inserted, updated or deleted since the last sync
+            changed = set()
+            try:
+                while True:
+                    rows = db.session.execute(CHANGES, {"since": position, "limit": SYNC_BATCH + 1}).all()
+                    found = batch(rows, position, SYNC_BATCH, {model.__tablename__}, change_feed.gap_seconds)
+                    changed.update(change['id'] for change in found.changes)
+                    position = found.next
+                    if not found.more:
+                        break
+            except APIException:
+                # the changes since the last sync were pruned
+                self.rebuild(resource)
+                return
+            index = self.indexes[resource]
+            ids = sorted(changed)
+            for start in range(0, len(ids), SYNC_BATCH):
+                chunk = ids[start:start + SYNC_BATCH]
+                present = set()
+                for id, name, text in self._rows(model, self._select(model).where(model.id.in_(chunk))):
+                    index.add(id, name, text)
+                    present.add(id)
+                for id in set(chunk) - present:
+                    index.remove(id)
+            self.positions[resource] = position
+
+    def rebuild(self, resource):
+        # read first: what commits during the load is applied again by the next sync
+        position = change_feed.current()
+        # built on the side and swapped, searches keep using the old index meanwhile
+        model = SEARCH_FIELDS[resource][0]
+        index = InvertedIndex()
+        index.bulk_load(self._rows(model, self._select(model)))
+        self.indexes[resource] = index
+        self.positions[resource] = position
+
+    def add(self, row):
+        resource = resource_of(type(row))
+        if resource is not None:
+            self.indexes[resource].add(row.id, row.name, document_text(type(row), row))
+
+    def remove(self, row):
+        resource = resource_of(type(row))
+        if resource is not None:
+            self.indexes[resource].remove(row.id)
+
+    def search(self, resource, terms, limit, offset):
+        self.sync(resource)
+        results, total = self.indexes[resource].search(terms, limit, offset)
+        return [{"type": resource, "id": id, "name": name, "score": float(score)} for score, id, name in results], total
+
+class PostgresBackend:
+
+    @staticmethod
+    def vector(model):
+        fields = SEARCH_FIELDS[resource_of(model)][1]
+        # must stay identical to the expression of the ix_<table>_search indexes
+        document = func.coalesce(getattr(model, fields[0]), '')
+        for field in fields[1:]:
+            document = document + ' ' + func.coalesce(getattr(model, field), '')
+        return func.to_tsvector('simple', document)
+
+    def search(self, resource, terms, limit, offset):
+        model = SEARCH_FIELDS[resource][0]
+        vector = self.vector(model)
+        query = func.to_tsquery('simple', ' & '.join(term + ':*' for term in terms))
+        rank = func.ts_rank(vector, query).label('score')
+        matches = vector.op('@@')(query)
+        statement = select(model.id, model.name, rank).where(matches).order_by(desc('score'), model.id).limit(limit).offset(offset)
+        total = db.session.execute(select(func.count()).select_from(model).where(matches)).scalar()
+        rows = db.session.execute(statement).all()
+        return [{"type": resource, "id": row.id, "name": row.name, "score": float(row.score)} for row in rows], total
+
+    def add(self, row):
+        pass
+
+    def remove(self, row):
+        pass
+
+class MySQLBackend(PostgresBackend):
+
+    def search(self, resource, terms, limit, offset):
+        from sqlalchemy.dialects.mysql import match
+        model, fields = SEARCH_FIELDS[resource]
+        query = ' '.join('+' + term + '*' for term in terms)
+        # the column list must be the one of the FULLTEXT index
+        relevance = match(*[getattr(model, field) for field in fields], against=query).in_boolean_mode()
+        statement = select(model.id, model.name, relevance.label('score')).where(relevance).order_by(desc('score'), model.id).limit(limit).offset(offset)
+        total = db.session.execute(select(func.count()).select_from(model).where(relevance)).scalar()
+        rows = db.session.execute(statement).all()
+        return [{"type": resource, "id": row.id, "name": row.name, "score": float(row.score)} for row in rows], total
+
+class SearchEngine:
+
+    def __init__(self):
+        self._backend = None
+        self.setting = 'auto'
+        self.refresh_seconds = 5
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            dialect = db.engine.dialect.name
+            if self.setting != 'memory' and dialect == 'postgresql':
+                self._backend = PostgresBackend()
+            elif self.setting != 'memory' and dialect == 'mysql':
+                self._backend = MySQLBackend()
+            else:
+                self._backend = MemoryBackend(self.refresh_seconds)
+        return self._backend
+
+    def search(self, q, resources=None, limit=20, offset=0):
+        """
+        Ranked matches of every word of `q` (as a prefix) across resources,
+        returns (results, total).
+        """
+        terms = tokenize(q)
+        if not terms:
+            return [], 0
+        resources = resources or list(SEARCH_FIELDS)
+        results, total = [], 0
+        for resource in resources:
+            # every resource is asked for the first offset+limit rows, then merged
+            found, count = self.backend.search(resource, terms, offset + limit, 0)
+            results.extend(found)
+            total += count
+        results.sort(key=lambda r: (-r['score'], len(r['name']), r['type'], r['id']))
+        return results[offset:offset + limit], total
+
+    # keep the in-process index current on writes, no-ops with a native index
+    def add(self, row):
+        if self._backend is not None:
+            self._backend.add(row)
+
+    def remove(self, row):
+        if self._backend is not None:
+            self._backend.remove(row)
+
+search_engine = SearchEngine()
+
+def search_response():
+    """GET /search?q=luke&type=people,vehicle&limit=20&offset=0"""
+    q = request.args.get('q', '').strip()
+    if not q:
+        raise APIException("'q' is required", status_code=400)
+    resources = [r for r in request.args.get('type', '').split(',') if r] or None
+    unknown = set(resources or ()).difference(SEARCH_FIELDS)
+    if unknown:
+        raise APIException("Unknown type(s): %s" % ", ".join(sorted(unknown)), status_code=400)
+    limit = min(request.args.get('limit', 20, type=int), MAX_LIMIT)
+    offset = min(max(request.args.get('offset', 0, type=int), 0), MAX_OFFSET)
+    if limit < 1:
+        raise APIException("'limit' must be greater than 0", status_code=400)
+    results, total = search_engine.search(q, resources, limit, offset)
+    return jsonify({"query": q, "total": total, "limit": limit, "offset": offset, "results": results})
+
+def setup_search(app):
+    app.config.setdefault('SEARCH_BACKEND', os.environ.get('SEARCH_BACKEND', 'auto'))
+    app.config.setdefault('SEARCH_REFRESH_SECONDS', float(os.environ.get('SEARCH_REFRESH_SECONDS', 5)))
+    search_engine.setting = app.config['SEARCH_BACKEND']
+    search_engine.refresh_seconds = app.config['SEARCH_REFRESH_SECONDS']
+    return search_engine
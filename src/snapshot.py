@@ -0,0 +1,374 @@
+"""
+Read-only snapshot of the catalog (people, planets, vehicles) in process
+memory, for nodes that serve the catalog GETs without querying the database.
+
+    CATALOG_SNAPSHOT                    load the snapshot and serve the catalog
+                                        GETs from it (false)
+    CATALOG_SNAPSHOT_REFRESH_SECONDS    the table versions are checked this often,
+                                        a table that changed is reloaded (30)
+
+The tables are stored by column: integers and timestamps in array.array,
+text as an array of codes into the interned distinct values of the column
+(hair_color, climate, manufacturer, gender... repeat a lot), or as one UTF-8
+buffer and offsets when the values hardly repeat (names). No row object is
+ever built, pages are encoded straight from the columns by the serializers.
+Item GETs and listings in id order, with any filter of query.py, are answered
+from the snapshot; sorted listings and streamed exports still read the
+database. WSGI app only.
+
+With the app preloaded by the gunicorn master (see gunicorn.conf.py) the
+snapshot is loaded once before the workers fork and they share it copy on
+write: array and byte buffers hold no Python objects, reference counting
+never writes to them, so their pages stay shared. A table reloaded by a worker after a
+change is private to that worker.
+
+Writes made through this node show once the table is reloaded, it is meant
+for read-only nodes.
+"""
+import os
+import sys
+import time
+import bisect
+import datetime
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import Integer, DateTime
+from models import db, Character, Planet, Vehicle
+from utils import APIException, env_bool
+from serializers import serializer_for, dumps
+import conditional
+
+CATALOG = (Character, Planet, Vehicle)
+LOAD_BATCH_SIZE = 10000
+
+class TextColumn:
+    """Codes (array of H or I) into the interned distinct values, None is a value like the others."""
+    __slots__ = ('codes', 'values', 'index')
+
+    def __init__(self):
+        self.codes = array('I')
+        self.values = []
+        self.index = {}  # value -> code
+
+    def append(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(sys.intern(value) if value is not None else None)
+        self.codes.append(code)
+
+    def seal(self):
+        """The column to keep once loaded: this one, or a BlobColumn when most values are distinct (names)."""
+        self.index = None  # only needed while loading
+        if len(self.values) > len(self.codes) // 2:
+            return BlobColumn(self.values[code] for code in self.codes)
+        if len(self.values) <= 0xffff:
+            self.codes = array('H', self.codes)
+        return self
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    def matching(self, test):
+        """Codes of the distinct values that pass `test`, tested once per value instead of per row."""
+        return frozenset(code for code, value in enumerate(self.values) if value is not None and test(value))
+
+    def nbytes(self):
+        return self.codes.itemsize * len(self.codes) + sys.getsizeof(self.values) + sum(map(sys.getsizeof, self.values))
+
+class BlobColumn:
+    """
+    Text that hardly repeats, as one UTF-8 buffer and the offsets of the values:
+    no object (and its ~50 bytes of header) per row, and nothing that
+    reference counting writes to.
+    """
+    __slots__ = ('data', 'offsets', 'nulls')
+
+    def __init__(self, values):
+        parts, offsets, nulls, end = [], array('Q', [0]), set(), 0
+        for i, value in enumerate(values):
+            if value is None:
+                nulls.add(i)
+            else:
+                value = value.encode()
+                parts.append(value)
+                end += len(value)
+            offsets.append(end)
+        self.data = b''.join(parts)
+        self.offsets = offsets
+        self.nulls = frozenset(nulls)
+
+    def __getitem__(self, i):
+        if self.nulls and i in self.nulls:
+            return None
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode()
+
+    def nbytes(self):
+        return len(self.data) + self.offsets.itemsize * len(self.offsets) + sys.getsizeof(self.nulls)
+
+class NumberColumn:
+    """Integers, or timestamps as POSIX seconds (the serializers' http_date takes both)."""
+    __slots__ = ('data', 'nulls', 'is_date')
+
+    def __init__(self, is_date=False):
+        self.data = array('d' if is_date else 'q')
+        self.nulls = set()  # positions of the NULLs, stored as 0
+        self.is_date = is_date
+
+    def append(self, value):
+        if value is None:
+            self.nulls.add(len(self.data))
+            value = 0
+        elif self.is_date:
+            value = value.replace(tzinfo=datetime.timezone.utc).timestamp()
+        self.data.append(value)
+
+    def seal(self):
+        self.nulls = frozenset(self.nulls)
+        return self
+
+    def __getitem__(self, i):
+        if self.nulls and i in self.nulls:
+            return None
+        return self.data[i]
+
+    def nbytes(self):
+        return self.data.itemsize * len(self.data) + sys.getsizeof(self.nulls)
+
+COMPARE = {
+    'eq': lambda a, b: a == b,
+    'ne': lambda a, b: a != b,
+    'gt': lambda a, b: a > b,
+    'gte': lambda a, b: a >= b,
+    'lt': lambda a, b: a < b,
+    'lte': lambda a, b: a <= b
+}
+
+class TableSnapshot:
+    __slots__ = ('model', 'names', 'columns', 'ids', 'version', 'loaded_at', 'checked_at', 'like_ignores_case')
+
+    def __init__(self, model, version):
+        self.model = model
+        self.names = serializer_for(model).names
+        self.columns = {}
+        for column in model.__table__.columns:
+            if column.key not in self.names:
+                continue
+            if isinstance(column.type, (Integer, DateTime)):
+                self.columns[column.key] = NumberColumn(isinstance(column.type, DateTime))
+            else:
+                self.columns[column.key] = TextColumn()
+        self.ids = self.columns['id'].data
+        self.version = version
+        self.like_ignores_case = False
+        self.loaded_at = self.checked_at = time.monotonic()
+
+    @classmethod
+    def load(cls, model, connection):
+        version = tuple(connection.execute(conditional.version_statement(model)).one())
+        snapshot = cls(model, version)
+        # prefixes (?name=) match like the database does, see query.py
+        snapshot.like_ignores_case = connection.dialect.name == 'mysql'
+        columns = [snapshot.columns[name] for name in snapshot.names]
+        statement = serializer_for(model).select(snapshot.names).order_by(model.id)
+        result = connection.execution_options(stream_results=True).execute(statement)
+        for batch in result.partitions(LOAD_BATCH_SIZE):
+            for row in batch:
+                for column, value in zip(columns, row):
+                    column.append(value)
+        for name in snapshot.names:
+            snapshot.columns[name] = snapshot.columns[name].seal()
+        return snapshot
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nbytes(self):
+        return sum(column.nbytes() for column in self.columns.values())
+
+    def row(self, i, names):
+        columns = self.columns
+        return tuple(columns[name][i] for name in names)
+
+    def item(self, id):
+        """(JSON body, last modified) of the row, 404 when there is none."""
+        i = bisect.bisect_left(self.ids, id)
+        if i == len(self.ids) or self.ids[i] != id:
+            raise APIException("%s %s not found" % (self.model.__name__, id), status_code=404)
+        column = conditional.timestamp_column(self.model)
+        stamp = self.columns[column.key][i] if column is not None else None
+        last_modified = None if stamp is None else datetime.datetime.fromtimestamp(stamp, datetime.timezone.utc)
+        return dumps(serializer_for(self.model).encoder()(self.row(i, self.names))), last_modified
+
+    def prefix_test(self, prefix):
+        if self.like_ignores_case:
+            prefix = prefix.lower()
+            return lambda v: v.lower().startswith(prefix)
+        return lambda v: v.startswith(prefix)
+
+    def test(self, name, op, value):
+        """`test(i)` of a filter of query.py, None when no row can match."""
+        column = self.columns[name]
+        if isinstance(column, TextColumn):
+            if op in ('null', 'notnull'):
+                codes = frozenset(c for c, v in enumerate(column.values) if v is None)
+                if op == 'notnull':
+                    codes = frozenset(range(len(column.values))) - codes
+            elif op == 'in':
+                wanted = set(value)
+                codes = column.matching(lambda v: v in wanted)
+            elif op == 'prefix':
+                codes = column.matching(self.prefix_test(value))
+            else:
+                compare = COMPARE[op]
+                codes = column.matching(lambda v: compare(v, value))
+            if not codes:
+                return None
+            data = column.codes
+            if len(codes) == 1:
+                code, = codes
+                return lambda i: data[i] == code
+            return lambda i: data[i] in codes
+        if isinstance(column, BlobColumn):
+            # decoded row by row, mostly names: few filters use them besides ?name=
+            if op in ('null', 'notnull'):
+                nulls = column.nulls
+                return (lambda i: i in nulls) if op == 'null' else (lambda i: i not in nulls)
+            if op == 'in':
+                wanted = set(value)
+                match = lambda v: v in wanted
+            elif op == 'prefix':
+                match = self.prefix_test(value)
+            else:
+                compare = COMPARE[op]
+                match = lambda v: compare(v, value)
+            return lambda i: (lambda v: v is not None and match(v))(column[i])
+        nulls, data = column.nulls, column.data
+        if op == 'null':
+            return None if not nulls else lambda i: i in nulls
+        if op == 'notnull':
+            return lambda i: i not in nulls
+        if column.is_date:
+            as_stamp = lambda v: v.replace(tzinfo=datetime.timezone.utc).timestamp()
+            value = [as_stamp(v) for v in value] if op == 'in' else as_stamp(value)
+        if op == 'in':
+            wanted = set(value)
+            return lambda i: data[i] in wanted and i not in nulls
+        compare = COMPARE[op]
+        return lambda i: compare(data[i], value) and i not in nulls
+
+    def rows(self, query, count, cursor):
+        """
+        Up to `count` rows (tuples of query.columns) of a listing in id order,
+        scanning from the cursor. None for the shapes the snapshot doesn't answer.
+        """
+        if len(query.sort) != 1:
+            return None
+        tests = []
+        for name, op in query.filters:
+            test = self.test(name, op, query.params.get('%s__%s' % (name, op)))
+            if test is None:
+                return []
+            tests.append(test)
+        descending = query.sort[0][1]
+        ids = self.ids
+        if not cursor:
+            positions = range(len(ids) - 1, -1, -1) if descending else range(len(ids))
+        elif descending:
+            positions = range(bisect.bisect_left(ids, query.params['cursor_0']) - 1, -1, -1)
+        else:
+            positions = range(bisect.bisect_right(ids, query.params['cursor_0']), len(ids))
+        rows = []
+        for i in positions:
+            if all(test(i) for test in tests):
+                rows.append(self.row(i, query.columns))
+                if len(rows) == count:
+                    break
+        return rows
+
+class Catalog:
+
+    def __init__(self):
+        self.enabled = False
+        self.refresh_seconds = 30
+        self.tables = {}  # model -> TableSnapshot
+        self.app = None
+        self.reloads = 0
+        self.pid = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def load(self, models=CATALOG):
+        """Loads the tables (in an app context), replacing their snapshots."""
+        # a connection of its own, the session of the current request is left alone
+        with db.engine.connect() as connection:
+            for model in models:
+                self.tables[model] = TableSnapshot.load(model, connection)
+                self.reloads += 1
+
+    def refresh(self, model):
+        with self.app.app_context():
+            try:
+                snapshot = self.tables[model]
+                with db.engine.connect() as connection:
+                    version = tuple(connection.execute(conditional.version_statement(model)).one())
+                if version != snapshot.version:
+                    self.load([model])
+                else:
+                    snapshot.checked_at = time.monotonic()
+            except Exception:
+                self.app.logger.warning("refreshing the %s snapshot failed", model.__tablename__, exc_info=True)
+
+    def table(self, model):
+        """The snapshot of a catalog table, None when snapshots are off."""
+        if not self.enabled or model not in CATALOG:
+            return None
+        snapshot = self.tables.get(model)
+        if snapshot is None:
+            with self._lock:
+                if model not in self.tables:
+                    # not preloaded (or it failed): the first request loads the tables
+                    self.load()
+            snapshot = self.tables[model]
+        if time.monotonic() - snapshot.checked_at >= self.refresh_seconds:
+            snapshot.checked_at = time.monotonic()  # one refresh at a time
+            self.executor().submit(self.refresh, model)
+        return snapshot
+
+    def executor(self):
+        # threads don't survive a fork, each worker starts its own
+        if self.pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='catalog-snapshot')
+            self.pid = os.getpid()
+        return self._executor
+
+    def version(self, model):
+        snapshot = self.table(model)
+        return snapshot.version if snapshot is not None else None
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "reloads": self.reloads,
+            "tables": {model.__tablename__: {"rows": len(snapshot), "bytes": snapshot.nbytes(),
+                                             "age": round(time.monotonic() - snapshot.loaded_at, 1)}
+                       for model, snapshot in self.tables.items()}
+        }
+
+catalog = Catalog()
+
+def setup_snapshot(app):
+    app.config.setdefault('CATALOG_SNAPSHOT', env_bool('CATALOG_SNAPSHOT', 'false'))
+    app.config.setdefault('CATALOG_SNAPSHOT_REFRESH_SECONDS', float(os.environ.get('CATALOG_SNAPSHOT_REFRESH_SECONDS', 30)))
+    catalog.enabled = app.config['CATALOG_SNAPSHOT']
+    catalog.refresh_seconds = app.config['CATALOG_SNAPSHOT_REFRESH_SECONDS']
+    catalog.app = app
+    for model in CATALOG:
+        # ETags, Last-Modified and the collection cache follow the version of the snapshot
+        if catalog.enabled:
+            conditional.version_sources[model] = catalog.version
+        else:
+            conditional.version_sources.pop(model, None)
+    app.extensions['catalog_snapshot'] = catalog
+    return catalog
@@ -1,5 +1,10 @@
+import os
 from flask import jsonify, url_for
 
+def env_bool(name, default):
+    """An environment variable read as a flag: 1, true, yes, on (any case) are true."""
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes', 'on')
+
 class APIException(Exception):
     status_code = 400
 
@@ -21,7 +26,7 @@ def has_no_empty_params(rule):
     return len(defaults) >= len(arguments)
 
 def generate_sitemap(app):
-    links = ['/admin/']
+    links = ['/admin/'] if app.config.get('ENABLE_ADMIN') else []
     for rule in app.url_map.iter_rules():
         # Filter out rules we can't navigate to in a browser
         # and rules that require parameters
@@ -0,0 +1,76 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('RATELIMIT_ENABLED', 'false')
+
+import pytest
+from sqlalchemy import event, create_engine
+from main import create_app
+from models import db
+from search import search_engine
+from popularity import leaderboards
+from snapshot import catalog
+from changes import change_feed
+
+@pytest.fixture
+def make_app(tmp_path):
+    """
+    make_app(**config): the API on a SQLite file of tmp_path (`database`, test.db by default)
+    created with db.create_all (change_log triggers included), the module level state
+    filled from the database of a previous test reset.
+    """
+    apps = []
+
+    def make(database='test.db', **config):
+        settings = {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / database), 'ENABLE_ADMIN': False,
+                    'COLLECTION_CACHE_REVALIDATE_SECONDS': 0, 'ENTITY_CACHE_REVALIDATE_SECONDS': 0,
+                    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000'}
+        settings.update(config)
+        app = create_app(settings)
+        with app.app_context():
+            db.create_all()
+        search_engine._backend = None
+        leaderboards.reset()
+        catalog.tables = {}
+        change_feed.latest = 0
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        with app.app_context():
+            db.session.remove()
+            for engine in db.get_binds().values():
+                engine.dispose()
+            db.engine.dispose()
+    catalog.tables = {}
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def statements(app):
+    """The SQL statements run by the app's engine, appended as they run."""
+    run = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        run.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    yield run
+    event.remove(engine, 'before_cursor_execute', record)
+
+def out_of_band(app, statement):
+    """Runs `statement` through an engine of its own, like another process would."""
+    engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+    with engine.begin() as connection:
+        connection.exec_driver_sql(statement)
+    engine.dispose()
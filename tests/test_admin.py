@@ -0,0 +1,37 @@
+from admin import create_admin_app
+from models import db, User, Character, FavoriteCharacter, FavoriteCount
+
+def favorites_of_luke():
+    row = FavoriteCount.query.filter_by(entity_type='people', entity_id=1).first()
+    return row.favorites if row is not None else 0
+
+def test_admin_favorites_are_counted(app):
+    with app.app_context():
+        db.session.add_all([User(first_name='Leia', last_name='Organa', email='leia@example.com', password='x'),
+                            Character(name='Luke', birth_year='19BBY')])
+        db.session.commit()
+    admin = create_admin_app(app).test_client()
+    assert admin.post('/favoritecharacter/new/', data={'user': '1', 'character': '1'}).status_code == 302
+    # a duplicate fails on the unique index, nothing is counted
+    admin.post('/favoritecharacter/new/', data={'user': '1', 'character': '1'})
+    with app.app_context():
+        assert FavoriteCharacter.query.count() == 1 and favorites_of_luke() == 1
+    assert admin.post('/favoritecharacter/delete/', data={'id': '1'}).status_code == 302
+    # already deleted: the second request removes nothing and uncounts nothing
+    admin.post('/favoritecharacter/delete/', data={'id': '1'})
+    with app.app_context():
+        assert FavoriteCharacter.query.count() == 0 and favorites_of_luke() == 0
+
+def test_admin_user_edit_refreshes_the_api(app, client):
+    with app.app_context():
+        db.session.add(User(first_name='Leia', last_name='Organa', email='leia@example.com', password='x'))
+        db.session.commit()
+    app.config['COLLECTION_CACHE_REVALIDATE_SECONDS'] = 60
+    assert client.get('/user/1').json['first_name'] == 'Leia'
+    assert client.get('/user').json[0]['first_name'] == 'Leia'
+    admin = create_admin_app(app).test_client()
+    form = {'first_name': 'General', 'last_name': 'Organa', 'email': 'leia@example.com', 'password': 'x',
+            'join_date': '2026-10-18 10:00:00'}
+    assert admin.post('/user/edit/?id=1', data=form).status_code == 302
+    assert client.get('/user/1').json['first_name'] == 'General'
+    assert client.get('/user').json[0]['first_name'] == 'General'
@@ -0,0 +1,87 @@
+import json
+import asyncio
+import pytest
+import asgi
+from models import db, Vehicle
+from conftest import out_of_band
+from ratelimit import rate_limiter, configure_ratelimit
+
+async def call(method, path, body=None, headers=(), client='127.0.0.1'):
+    """(status, headers, body) of a request to the ASGI app, without a server."""
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+             'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+             'headers': [(b'host', b'testserver')] + [(k.lower().encode(), v.encode()) for k, v in headers],
+             'client': (client, 50000), 'server': ('testserver', 80)}
+    payload = b'' if body is None else json.dumps(body).encode()
+    if body is not None:
+        scope['headers'].append((b'content-type', b'application/json'))
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': payload, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi.app(scope, receive, send)
+    start = messages[0]
+    return (start['status'], {k.decode(): v.decode() for k, v in start['headers']},
+            b''.join(message.get('body', b'') for message in messages[1:]))
+
+@pytest.fixture
+def served(app, monkeypatch):
+    """Runs a coroutine taking `call` against the ASGI app on the database of `app`, inside its lifespan."""
+    monkeypatch.setenv('DB_CONNECTION_STRING', app.config['SQLALCHEMY_DATABASE_URI'])
+
+    def run(test):
+        async def main():
+            async with asgi.lifespan(asgi.app):
+                await test()
+        asyncio.run(main())
+    return run
+
+def test_items_follow_writes_of_other_processes(app, served):
+    with app.app_context():
+        db.session.add(Vehicle(name='Speeder', model='74-Z', manufacturer='Aratech', cost_in_credits=8000, length=3,
+                               cargo_capacity=4))
+        db.session.commit()
+
+    async def test():
+        status, headers, body = await call('GET', '/vehicle/1')
+        assert status == 200 and json.loads(body)['name'] == 'Speeder'
+        # the WSGI app, the admin or a job
+        out_of_band(app, "UPDATE vehicle SET name = 'Skiff' WHERE id = 1")
+        status, _, body = await call('GET', '/vehicle/1', headers=[('If-None-Match', headers['etag'])])
+        assert status == 200 and json.loads(body)['name'] == 'Skiff'
+    served(test)
+
+def test_writes_are_rate_limited(app, served):
+    configure_ratelimit({'RATELIMIT_ENABLED': True})
+    rate_limiter.decode = asgi.decode_claims
+
+    async def test():
+        for remaining in range(4, -1, -1):
+            status, headers, _ = await call('POST', '/user', body={})
+            assert status == 400 and headers['ratelimit-limit'] == '5' and headers['ratelimit-remaining'] == str(remaining)
+        status, headers, body = await call('POST', '/user', body={})
+        assert status == 429 and int(headers['retry-after']) >= 1 and b'Too many requests' in body
+        # another client has a bucket of its own, the reads are not limited
+        status, _, _ = await call('POST', '/user', body={}, client='10.0.0.2')
+        assert status == 400
+        status, headers, _ = await call('GET', '/user')
+        assert status == 200 and 'ratelimit-limit' not in headers
+    try:
+        served(test)
+    finally:
+        configure_ratelimit({'RATELIMIT_ENABLED': False})
+
+def test_health_hides_the_driver_error(tmp_path, monkeypatch, caplog):
+    monkeypatch.setenv('DB_CONNECTION_STRING', 'sqlite:///' + str(tmp_path / 'missing' / 'secret.db'))
+
+    async def main():
+        async with asgi.lifespan(asgi.app):
+            return await call('GET', '/health/db')
+    status, _, body = asyncio.run(main())
+    assert status == 503 and json.loads(body)['error'] == 'database unreachable' and b'secret' not in body
+    assert any(record.exc_info for record in caplog.records if 'health check' in record.getMessage())
@@ -0,0 +1,31 @@
+import auth
+from auth import hasher
+
+def test_login(client):
+    user = {"first_name": "Han", "last_name": "Solo", "email": "han@example.com", "password": "falcon"}
+    assert client.post('/user', json=user).status_code == 200
+    response = client.post('/token', json={"email": "han@example.com", "password": "falcon"})
+    assert response.status_code == 200 and response.json['user_id'] == 1
+    assert client.post('/token', json={"email": "han@example.com", "password": "wrong"}).status_code == 401
+
+def test_login_rejects_non_string_credentials(client):
+    bodies = ({"email": "han@example.com", "password": 1234}, {"email": ["han"], "password": "x"}, {"email": "han@example.com"})
+    for body in bodies:
+        assert client.post('/token', json=body).status_code == 400
+
+def test_unknown_email_is_hashed_too(client, monkeypatch):
+    checked = []
+    check_password_hash = auth.check_password_hash
+
+    def check(stored, password):
+        checked.append(password)
+        return check_password_hash(stored, password)
+
+    monkeypatch.setattr(auth, 'check_password_hash', check)
+    assert client.post('/token', json={"email": "nobody@example.com", "password": "guess"}).status_code == 401
+    assert checked == ["guess"]
+
+def test_configure_shuts_the_previous_pool_down(app):
+    pool = hasher._pool
+    hasher.configure(app.config['PASSWORD_HASH_METHOD'])
+    assert pool._shutdown and hasher._pool is not pool
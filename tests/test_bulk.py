@@ -0,0 +1,52 @@
+import json
+from models import db, Character, Job
+from jobs import Worker
+from conftest import out_of_band
+
+def people(*names):
+    return [{"name": name, "birth_year": "19BBY"} for name in names]
+
+def names(app):
+    with app.app_context():
+        return [name for name, in db.session.query(Character.name).order_by(Character.id)]
+
+def test_invalid_rows_are_reported_the_others_inserted(app, client):
+    items = people('Luke', 'Leia') + [{"birth_year": "19BBY"}, {"name": "Han", "birth_year": "29BBY", "gender": 7}]
+    response = client.post('/people/bulk', json=items)
+    assert response.status_code == 200
+    assert response.json == {"inserted": 3, "failed": 1, "errors": [{"index": 2, "errors": {"name": "is required"}}]}
+    assert names(app) == ['Luke', 'Leia', 'Han']
+    assert client.post('/people/bulk', json={"name": "Luke"}).status_code == 400
+
+def test_a_batch_rejected_by_the_database_is_retried_row_by_row(app, client):
+    out_of_band(app, "CREATE TRIGGER reject_vader BEFORE INSERT ON character WHEN NEW.name = 'Vader' "
+                     "BEGIN SELECT RAISE(ABORT, 'no sith'); END")
+    response = client.post('/people/bulk?batch_size=2', json=people('Luke', 'Vader', 'Leia', 'Han', 'Yoda'))
+    assert response.json['inserted'] == 4 and response.json['failed'] == 1
+    assert response.json['errors'][0]['index'] == 1 and 'no sith' in response.json['errors'][0]['errors']['_']
+    # the rows of the failed batch around the bad one, and the next batches, are in
+    assert names(app) == ['Luke', 'Leia', 'Han', 'Yoda']
+
+def test_ndjson_body(app, client):
+    body = '\n'.join(json.dumps(item) for item in people('Luke', 'Leia')) + '\n{"name": oops\n\n' + json.dumps(people('Han')[0])
+    response = client.post('/people/bulk', data=body, content_type='application/x-ndjson')
+    assert response.json['inserted'] == 3
+    assert [error['index'] for error in response.json['errors']] == [2]
+    assert names(app) == ['Luke', 'Leia', 'Han']
+
+def test_async_import_is_queued_once_per_idempotency_key(app, client):
+    headers = {'Prefer': 'respond-async', 'Idempotency-Key': 'import-1'}
+    first = client.post('/people/bulk', json=people('Luke', 'Leia'), headers=headers)
+    retry = client.post('/people/bulk', json=people('Luke', 'Leia'), headers=headers)
+    assert first.status_code == retry.status_code == 202
+    assert first.json['id'] == retry.json['id']
+    assert first.headers['Location'].endswith('/jobs/%d' % first.json['id'])
+    assert first.json['status'] == 'queued' and names(app) == []
+    with app.app_context():
+        assert Job.query.count() == 1
+        Worker().work(once=True)
+    job = client.get(first.headers['Location']).json
+    assert job['status'] == 'done' and job['result']['inserted'] == 2
+    assert names(app) == ['Luke', 'Leia']
+    long_key = client.post('/people/bulk', json=[], headers={'Prefer': 'respond-async', 'Idempotency-Key': 'k' * 201})
+    assert long_key.status_code == 400
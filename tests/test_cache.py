@@ -0,0 +1,36 @@
+from models import db, Vehicle
+from cache import entity_cache, DictBackend
+from conftest import out_of_band
+
+def add_speeder(app):
+    with app.app_context():
+        db.session.add(Vehicle(name='Speeder', model='74-Z', manufacturer='Aratech', cost_in_credits=8000, length=3,
+                               cargo_capacity=4))
+        db.session.commit()
+
+def test_cached_entity_dropped_after_out_of_band_update(app, client):
+    add_speeder(app)
+    first = client.get('/vehicle/1')
+    assert client.get('/vehicle/1').headers['ETag'] == first.headers['ETag']
+    assert entity_cache.local.hits == 1
+    # another worker, a job or raw SQL: only the change feed tells
+    out_of_band(app, "UPDATE vehicle SET name = 'Skiff' WHERE id = 1")
+    second = client.get('/vehicle/1', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200 and second.json['name'] == 'Skiff'
+
+def test_shared_entries_are_dropped_too(app, client):
+    entity_cache.shared = DictBackend()
+    add_speeder(app)
+    client.get('/vehicle/1')
+    out_of_band(app, "UPDATE vehicle SET name = 'Skiff' WHERE id = 1")
+    assert client.get('/vehicle/1').json['name'] == 'Skiff'
+    assert b'Skiff' in entity_cache.shared.get(entity_cache.key(Vehicle, 1))
+
+def test_entries_are_kept_between_checks(app, client):
+    app.config['ENTITY_CACHE_REVALIDATE_SECONDS'] = entity_cache.revalidate_seconds = 60
+    add_speeder(app)
+    client.get('/vehicle/1')
+    out_of_band(app, "UPDATE vehicle SET name = 'Skiff' WHERE id = 1")
+    assert client.get('/vehicle/1').json['name'] == 'Speeder'
+    entity_cache.checked_at -= 60
+    assert client.get('/vehicle/1').json['name'] == 'Skiff'
@@ -0,0 +1,83 @@
+import time
+import datetime
+import threading
+from models import db, Character, Planet
+from changes import change_feed
+from conftest import out_of_band
+
+def add_people(app, *names):
+    with app.app_context():
+        db.session.add_all([Character(name=name, birth_year='19BBY') for name in names])
+        db.session.commit()
+
+def test_changes_are_read_in_pages(app, client):
+    add_people(app, 'Luke', 'Leia', 'Han')
+    with app.app_context():
+        db.session.add(Planet(name='Hoth', orbital_period=549, gravity='1.1 standard', population=0, climate='frozen'))
+        db.session.commit()
+    first = client.get('/changes?since=0&limit=2').json
+    assert [(c['type'], c['id'], c['op']) for c in first['changes']] == [('people', 1, 'insert'), ('people', 2, 'insert')]
+    assert first['more'] is True
+    second = client.get('/changes?since=%d&limit=2' % first['next']).json
+    assert [(c['type'], c['id']) for c in second['changes']] == [('people', 3), ('planet', 1)] and second['more'] is False
+    assert client.get('/changes?since=0&type=planet').json['changes'][0]['type'] == 'planet'
+    assert client.get('/changes?since=0&type=starship').status_code == 400
+    assert client.get('/changes?since=now').json == {"changes": [], "next": second['next'], "more": False}
+
+def test_a_gap_holds_the_changes_after_it_back(app, client):
+    add_people(app, 'Luke')
+    since = client.get('/changes?since=now').json['next']
+    # seq since + 1 is allocated by a transaction that has not committed yet
+    out_of_band(app, "INSERT INTO change_log (seq, entity_type, entity_id, op, created) "
+                     "VALUES (%d, 'character', 1, 'update', CURRENT_TIMESTAMP)" % (since + 2))
+    held = client.get('/changes?since=%d' % since).json
+    assert held == {"changes": [], "next": since, "more": False}
+    # once the change after the gap is CHANGES_GAP_SECONDS old, the transaction is taken as rolled back
+    out_of_band(app, "UPDATE change_log SET created = datetime('now', '-%d seconds') WHERE seq = %d"
+                % (change_feed.gap_seconds + 1, since + 2))
+    assert [c['seq'] for c in client.get('/changes?since=%d' % since).json['changes']] == [since + 2]
+
+def test_consumers_behind_a_prune_get_a_410(app, client):
+    add_people(app, 'Luke', 'Leia')
+    with app.app_context():
+        assert change_feed.prune(before=datetime.datetime.utcnow() + datetime.timedelta(seconds=1)) == 1
+    assert client.get('/changes?since=0').status_code == 410
+    assert client.get('/changes?since=0', headers={'Accept': 'text/event-stream'}).status_code == 410
+    latest = client.get('/changes?since=now').json['next']
+    assert client.get('/changes?since=%d' % latest).status_code == 200
+
+def test_long_poll_answers_on_the_next_commit(make_app):
+    app = make_app(CHANGES_POLL_SECONDS=0.05)
+    client = app.test_client()
+    since = client.get('/changes?since=now').json['next']
+    result = {}
+
+    def poll():
+        start = time.monotonic()
+        result['body'] = app.test_client().get('/changes?since=%d&wait=10' % since).json
+        result['elapsed'] = time.monotonic() - start
+
+    thread = threading.Thread(target=poll)
+    thread.start()
+    time.sleep(0.2)
+    add_people(app, 'Luke')
+    thread.join(10)
+    assert [c['id'] for c in result['body']['changes']] == [1]
+    assert 0.2 <= result['elapsed'] < 5
+    # nothing to wait for: an empty answer after ?wait=
+    start = time.monotonic()
+    assert client.get('/changes?since=%d&wait=1' % result['body']['next']).json['changes'] == []
+    assert time.monotonic() - start >= 1
+
+def test_event_stream_resumes_from_last_event_id(make_app):
+    app = make_app(CHANGES_STREAM_SECONDS=0.3, CHANGES_POLL_SECONDS=0.05)
+    client = app.test_client()
+    add_people(app, 'Luke', 'Leia')
+    response = client.get('/changes?since=0', headers={'Accept': 'text/event-stream'})
+    assert response.mimetype == 'text/event-stream'
+    events = response.get_data().split(b'\n\n')
+    assert events[0] == b'retry: 1000'
+    assert [event.split(b'\n')[0] for event in events[1:3]] == [b'id: 1', b'id: 2']
+    add_people(app, 'Han')
+    resumed = client.get('/changes', headers={'Accept': 'text/event-stream', 'Last-Event-ID': '2'}).get_data()
+    assert b'id: 3\nevent: change\n' in resumed and b'id: 2\n' not in resumed
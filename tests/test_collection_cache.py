@@ -0,0 +1,15 @@
+from models import db, Vehicle
+from conftest import out_of_band
+
+def test_cached_page_sees_out_of_band_update(app, client):
+    with app.app_context():
+        db.session.add(Vehicle(name='Speeder', model='74-Z', manufacturer='Aratech', cost_in_credits=8000, length=3,
+                               cargo_capacity=4))
+        db.session.commit()
+    first = client.get('/vehicle')
+    assert client.get('/vehicle').data == first.data  # served from the cached page
+    # same count, same max id, same created: only the change_log tells the page is stale
+    out_of_band(app, "UPDATE vehicle SET name = 'Skiff' WHERE id = 1")
+    second = client.get('/vehicle')
+    assert b'Skiff' in second.data and b'Speeder' not in second.data
+    assert second.headers['ETag'] != first.headers['ETag']
@@ -0,0 +1,17 @@
+from models import db, Vehicle, User
+from conftest import out_of_band
+
+def test_collection_etag_changes_on_update(app, client):
+    with app.app_context():
+        db.session.add(Vehicle(name='Speeder', model='74-Z', manufacturer='Aratech', cost_in_credits=8000, length=3,
+                               cargo_capacity=4))
+        db.session.add(User(first_name='Luke', last_name='Skywalker', email='luke@example.com', password='x'))
+        db.session.commit()
+    for path, table, column in (('/vehicle', 'vehicle', 'name'), ('/user', '"user"', 'first_name')):
+        first = client.get(path)
+        assert client.get(path, headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+        out_of_band(app, "UPDATE %s SET %s = 'changed' WHERE id = 1" % (table, column))
+        second = client.get(path, headers={'If-None-Match': first.headers['ETag']})
+        assert second.status_code == 200
+        assert second.headers['ETag'] != first.headers['ETag']
+        assert b'changed' in second.data
@@ -0,0 +1,26 @@
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from models import db
+from main import create_app
+from dbpool import dispose_after_fork
+
+def test_dispose_after_fork_keeps_the_parent_connections(app, monkeypatch):
+    # Engine.dispose as of SQLAlchemy 1.4.23 (Pipfile.lock), before its close argument
+    monkeypatch.setattr(Engine, 'dispose', lambda self: None)
+    with app.app_context():
+        parent = db.engine.connect()
+        pool = db.engine.pool
+    dispose_after_fork(app)
+    with app.app_context():
+        assert db.engine.pool is not pool
+        assert parent.execute(text('SELECT 1')).scalar() == 1  # not closed under the parent
+        with db.engine.connect() as connection:
+            assert connection.execute(text('SELECT 1')).scalar() == 1
+    parent.close()
+
+def test_health_hides_the_driver_error(tmp_path, caplog):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'missing' / 'secret.db'), 'ENABLE_ADMIN': False})
+    response = app.test_client().get('/health/db')
+    assert response.status_code == 503
+    assert response.json['error'] == 'database unreachable' and b'secret' not in response.data
+    assert any(record.exc_info for record in caplog.records if 'health check' in record.getMessage())
@@ -0,0 +1,44 @@
+import favorites
+from favorites import add_favorites, remove_favorites
+from models import db, User, Character, Planet, Vehicle, FavoriteCharacter, FavoritePlanet, FavoriteVehicle, FavoriteCount
+from conftest import out_of_band
+
+def test_user_favorites_query_count(app, client, statements):
+    with app.app_context():
+        db.session.add(User(first_name='Leia', last_name='Organa', email='leia@example.com', password='x'))
+        for i in range(5):
+            db.session.add_all([
+                Character(name='Character %d' % i, birth_year='19BBY'),
+                Planet(name='Planet %d' % i, orbital_period=304, gravity='1 standard', population=1000, climate='arid'),
+                Vehicle(name='Vehicle %d' % i, model='T-16', manufacturer='Incom', cost_in_credits=14500, length=10,
+                        cargo_capacity=50)
+            ])
+        db.session.flush()
+        for id in range(1, 6):
+            db.session.add_all([FavoriteCharacter(user_id=1, character_id=id), FavoritePlanet(user_id=1, planet_id=id),
+                                FavoriteVehicle(user_id=1, vehicle_id=id)])
+        db.session.commit()
+    del statements[:]
+    response = client.get('/user/1/favorites')
+    assert response.status_code == 200
+    assert [len(response.json[resource]) for resource in ('people', 'planet', 'vehicle')] == [5, 5, 5]
+    # the user, then one SELECT ... IN per favorite table joined with its entities
+    assert len([statement for statement in statements if statement.lstrip().upper().startswith('SELECT')]) == 4
+
+def test_concurrent_removal_is_uncounted_once(app, monkeypatch):
+    with app.app_context():
+        db.session.add_all([User(first_name='Leia', last_name='Organa', email='leia@example.com', password='x'),
+                            Character(name='Luke', birth_year='19BBY')])
+        db.session.commit()
+        add_favorites(1, {'people': {1}})
+        delete_statements = favorites.delete_statements
+
+        def racing(*args):
+            # another request removes the favorite between our SELECT and our DELETE
+            out_of_band(app, 'DELETE FROM "favorite-character"')
+            return delete_statements(*args)
+
+        monkeypatch.setattr(favorites, 'delete_statements', racing)
+        assert remove_favorites(1, {'people': {1}})['removed'] == 0
+        # the other request uncounts it, not this one
+        assert FavoriteCount.query.filter_by(entity_type='people', entity_id=1).one().favorites == 1
@@ -0,0 +1,88 @@
+import datetime
+import pytest
+from models import db, Job
+from jobs import task, enqueue, job_by_key, Worker
+
+calls = []
+
+@task('test_flaky')
+def flaky(payload):
+    calls.append(payload)
+    if len(calls) <= payload['failures']:
+        raise RuntimeError("attempt %d failed" % len(calls))
+    return {"calls": len(calls)}
+
+@task('test_once', max_attempts=1)
+def once(payload):
+    raise RuntimeError("not retried")
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+    del calls[:]
+
+def make_due(key):
+    job = job_by_key(key)
+    job.run_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    db.session.commit()
+
+def test_failed_job_is_retried_after_a_backoff(app):
+    with app.app_context():
+        key = enqueue('test_flaky', {"failures": 1})
+        db.session.commit()
+        worker = Worker()
+        worker.work(once=True)
+        job = job_by_key(key)
+        assert (job.status, job.attempts, worker.retried) == ('queued', 1, 1)
+        assert 'attempt 1 failed' in job.last_error
+        # JOB_BACKOFF_SECONDS (2) with a jitter of 0.5 to 1: not due before a second
+        assert job.run_at > datetime.datetime.utcnow() + datetime.timedelta(seconds=0.9)
+        worker.work(once=True)
+        assert job_by_key(key).attempts == 1
+        make_due(key)
+        worker.work(once=True)
+        job = job_by_key(key)
+        assert (job.status, job.attempts, job.serialize()['result']) == ('done', 2, {"calls": 2})
+
+def test_job_fails_after_its_attempts(make_app):
+    app = make_app(JOB_MAX_ATTEMPTS=2)
+    with app.app_context():
+        flaky_key = enqueue('test_flaky', {"failures": 5})
+        once_key = enqueue('test_once')
+        db.session.commit()
+        worker = Worker()
+        worker.work(once=True)
+        assert job_by_key(once_key).status == 'failed'  # max_attempts=1: never run twice
+        assert job_by_key(flaky_key).status == 'queued'
+        make_due(flaky_key)
+        worker.work(once=True)
+        job = job_by_key(flaky_key)
+        assert (job.status, job.attempts, job.max_attempts, worker.failed) == ('failed', 2, 2, 2)
+        assert job.serialize()['last_error'] == 'RuntimeError: attempt 2 failed'
+
+def test_lost_job_is_claimed_again_after_its_lock_expires(app):
+    with app.app_context():
+        key = enqueue('test_flaky', {"failures": 0})
+        db.session.commit()
+        # a worker claims it and dies before running it
+        assert [job.idempotency_key for job in Worker(name='dead').claim()] == [key]
+        other = Worker(name='alive')
+        assert other.claim() == []
+        job = job_by_key(key)
+        job.locked_at -= datetime.timedelta(seconds=app.config['JOB_LOCK_SECONDS'] + 1)
+        db.session.commit()
+        claimed = other.claim()
+        assert [job.idempotency_key for job in claimed] == [key] and claimed[0].locked_by.startswith('alive:')
+        other.run(claimed[0])
+        job = job_by_key(key)
+        assert (job.status, job.attempts) == ('done', 2)
+
+def test_enqueue_joins_the_transaction_of_the_caller(app):
+    with app.app_context():
+        enqueue('test_flaky', {"failures": 0}, key='rolled-back')
+        db.session.rollback()
+        enqueue('test_flaky', {"failures": 0}, key='same')
+        enqueue('test_flaky', {"failures": 0}, key='same')
+        db.session.commit()
+        assert [job.idempotency_key for job in Job.query.all()] == ['same']
+        with pytest.raises(KeyError):
+            enqueue('no_such_task')
@@ -0,0 +1,8 @@
+def test_token_routes_carry_security(client):
+    paths = client.get('/openapi.json').json['paths']
+    assert paths['/me/favorites']['get']['security'] == [{"bearerAuth": []}]
+    assert paths['/me/favorites']['post']['security'] == [{"bearerAuth": []}]
+    assert paths['/me/favorites']['delete']['security'] == [{"bearerAuth": []}]
+    assert paths['/user/favorite/people/{character_id}']['post']['security'] == [{"bearerAuth": []}]
+    assert 'security' not in paths['/people']['get']
+    assert 'security' not in paths['/token']['post']
@@ -0,0 +1,62 @@
+from urllib.parse import urlsplit
+from models import db, Character
+
+NAMES = ['Luke', 'Leia', 'Han', 'Chewbacca', 'Leia', 'Yoda', 'Han', 'Anakin']
+
+def add_people(app):
+    with app.app_context():
+        db.session.add_all([Character(name=name, birth_year='19BBY') for name in NAMES])
+        db.session.commit()
+
+def read_pages(client, url):
+    """Items of every page following the Link headers, and the X-Next-Cursor of each page."""
+    items, cursors = [], []
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        items.extend(response.json)
+        cursors.append(response.headers.get('X-Next-Cursor'))
+        link = response.headers.get('Link')
+        url = None
+        if link:
+            assert link.endswith('>; rel="next"')
+            next_url = urlsplit(link[1:link.index('>')])
+            url = next_url.path + '?' + next_url.query
+    return items, cursors
+
+def test_id_order_is_paged_after_the_last_id(app, client):
+    add_people(app)
+    items, cursors = read_pages(client, '/people?limit=3&fields=id,name')
+    assert [item['id'] for item in items] == list(range(1, 9))
+    assert cursors == ['3', '6', None]
+    # ?after= and the X-Next-Cursor value give the same page as the Link
+    assert [item['id'] for item in client.get('/people?limit=3&after=3').json] == [4, 5, 6]
+    assert [item['id'] for item in client.get('/people?limit=3&cursor=6').json] == [7, 8]
+
+def test_sorted_listing_pages_with_an_opaque_cursor(app, client):
+    add_people(app)
+    items, cursors = read_pages(client, '/people?sort=name&limit=3&fields=id,name')
+    # ties on name are broken by id, no row is repeated or skipped across pages
+    assert [(item['name'], item['id']) for item in items] == sorted((name, i) for i, name in enumerate(NAMES, 1))
+    assert len(cursors) == 3 and cursors[-1] is None
+    assert not any(cursor.isdigit() for cursor in cursors[:-1])
+
+    items, _ = read_pages(client, '/people?sort=-name&limit=2&fields=id,name')
+    assert [(item['name'], item['id']) for item in items] == sorted(((name, i) for i, name in enumerate(NAMES, 1)), reverse=True)
+
+def test_rows_written_between_pages_are_not_skipped(app, client):
+    add_people(app)
+    first = client.get('/people?limit=4')
+    with app.app_context():
+        db.session.add(Character(name='Obi-Wan', birth_year='57BBY'))
+        db.session.commit()
+    rest, _ = read_pages(client, '/people?limit=4&after=%s' % first.headers['X-Next-Cursor'])
+    assert [item['id'] for item in first.json + rest] == list(range(1, 10))
+
+def test_bad_cursors_are_rejected(app, client):
+    add_people(app)
+    assert client.get('/people?after=abc').status_code == 400
+    assert client.get('/people?sort=name&after=3').status_code == 400
+    assert client.get('/people?sort=name&cursor=not-a-cursor').status_code == 400
+    assert client.get('/people?sort=hair_color').status_code == 400
+    assert client.get('/people?limit=0').status_code == 400
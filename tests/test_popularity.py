@@ -0,0 +1,26 @@
+import favorites
+from favorites import add_favorites, remove_favorites
+from models import db, User, Character
+from conftest import out_of_band
+
+def test_leaderboard_stays_exact_through_concurrent_removals(app, client, monkeypatch):
+    with app.app_context():
+        db.session.add_all([User(first_name='User', last_name=str(i), email='user%d@example.com' % i, password='x')
+                            for i in range(1, 4)])
+        db.session.add_all([Character(name='Luke', birth_year='19BBY'), Character(name='Leia', birth_year='19BBY')])
+        db.session.commit()
+        for user_id in (1, 2, 3):
+            add_favorites(user_id, {'people': {1, 2}})
+        remove_favorites(1, {'people': {2}})
+        delete_statements = favorites.delete_statements
+
+        def racing(*args):
+            # a concurrent removal of the same favorite, counted by its own request
+            out_of_band(app, 'DELETE FROM "favorite-character" WHERE user_id = 2 AND character_id = 2')
+            out_of_band(app, "UPDATE favorite_count SET favorites = favorites - 1 WHERE entity_type = 'people' AND entity_id = 2")
+            return delete_statements(*args)
+
+        monkeypatch.setattr(favorites, 'delete_statements', racing)
+        remove_favorites(2, {'people': {2}})
+    top = client.get('/leaderboard/people').json
+    assert [(entry['id'], entry['favorites']) for entry in top['results']] == [(1, 3), (2, 1)]
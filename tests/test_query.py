@@ -0,0 +1,18 @@
+from models import db, Character
+
+def test_name_prefix(app, client):
+    with app.app_context():
+        for name in ('Luke Skywalker', 'luminara Unduli', 'Lu_x', 'Lux', 'Leia Organa'):
+            db.session.add(Character(name=name, birth_year='19BBY'))
+        db.session.commit()
+
+    def names(query):
+        response = client.get('/people?' + query)
+        assert response.status_code == 200
+        return sorted(row['name'] for row in response.json)
+
+    # a range of the name index, compared byte by byte: case sensitive
+    assert names('name=Lu') == ['Lu_x', 'Luke Skywalker', 'Lux']
+    assert names('name=Lu_') == ['Lu_x']
+    assert names('name__prefix=lu') == ['luminara Unduli']
+    assert names('name=') == ['Leia Organa', 'Lu_x', 'Luke Skywalker', 'Lux', 'luminara Unduli']
@@ -0,0 +1,18 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from models import db
+from seed import seed
+from explain_queries import check
+
+def test_collection_queries_use_indexes(app):
+    """benchmarks/explain_queries.py on a small seeded SQLite database: no SCAN <table> where an index must be searched."""
+    seed(2000, app=app)
+    with app.app_context():
+        with db.engine.connect() as connection:
+            failures = ['/%s?%s: %s (%s)' % (collection, query_args, ', '.join(problems), '; '.join(lines))
+                        for collection, query_args, lines, problems, unindexed in check(connection, 'sqlite')
+                        if problems]
+    assert failures == []
@@ -0,0 +1,17 @@
+import logging
+from ratelimit import rate_limiter
+
+def test_proxy_count_defaults_to_one_on_heroku(monkeypatch, make_app):
+    monkeypatch.setenv('DYNO', 'web.1')
+    app = make_app()
+    assert app.config['RATELIMIT_PROXY_COUNT'] == 1
+    environ = {'REMOTE_ADDR': '10.1.2.3', 'HTTP_X_FORWARDED_FOR': '203.0.113.7'}
+    assert rate_limiter.client_ip(environ) == '203.0.113.7'
+
+def test_forwarded_for_without_proxy_count_is_logged_once(app, caplog):
+    assert app.config['RATELIMIT_PROXY_COUNT'] == 0
+    environ = {'REMOTE_ADDR': '10.1.2.3', 'HTTP_X_FORWARDED_FOR': '203.0.113.7'}
+    with app.test_request_context(), caplog.at_level(logging.ERROR):
+        assert rate_limiter.client_ip(environ) == '10.1.2.3'
+        assert rate_limiter.client_ip(environ) == '10.1.2.3'
+    assert [record.levelno for record in caplog.records if 'RATELIMIT_PROXY_COUNT' in record.getMessage()] == [logging.ERROR]
@@ -0,0 +1,38 @@
+import pytest
+from sqlalchemy import create_engine
+from models import db, User
+from replicas import replica_router
+
+@pytest.fixture
+def replicated(make_app, tmp_path):
+    """The API on a primary SQLite file and a replica file that replication never reaches."""
+    replica_url = 'sqlite:///' + str(tmp_path / 'replica.db')
+    app = make_app('primary.db', DB_REPLICA_URLS=replica_url)
+    replica = create_engine(replica_url)
+    db.metadata.create_all(replica)
+    with replica.begin() as connection:
+        connection.execute(User.__table__.insert().values(id=1, first_name='Stale', last_name='Replica',
+                                                          email='stale@example.com', password='x'))
+    replica.dispose()
+    yield app
+    replica_router.configure([])
+
+def first_names(response):
+    return [user['first_name'] for user in response.json]
+
+def test_get_after_post_reads_the_primary(replicated):
+    writer = replicated.test_client()
+    reader = replicated.test_client()
+    other = {'REMOTE_ADDR': '10.0.0.2'}
+    assert first_names(reader.get('/user', environ_base=other)) == ['Stale']
+
+    response = writer.post('/user', json={'first_name': 'Leia', 'last_name': 'Organa', 'email': 'leia@example.com',
+                                          'password': 'secret'})
+    assert response.status_code == 200
+    assert first_names(writer.get('/user')) == ['Leia']
+    # without the cookie, the worker that served the write still remembers the client
+    writer.cookie_jar.clear()
+    assert first_names(writer.get('/user')) == ['Leia']
+    # the other clients keep reading the replica
+    assert first_names(reader.get('/user', environ_base=other)) == ['Stale']
+    assert replica_router.replicas[0].reads == 2
@@ -0,0 +1,27 @@
+from models import db, Vehicle
+from search import search_engine, MAX_OFFSET
+from conftest import out_of_band
+
+def test_memory_index_follows_the_change_feed(app, client):
+    search_engine.setting, search_engine.refresh_seconds = 'memory', 0
+    with app.app_context():
+        for name in ('Snowspeeder', 'Sand Crawler'):
+            db.session.add(Vehicle(name=name, model='T-47', manufacturer='Incom', cost_in_credits=1, length=5, cargo_capacity=10))
+        db.session.commit()
+
+    def found(q):
+        response = client.get('/search?type=vehicle&q=' + q)
+        assert response.status_code == 200
+        return [result['id'] for result in response.json['results']]
+
+    assert found('snowspeeder') == [1]
+    # written by another process: only the change feed tells the index
+    out_of_band(app, "UPDATE vehicle SET name = 'Airspeeder' WHERE id = 1")
+    out_of_band(app, "DELETE FROM vehicle WHERE id = 2")
+    assert found('snowspeeder') == []
+    assert found('airspeeder') == [1]
+    assert found('crawler') == []
+
+def test_search_offset_is_capped(client):
+    response = client.get('/search?q=luke&offset=%d' % (MAX_OFFSET * 10))
+    assert response.status_code == 200 and response.json['offset'] == MAX_OFFSET
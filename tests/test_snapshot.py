@@ -0,0 +1,28 @@
+import pytest
+from main import warm
+from models import db, Vehicle
+from snapshot import catalog
+from conftest import out_of_band
+
+@pytest.fixture
+def snapshot_app(make_app):
+    """The API serving the catalog from the snapshot, its tables checked on every request."""
+    app = make_app(CATALOG_SNAPSHOT=True, CATALOG_SNAPSHOT_REFRESH_SECONDS=0)
+    with app.app_context():
+        db.session.add(Vehicle(name='Speeder', model='74-Z', manufacturer='Aratech', cost_in_credits=8000, length=3,
+                               cargo_capacity=4))
+        db.session.commit()
+    return app
+
+def test_edit_after_warm_up_reaches_the_snapshot(snapshot_app):
+    warm(snapshot_app)
+    client = snapshot_app.test_client()
+    first = client.get('/vehicle')
+    assert client.get('/vehicle/1').json['name'] == 'Speeder'
+    # an edit keeps the count, the max id and the created timestamps: only the change_log moves the version
+    out_of_band(snapshot_app, "UPDATE vehicle SET name = 'Skiff' WHERE id = 1")
+    catalog.refresh(Vehicle)  # what the requests schedule in the background
+    assert client.get('/vehicle/1').json['name'] == 'Skiff'
+    second = client.get('/vehicle')
+    assert second.json[0]['name'] == 'Skiff'
+    assert second.headers['ETag'] != first.headers['ETag']